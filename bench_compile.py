@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the compiled evaluation of queries (expr_compile) against
+# Expr.evaluate, in messages per second, on messages held in memory.
+# Run: python bench_compile.py
+
+import email.mime.application
+import email.mime.multipart
+import email.mime.text
+import timeit
+
+import emailextra
+import expr_compile
+from expr import *
+from expr_special import *
+from expr_eval import *
+from testutil import *
+
+##### messages ######################################################
+
+def messages(count):
+  result = []
+  for i in range(count):
+    text = email.mime.text.MIMEText('Hello %d\n' % i)
+    if i % 3 == 0:
+      message = email.mime.multipart.MIMEMultipart()
+      message.attach(text)
+      message.attach(email.mime.application.MIMEApplication('x' * (i * 7)))
+    else:
+      message = text
+    message['From'] = 'Person %d <p%d@example%d.com>' % (i, i, i % 10)
+    message['To'] = 'list%d@example.org' % (i % 4)
+    message['Cc'] = 'Other %d <o%d@example.net>' % (i, i)
+    if i % 2 == 0:
+      message['Subject'] = '=?utf-8?q?Zg=C5=82oszenie_nr_%d?=' % i
+    else:
+      message['Subject'] = 'Re: report %d' % i
+    result.append(message)
+  return result
+
+##### queries #######################################################
+
+# RETURN: list of (name, query)
+def queries():
+  return [
+    ('ASCII substring in a header',
+     substring(const('example3'), header('From'))),
+    ('non-ASCII substring in a header',
+     substring(const(u'zgłoszenie'), header('Subject'))),
+    ('OR of 4 header substrings',
+     logical(ExprOr, [substring(const(u'nr 1'), header('Subject')),
+                      substring(const(u'list2'), header('To')),
+                      substring(const(u'o7@'), header('Cc')),
+                      substring(const(u'Person 9'), header('From'))])),
+    ('exists over 3 headers',
+     exists(ET.String, [header('From'), header('To'), header('Cc')],
+            substring(const(u'example5'), ExprVar(ET.String, dict(),
+                                                 dict())))),
+    ('AND: header, attachment size',
+     logical(ExprAnd, [substring(const(u'Person'), header('From')),
+                       attachmentLarger(3000)])),
+    ('OR of 2 ANDs sharing an att. size',
+     logical(ExprOr, [logical(ExprAnd, [substring(const(u'list'),
+                                                  header('To')),
+                                        attachmentLarger(3000)]),
+                      logical(ExprAnd, [substring(const(u'example'),
+                                                  header('From')),
+                                        attachmentLarger(3000)])])),
+  ]
+
+def run(matches, raw, contexts):
+  if contexts == None:
+    def loop():
+      for message in raw:
+        matches(emailextra.MessageContext(message))
+  else:
+    def loop():
+      for message in contexts:
+        matches(message)
+  return min(timeit.repeat(loop, number=1, repeat=15))
+
+def main():
+  raw = messages(3000)
+  print 'Messages per second, %d messages in memory. "fresh": a new' % len(raw)
+  print 'MessageContext for each message, as in a search; "warm": the same'
+  print 'ones again, their headers already decoded, which leaves the cost'
+  print 'of the evaluation itself.'
+  print
+  print '%-34s %26s %26s' % ('', '--------- fresh ----------',
+                              '---------- warm ----------')
+  print '%-34s %9s %9s %6s %9s %9s %6s' % \
+    ('query', 'evaluate', 'compiled', 'gain', 'evaluate', 'compiled', 'gain')
+  for (name, query) in queries():
+    interpreted = lambda message: query.evaluate(message, dict(), dict())
+    compiled = expr_compile.CompiledQuery(query).matches
+    contexts = [emailextra.MessageContext(message) for message in raw]
+    for message in contexts:
+      if interpreted(message) != compiled(message):
+        raise BaseException("Different result for: "+name)
+    line = '%-34s' % name
+    for kept in (None, contexts):
+      before = run(interpreted, raw, kept)
+      after = run(compiled, raw, kept)
+      line += ' %9d %9d %5.1fx' % \
+        (len(raw) / before, len(raw) / after, before / after)
+    print line
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Microbenchmarks of emailextra.decodeHeader against the header
+# decoding moss used before (kept below for the comparison).
+# Run: python bench_decoding.py
+
+import email.header
+import timeit
+
+import emailextra
+
+##### the previous implementation ###################################
+
+def oldHeaderDecodeSafely(headerText):
+  text = headerText
+  if text == None:
+    text = ''
+  out = []
+  while True:
+    match = emailextra.headerDecodeSafely_pattern.search(text)
+    if match == None:
+      out.append((text, None))
+      return out
+    else:
+      if match.start() > 0:
+        out.append((text[:match.start()], None))
+        text = text[match.start():]
+      out.extend(email.header.decode_header(match.group(0)))
+      text = text[len(match.group(0)):]
+
+def oldDecodeHeader(headerText):
+  out = u""
+  for pair in oldHeaderDecodeSafely(headerText):
+    (text, encoding) = pair
+    if encoding == None:
+      out += unicode(text, 'ascii', 'replace')
+    else:
+      out += unicode(text, encoding, 'replace')
+  return out
+
+##### cases #########################################################
+
+# RETURN: list of (name, header values, number of times to decode them)
+def cases():
+  word = '=?utf-8?q?Zg=C5=82oszenie_b=C5=82=C4=99du?='
+  return [
+    ('short ASCII subject', ['Re: weekly meeting notes'], 10000),
+    ('folded To, 50 addresses',
+     [',\n '.join('Person %d <p%d@example.com>' % (i, i) for i in range(50))],
+     10000),
+    ('encoded subject, repeated', [word + ' [list] #1234'], 10000),
+    ('encoded subjects, same words',
+     ['[list] Re: %s #%d' % (word, i) for i in range(10000)], 1),
+    ('encoded subjects, all different',
+     ['=?utf-8?q?Zg=C5=82oszenie_nr_%d?=' % i for i in range(10000)], 1),
+    ('folded, 200 encoded words, different',
+     ['\n '.join(['=?utf-8?q?Zg=C5=82oszenie_%d_%d?=' % (j, i)
+                   for i in range(200)]) for j in range(20)], 1),
+  ]
+
+def run(values, decode, repeat, clearCache):
+  def loop():
+    if clearCache:
+      emailextra._decodedHeaders = emailextra.LruCache(4096)
+    for value in values:
+      decode(value)
+  return min(timeit.repeat(loop, number=1, repeat=repeat))
+
+def main():
+  print 'Times in ms. "cold" starts with an empty memo, "warm" with the'
+  print 'memo filled by a previous run over the same headers.'
+  print
+  print '%-38s %8s %8s %8s %8s %8s' % \
+    ('case', 'before', 'cold', 'speedup', 'warm', 'speedup')
+  for (name, values, count) in cases():
+    values = values * count
+    for value in values:
+      if oldDecodeHeader(value) != emailextra.decodeHeader(value):
+        raise BaseException("Different result for: "+value)
+    before = run(values, oldDecodeHeader, 3, False)
+    cold = run(values, emailextra.decodeHeader, 3, True)
+    warm = run(values, emailextra.decodeHeader, 3, False)
+    print '%-38s %8.1f %8.1f %7.1fx %8.1f %7.1fx' % \
+      (name, before*1000, cold*1000, before/cold, warm*1000, before/warm)
+
+if __name__ == '__main__':
+  main()
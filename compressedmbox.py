@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import bz2
+import cStringIO
+import mailbox
+import os
+import struct
+import threading
+import zlib
+
+import emailextra
+
+try:
+  # the backport of the Python 3 lzma module, for .xz
+  from backports import lzma
+except ImportError:
+  try:
+    import lzma
+  except ImportError:
+    lzma = None
+
+try:
+  # python-zstandard, for .zst
+  import zstandard
+except ImportError:
+  zstandard = None
+
+##### formats #######################################################
+
+def _newGzipDecompressor():
+  return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def _newZstdDecompressor():
+  return zstandard.ZstdDecompressor().decompressobj()
+
+# file name suffix -> (function creating a decompressor, module needed)
+_formats = {
+  '.gz':  (_newGzipDecompressor, zlib),
+  '.bz2': (bz2.BZ2Decompressor, bz2),
+  '.xz':  (lzma and lzma.LZMADecompressor, lzma),
+  '.zst': (_newZstdDecompressor, zstandard),
+}
+
+def compressionOf(path):
+  """The suffix of `path' ('.gz', '.bz2', '.xz' or '.zst') if it names
+     a compressed mbox, otherwise None."""
+  suffix = os.path.splitext(path)[1].lower()
+  if suffix in _formats:
+    return suffix
+  return None
+
+def readStart(path, size):
+  """RETURNS the first `size' bytes (or fewer, if it is shorter) of the
+     uncompressed content of the file `path', compressed as
+     compressionOf tells; None if the module needed is missing. Raises
+     what the decompressor does if the file is not compressed so."""
+  (newDecompressor, module) = _formats[compressionOf(path)]
+  if module == None:
+    return None
+  decompressor = newDecompressor()
+  out = ''
+  f = open(path, 'rb')
+  try:
+    while len(out) < size:
+      data = f.read(4096)
+      if data == '':
+        break
+      (piece, rest) = _feed(decompressor, data)
+      out += piece
+      if rest != None:
+        break
+  finally:
+    f.close()
+  return out[:size]
+
+def _feed(decompressor, data):
+  """Decompresses `data'.
+     RETURNS (output, rest): rest is None if the compressed stream goes
+     on, otherwise the data found after its end (maybe '')."""
+  try:
+    out = decompressor.decompress(data)
+  except EOFError:
+    # the stream ended exactly at the end of the previous data
+    # (bz2, lzma: these complain about data after the end)
+    return ('', data)
+  # zlib has no `eof': it tells by putting data after the end aside
+  if getattr(decompressor, 'eof', False) or decompressor.unused_data:
+    return (out, decompressor.unused_data)
+  return (out, None)
+
+##### the mailbox ###################################################
+
+class CompressedMbox(mailbox.mbox):
+  """A read-only mbox compressed as a whole with gzip, bzip2, xz or
+     zstd, read by decompressing it on the fly, without a temporary
+     copy. Keys and (start, stop) offsets are those of the uncompressed
+     mbox.
+     Decompression can only start at a 'restart point': the start of
+     the file or of any later gzip member, bzip2/xz stream or zstd
+     frame (as written by e.g. pbzip2, pzstd, or simply `cat a.gz
+     b.gz'). pigz -i and xz -T do not help: they write one gzip member
+     or xz stream (split into blocks inside, which are not used). For
+     gzip, the state of the decompressor is also copied every
+     `checkpointDistance' bytes of output, so that within one session
+     any message can be reached quickly.
+     Reading messages in key order (as searches do) goes on from where
+     the previous read stopped, so a search decompresses the file once.
+     The table of contents and the restart points are kept in
+     '<mbox>.moss-toc' and reused while the file is unchanged."""
+
+  # how much compressed data to read at once
+  chunkSize = 1 << 20
+  # in-memory checkpoints (gzip only), in uncompressed bytes
+  checkpointDistance = 8 << 20
+  # uncompressed data kept before the last message read, so that reader
+  # threads (see scan.PipelinedScanner) may ask a bit out of order
+  keepBehind = 4 << 20
+
+  def __init__(self, path, factory=None, create=False):
+    (newDecompressor, module) = _formats[compressionOf(path)]
+    if module == None:
+      raise BaseException("Reading "+compressionOf(path)+" mailboxes needs "+
+                          "a module that is not installed "+
+                          "(backports.lzma for .xz, zstandard for .zst)")
+    mailbox.mbox.__init__(self, path, factory, False)
+    self._newDecompressor = newDecompressor
+    self._readLock = threading.RLock()
+    # restart points, sorted: (uncompressed offset, compressed offset,
+    # copy of the decompressor or None for the start of a stream)
+    self._points = [(0, 0, None)]
+    # uncompressed data from _bufStart on, and the decompression that
+    # goes on after it (a generator from _decompress) or None
+    self._buf = ''
+    self._bufStart = 0
+    self._cursor = None
+
+  def _pointBefore(self, pos):
+    """The last restart point at or before the uncompressed offset
+       `pos'."""
+    index = bisect.bisect_right(self._points, (pos, float('inf'))) - 1
+    return self._points[index]
+
+  def _addPoint(self, point):
+    # the same points are found again after going back
+    index = bisect.bisect_left(self._points, (point[0],))
+    if index == len(self._points) or self._points[index][0] != point[0]:
+      self._points.insert(index, point)
+
+  def _decompress(self, point):
+    """Yields the uncompressed data from the restart point `point' to
+       the end of the file, in pieces. Restart points passed on the
+       way are remembered."""
+    (upos, cpos, state) = point
+    decompressor = None
+    if state != None:
+      decompressor = state.copy()
+    lastCheckpoint = upos
+    while True:
+      self._file.seek(cpos)
+      data = self._file.read(self.chunkSize)
+      if data == '':
+        return
+      cpos += len(data)
+      while data != '':
+        if decompressor == None:
+          # trailing zero padding is allowed after gzip members
+          data = data.lstrip('\0')
+          if data == '':
+            break
+          decompressor = self._newDecompressor()
+        (out, rest) = _feed(decompressor, data)
+        upos += len(out)
+        if rest == None:
+          data = ''
+          if hasattr(decompressor, 'copy') and \
+             upos - lastCheckpoint >= self.checkpointDistance:
+            self._addPoint((upos, cpos, decompressor.copy()))
+            lastCheckpoint = upos
+        else:
+          data = rest
+          decompressor = None
+          self._addPoint((upos, cpos - len(rest), None))
+        if out != '':
+          yield out
+
+  def _read(self, start, stop):
+    """Returns the uncompressed data from `start' to `stop'."""
+    self._readLock.acquire()
+    try:
+      if self._cursor == None or start < self._bufStart or \
+         self._pointBefore(start)[0] > self._bufStart + len(self._buf):
+        # jumping backwards, or far enough ahead to skip some data
+        point = self._pointBefore(start)
+        self._cursor = self._decompress(point)
+        self._buf = ''
+        self._bufStart = point[0]
+      bufEnd = self._bufStart + len(self._buf)
+      if bufEnd < stop:
+        pieces = [self._buf]
+        while bufEnd < stop:
+          try:
+            piece = self._cursor.next()
+          except StopIteration:
+            break
+          if bufEnd + len(piece) <= start:
+            # not needed at all
+            self._bufStart = bufEnd + len(piece)
+            pieces = []
+          else:
+            pieces.append(piece)
+          bufEnd += len(piece)
+        # reads normally go forward: drop what is well behind `start'
+        keepFrom = max(min(start, bufEnd - self.keepBehind), self._bufStart)
+        self._buf = ''.join(pieces)[keepFrom - self._bufStart:]
+        self._bufStart = keepFrom
+      return self._buf[start - self._bufStart:stop - self._bufStart]
+    finally:
+      self._readLock.release()
+
+  #---- table of contents
+
+  def _generate_toc(self):
+    """Generate key-to-(start, stop) table of contents."""
+    starts, stops = [], []
+    self._readLock.acquire()
+    try:
+      if not self._loadToc(starts, stops):
+        self._points = [(0, 0, None)]
+        self._cursor = None
+        self._scanToc(starts, stops)
+        self._saveToc(starts, stops)
+    finally:
+      self._readLock.release()
+    self._toc = dict(enumerate(zip(starts, stops)))
+    self._next_key = len(self._toc)
+    self._tocStamp = self._fileStamp()
+
+  def snapshot(self):
+    """Builds the table of contents again if the file has changed
+       (e.g. another member was appended to a .gz)."""
+    if self._toc != None and self._fileStamp() == self._tocStamp:
+      return
+    self._generate_toc()
+
+  def _scanToc(self, starts, stops):
+    """Decompresses the whole file and fills starts/stops the same way
+       MmapMbox does: messages begin with a 'From ' line at the start
+       of the file or after a line separator."""
+    sep = os.linesep + 'From '
+    sepLen = len(os.linesep)
+    blank = os.linesep + os.linesep
+    # the file is treated as if it started with a line separator; `tail'
+    # keeps enough of the previous pieces to find separators (and the
+    # empty line before them) across pieces
+    keep = len(sep) + sepLen
+    tail = os.linesep
+    tailStart = -sepLen
+    for piece in self._decompress(self._points[0]):
+      text = tail + piece
+      pos = text.find(sep, max(len(tail) - len(sep) + 1, 0))
+      while pos != -1:
+        end = tailStart + pos + sepLen
+        if len(starts) > 0:
+          stops.append(self._stopBefore(end, starts[-1], text, tailStart))
+        starts.append(end)
+        pos = text.find(sep, pos + 1)
+      tail = text[-keep:]
+      tailStart += len(text) - len(tail)
+    size = tailStart + len(tail)
+    if len(starts) > 0:
+      stops.append(self._stopBefore(size, starts[-1], tail, tailStart))
+    self._file_length = size
+
+  def _stopBefore(self, end, start, text, textStart):
+    # like mailbox.mbox: an empty line just before the next 'From '
+    # line (or the end of file) does not belong to the message
+    sepLen = len(os.linesep)
+    lo = max(end - 2*sepLen, start) - textStart
+    if text[lo:end - textStart] == os.linesep + os.linesep:
+      return end - sepLen
+    return end
+
+  #---- table of contents sidecar
+  #
+  # '<mbox>.moss-toc' holds:
+  #   header:  magic, file size, mtime, uncompressed size, number of
+  #            messages, number of restart points
+  #   records: (start, stop) for each message, then (uncompressed
+  #            offset, compressed offset) for each restart point
+  # Only the starts of streams are kept: copies of a decompressor
+  # cannot be saved. The sidecar is used only if the file has the same
+  # size and mtime; anything else means a full scan.
+
+  _tocMagic = 'MOSSZTC1'
+  _tocHeader = struct.Struct('<8sQdQQQ')
+
+  def _tocPath(self):
+    return self._path + '.moss-toc'
+
+  def _fileStamp(self):
+    st = os.fstat(self._file.fileno())
+    return (st.st_size, st.st_mtime)
+
+  def _loadToc(self, starts, stops):
+    """Fills starts/stops and the restart points from the sidecar.
+       Returns False if it is missing or does not match the file."""
+    try:
+      f = open(self._tocPath(), 'rb')
+      try:
+        data = f.read()
+      finally:
+        f.close()
+    except IOError:
+      return False
+    if len(data) < self._tocHeader.size:
+      return False
+    (magic, size, mtime, length, count, pointCount) = \
+      self._tocHeader.unpack_from(data)
+    if magic != self._tocMagic or (size, mtime) != self._fileStamp() or \
+       len(data) != self._tocHeader.size + 16*(count + pointCount):
+      return False
+    records = struct.unpack_from('<%dQ' % (2*(count + pointCount)), data,
+                                 self._tocHeader.size)
+    starts.extend(records[0:2*count:2])
+    stops.extend(records[1:2*count:2])
+    self._points = [(records[i], records[i+1], None)
+                    for i in xrange(2*count, len(records), 2)]
+    self._cursor = None
+    self._file_length = length
+    return True
+
+  def _saveToc(self, starts, stops):
+    points = [point for point in self._points if point[2] == None]
+    records = [None] * (2*len(starts))
+    records[0::2] = starts
+    records[1::2] = stops
+    for (upos, cpos, state) in points:
+      records.extend((upos, cpos))
+    (size, mtime) = self._fileStamp()
+    header = self._tocHeader.pack(self._tocMagic, size, mtime,
+                                  self._file_length, len(starts), len(points))
+    try:
+      f = open(self._tocPath(), 'wb')
+      try:
+        f.write(header)
+        f.write(struct.pack('<%dQ' % len(records), *records))
+      finally:
+        f.close()
+    except IOError:
+      # e.g. read-only directory; we'll just scan again next time
+      pass
+
+  #---- messages
+
+  def _fromLineEnd(self, data):
+    pos = data.find('\n')
+    if pos == -1:
+      return len(data)
+    return pos + 1
+
+  def get_message(self, key):
+    """Return a Message representation or raise a KeyError."""
+    (start, stop) = self._lookup(key)
+    data = self._read(start, stop)
+    bodyStart = self._fromLineEnd(data)
+    msg = self._message_factory(data[bodyStart:].replace(os.linesep, '\n'))
+    msg.set_from(data[5:bodyStart].rstrip('\r\n'))
+    return msg
+
+  def get_string(self, key, from_=False):
+    """Return a string representation or raise a KeyError."""
+    (start, stop) = self._lookup(key)
+    data = self._read(start, stop)
+    if not from_:
+      data = data[self._fromLineEnd(data):]
+    return data.replace(os.linesep, '\n')
+
+  def get_file(self, key, from_=False):
+    """Return a file-like representation or raise a KeyError."""
+    (start, stop) = self._lookup(key)
+    data = self._read(start, stop)
+    if not from_:
+      data = data[self._fromLineEnd(data):]
+    return cStringIO.StringIO(data)
+
+  def get_header_string(self, key):
+    """Return the header section of the message (without the 'From '
+       line and the empty line ending it) or raise a KeyError."""
+    return emailextra.readHeaderBlock(self.get_file(key))
+
+  #---- writing is not supported
+
+  def add(self, message):
+    raise mailbox.Error('Compressed mailboxes are read-only')
+
+  def remove(self, key):
+    raise mailbox.Error('Compressed mailboxes are read-only')
+
+  def __setitem__(self, key, message):
+    raise mailbox.Error('Compressed mailboxes are read-only')
@@ -18,9 +18,14 @@
 # You should have received a copy of the GNU General Public License
 # along with Moss.  If not, see <http://www.gnu.org/licenses/>.
 
+import binascii
+import codecs
 import email
+import email.errors
 import email.header
+import email.parser
 import re
+import threading
 
 
 # TODO !!!
@@ -56,17 +61,42 @@ def headerDecodeSafely(headerText):
   if text == None:
     text = ''
   out = []
-  while True:
-    match = headerDecodeSafely_pattern.search(text)
-    if match == None:
-      out.append((text, None))
-      return out
-    else:
-      if match.start() > 0:
-        out.append((text[:match.start()], None))
-        text = text[match.start():]
-      out.extend(email.header.decode_header(match.group(0)))
-      text = text[len(match.group(0)):]
+  pos = 0
+  for match in headerDecodeSafely_pattern.finditer(text):
+    if match.start() > pos:
+      out.append((text[pos:match.start()], None))
+    out.extend(_decodeWord(match.group(0)))
+    pos = match.end()
+  out.append((text[pos:], None))
+  return out
+
+_encodedWord_pattern = re.compile( \
+  r'=\?([^?]*)\?([qb])\?(.*)\?=$', re.IGNORECASE)
+_qpEscape_pattern = re.compile(r'=[a-fA-F0-9]{2}')
+
+def _qpUnescape(match):
+  return chr(int(match.group(0)[1:], 16))
+
+def _decodeWord(word):
+  """The same as email.header.decode_header(word) for a single encoded
+     word (as matched by headerDecodeSafely_pattern), without splitting
+     and joining the header again."""
+  match = _encodedWord_pattern.match(word)
+  if match == None:
+    # unusual (e.g. a '?' in the charset): let the library decide
+    return email.header.decode_header(word)
+  (charset, encoding, encoded) = match.groups()
+  if encoding in 'qQ':
+    decoded = _qpEscape_pattern.sub(_qpUnescape, encoded.replace('_', ' '))
+  else:
+    padding = len(encoded) % 4
+    if padding:
+      encoded += '==='[:4 - padding]
+    try:
+      decoded = binascii.a2b_base64(encoded)
+    except binascii.Error:
+      raise email.errors.HeaderParseError
+  return [(decoded, charset.lower())]
 
 def headerToUnicode(message, headerName):
   """Take the header named `headerName' from the Message
@@ -80,17 +110,222 @@ def headerToUnicode(message, headerName):
      WARNING. May raise exceptions.
      !!
      TODO. Catch the exceptions and deal with them."""
-  list = message.get(headerName)
-  out = u""
-  for pair in headerDecodeSafely(message.get(headerName)):
-    (text, encoding) = pair
-#    print "TEXT >>{0}<< enc >>{1}<<".format( text, encoding )
-    if encoding == None:
-      out += unicode(text, 'ascii', 'replace')
-    else:
-      out += unicode(text, encoding, 'replace')
+  return decodeHeader(message.get(headerName))
+
+def decodeHeader(headerText):
+  """Decode the raw header value `headerText' (may be None)
+     like headerToUnicode does.
+     PARAM headerText : string or None
+     RETURNS Unicode string"""
+  if headerText == None:
+    return u""
+  if not '=?' in headerText:
+    # nothing encoded: the common case
+    return unicode(headerText, 'ascii', 'replace')
+  out = _decodedHeaders.get(headerText)
+  if out == None:
+    parts = []
+    for pair in headerDecodeSafely(headerText):
+      (text, encoding) = pair
+      if encoding == None:
+        parts.append(text.decode('ascii', 'replace'))
+      else:
+        parts.append(_decoder(encoding)(text, 'replace')[0])
+    out = u"".join(parts)
+    _decodedHeaders.put(headerText, out)
   return out
 
+_decoders = dict()
+
+def _decoder(encoding):
+  """The decoding function of the codec `encoding' (looked up once).
+     Raises LookupError for unknown encodings, like unicode() does."""
+  decoder = _decoders.get(encoding)
+  if decoder == None:
+    decoder = codecs.lookup(encoding).decode
+    _decoders[encoding] = decoder
+  return decoder
+
+# indexes into a link of LruCache: [previous link, next link, key, value]
+_PREV = 0
+_NEXT = 1
+_KEY = 2
+_VALUE = 3
+
+class LruCache:
+  """A map keeping at most `size' entries; when full, the least
+     recently used one is dropped. Safe to use from several threads.
+     The entries form a circular list around the root link, the
+     most recently used one just before the root."""
+
+  def __init__(self, size):
+    self._size = size
+    self._lock = threading.Lock()
+    # key -> link
+    self._map = dict()
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None]
+
+  # RETURN: the value for `key', or None
+  def get(self, key):
+    self._lock.acquire()
+    link = self._map.get(key)
+    if link == None:
+      self._lock.release()
+      return None
+    # move it to the front
+    link[_PREV][_NEXT] = link[_NEXT]
+    link[_NEXT][_PREV] = link[_PREV]
+    root = self._root
+    last = root[_PREV]
+    last[_NEXT] = root[_PREV] = link
+    link[_PREV] = last
+    link[_NEXT] = root
+    value = link[_VALUE]
+    self._lock.release()
+    return value
+
+  def put(self, key, value):
+    self._lock.acquire()
+    root = self._root
+    if key in self._map:
+      self._map[key][_VALUE] = value
+    elif len(self._map) >= self._size:
+      # the root takes the new entry and the oldest entry becomes the
+      # root, which saves unlinking and linking
+      root[_KEY] = key
+      root[_VALUE] = value
+      self._map[key] = root
+      self._root = root[_NEXT]
+      del self._map[self._root[_KEY]]
+      self._root[_KEY] = self._root[_VALUE] = None
+    else:
+      last = root[_PREV]
+      link = [last, root, key, value]
+      last[_NEXT] = root[_PREV] = self._map[key] = link
+    self._lock.release()
+
+  def __len__(self):
+    return len(self._map)
+
+# raw header value -> decoded value, for headers with encoded words;
+# Subject and From values repeat a lot in mailing list traffic
+_decodedHeaders = LruCache(4096)
+
+def readHeaderBlock(f):
+  """Read the header section of a message from the file-like object
+     `f', that is everything up to (not including) the first empty
+     line. The body is not read at all.
+     PARAM f : file-like object positioned at the start of a message
+     RETURNS string"""
+  lines = []
+  while True:
+    line = f.readline()
+    if line in ('', '\n', '\r\n'):
+      return ''.join(lines)
+    lines.append(line)
+
+def parseHeaderBlock(f):
+  """Parse only the headers of the message read from `f' (see
+     readHeaderBlock). The resulting Message has no payload.
+     RETURNS Message"""
+  return email.parser.HeaderParser().parsestr(readHeaderBlock(f))
+
+def loadHeaderString(mbox, key):
+  """Read the message `key' of the mailbox `mbox' only up to the blank
+     line ending its headers. Mailboxes that can hand out the header
+     section directly (get_header_string) are asked for it.
+     RETURNS string"""
+  if hasattr(mbox, 'get_header_string'):
+    return mbox.get_header_string(key)
+  f = mbox.get_file(key)
+  try:
+    return readHeaderBlock(f)
+  finally:
+    f.close()
+
+def loadHeaders(mbox, key):
+  """Like loadHeaderString, but parses the headers.
+     RETURNS Message without payload"""
+  return email.parser.HeaderParser().parsestr(loadHeaderString(mbox, key))
+
+class MessageContext(object):
+  """A message as seen by the evaluation of a query (Expr.evaluate).
+     The header list of a Message is searched linearly by every get();
+     here, on the first header access, a map from lowercase header
+     names to their values is built, and decoded values are kept, so
+     any further header access for this message is a dict lookup.
+     Other attributes are those of the wrapped Message."""
+
+  # True if the headers come from a headercache.HeaderCache: then
+  # values that need only them are not worth a valuecache.ValueCache
+  headersCached = False
+
+  def __init__(self, message):
+    self._message = message
+    # lowercase name -> list of raw values, built on first use
+    self._headers = None
+    # lowercase name -> decoded value of the first occurrence
+    self._decoded = dict()
+    # identifies the message across searches, for a
+    # valuecache.ValueCache (see valuecache.messageKey), or None
+    self.memoKey = None
+
+  def getMessage(self):
+    return self._message
+
+  # RETURN: list of the raw values of the header (empty if absent)
+  def getHeaders(self, headerName):
+    if self._headers == None:
+      headers = dict()
+      for (name, value) in self.getMessage().items():
+        lname = name.lower()
+        if lname in headers:
+          headers[lname].append(value)
+        else:
+          headers[lname] = [value]
+      self._headers = headers
+    return self._headers.get(headerName.lower(), [])
+
+  def headerToUnicode(self, headerName):
+    """Like the function headerToUnicode, for this message."""
+    lname = headerName.lower()
+    value = self._decoded.get(lname)
+    if value == None:
+      values = self.getHeaders(lname)
+      if len(values) == 0:
+        value = decodeHeader(None)
+      else:
+        value = decodeHeader(values[0])
+      self._decoded[lname] = value
+    return value
 
+  def headerContains(self, headerName, needle):
+    """Same as `needle in self.headerToUnicode(headerName)' for an
+       ASCII string `needle', but when the raw value has no encoded
+       words ('=?') it is searched directly, without decoding: then
+       decoding only turns non-ASCII bytes into U+FFFD, which cannot
+       take part in a match of an ASCII needle."""
+    lname = headerName.lower()
+    if not lname in self._decoded:
+      values = self.getHeaders(lname)
+      if len(values) == 0:
+        raw = ''
+      else:
+        raw = values[0]
+      if raw.find('=?') == -1:
+        return needle in raw
+    return needle in self.headerToUnicode(headerName)
 
+  def __getattr__(self, name):
+    return getattr(self.getMessage(), name)
 
+def asciiOrNone(text):
+  """RETURNS `text' as an ASCII str, or None if it is not ASCII"""
+  try:
+    if isinstance(text, unicode):
+      return text.encode('ascii')
+    text.decode('ascii')
+    return text
+  except UnicodeError:
+    return None
@@ -234,7 +234,7 @@ class ExprAnd(Expr):
   def getFlatTree(self):
     l = [self]
     for child in self._children:
-      l.extend(child.getFlatTree)
+      l.extend(child.getFlatTree())
     return l
 
 class ExprOr(Expr):
@@ -283,7 +283,7 @@ class ExprOr(Expr):
   def getFlatTree(self):
     l = [self]
     for child in self._children:
-      l.extend(child.getFlatTree)
+      l.extend(child.getFlatTree())
     return l
 
 class ExprForAll(Expr):
@@ -364,8 +364,8 @@ class ExprForAll(Expr):
   def getFlatTree(self):
     l = [self]
     for val in self._values:
-      l.extend(val.getFlatTree)
-    l.extend(self._expr.getFlatTree)
+      l.extend(val.getFlatTree())
+    l.extend(self._expr.getFlatTree())
     return l
 
 class ExprExists(Expr):
@@ -447,8 +447,8 @@ class ExprExists(Expr):
   def getFlatTree(self):
     l = [self]
     for val in self._values:
-      l.extend(val.getFlatTree)
-    l.extend(self._expr.getFlatTree)
+      l.extend(val.getFlatTree())
+    l.extend(self._expr.getFlatTree())
     return l
 
 class ExprConst(Expr):
@@ -0,0 +1,721 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compilation of queries into closures, once per search (see scan.search).
+#
+# Expr.evaluate walks the tree for every message: a method lookup per
+# node, environments passed down as dicts, type tests (isTypeList, the
+# fast path of ExprSubstring) and comparisons with True/False made again
+# and again. Here all of that is decided once: each node becomes a
+# function of the message only, with the constants of the query bound
+# in it, and each variable a slot of a list shared by the functions of
+# one query. The result is the same as that of Expr.evaluate. What is
+# compiled is a simplified copy of the query (see expr_simplify).
+#
+# The children of ExprAnd and ExprOr are evaluated in the order expr_plan
+# finds best. As its estimates may be wrong for the mailbox at hand, the
+# order is then learnt: for the first messages, each ExprAnd, ExprOr,
+# ExprForAll and ExprExists with several children (values, for the
+# quantifiers) times them and counts how often they are true, and puts
+# first those that decide most often for the least time (see _Adaptive).
+#
+# Subexpressions that occur several times in the query (as the
+# expansion of quantifiers makes them, see expr_simplify) are compiled
+# once, and evaluated at most once per message: the query becomes a DAG
+# (see _Shared). Only those whose variables are all bound inside them
+# are shared, their value depending on the message alone. For the same
+# reason, the values of those that need more than the headers may be
+# kept from one search to the next, in a valuecache.ValueCache - and
+# those that need the headers only, for messages whose headers are not
+# in a HeaderCache (IMAP mailboxes, ...).
+
+import time
+
+import expr_plan
+import expr_simplify
+import mimestream
+from expr import *
+from expr_eval import *
+
+class _Scope:
+  """The variables of a query being compiled: a slot in `frame' for
+     each variable name, and the names bound where the compilation is.
+     As in Expr.evaluate, where the quantifiers set the variables in one
+     dict for the whole query, a name has one slot, whichever quantifier
+     binds it.
+     Also collects the _Adaptive nodes of the query, if `adaptive', and
+     has the _Shared subexpressions of the query, `shared', and the
+     expr_plan.Estimates of its parts, `estimates'."""
+
+  def __init__(self, adaptive, shared, estimates):
+    self.frame = []
+    self.adaptive = adaptive
+    self.shared = shared
+    self.estimates = estimates
+    # _Adaptive, in the order of compilation
+    self.adaptives = []
+    # variable name -> index in frame
+    self._slots = dict()
+    self._bound = set()
+    # [number of quantifiers binding a name already bound]
+    self._shadows = [0]
+
+  def slot(self, name):
+    if not name in self._slots:
+      self._slots[name] = len(self.frame)
+      self.frame.append(None)
+    return self._slots[name]
+
+  # RETURN: copy of the scope where `name' is bound too, sharing the
+  #         rest
+  def binding(self, name):
+    scope = _Scope(self.adaptive, self.shared, self.estimates)
+    scope.frame = self.frame
+    scope.adaptives = self.adaptives
+    scope._slots = self._slots
+    scope._bound = self._bound | set([name])
+    scope._shadows = self._shadows
+    if name in self._bound:
+      self._shadows[0] += 1
+    return scope
+
+  def isBound(self, name):
+    return name in self._bound
+
+  # RETURN: how many times a quantifier compiled so far bound a variable
+  #         bound already
+  def getShadows(self):
+    return self._shadows[0]
+
+class _Adaptive:
+  """A node of a query whose children are evaluated in an order learnt
+     while searching: an ExprAnd or ExprForAll (`conjunction' True: the
+     first child that is false decides), or an ExprOr or ExprExists (the
+     first one that is true decides). The children are those of ExprAnd
+     and ExprOr, the values of the quantifiers.
+     While `sampling', the node is evaluated by run(), which times each
+     child and counts how often it is true; every `reorderEvery'
+     evaluations, the children are put in the order of the time they
+     take per decision. After `sampleSize' evaluations the order stays
+     as it is, and the node is evaluated without run()."""
+
+  sampleSize = 2000
+  reorderEvery = 100
+  # every so many evaluations, the children after the one that decides
+  # are evaluated too, so as to learn about those that rarely get their
+  # turn
+  exploreEvery = 50
+  # weight of the static estimate of selectivity, in evaluations
+  priorWeight = 10
+
+  # expr        - the node
+  # children    - its children, Expr
+  # priors      - estimated selectivity of each child (see expr_plan)
+  # order       - the order to begin with, list of indices of children
+  # apply       - called with the order each time it changes
+  def __init__(self, expr, children, priors, order, conjunction, apply):
+    self.expr = expr
+    self.children = children
+    self.priors = priors
+    self.order = list(order)
+    self.conjunction = conjunction
+    self._apply = apply
+    self.sampling = True
+    self._samples = 0
+    count = len(children)
+    self._evaluations = [0] * count
+    self._trues = [0] * count
+    self._seconds = [0.0] * count
+    # the counts reported last (see takeStatistics)
+    self._reported = ([0] * count, [0] * count, [0.0] * count)
+
+  # unit - function(index of a child) evaluating the child
+  # RETURN: the value of the node
+  def run(self, unit):
+    decided = False
+    result = self.conjunction
+    explore = self._samples % self.exploreEvery == 0
+    for index in self.order:
+      if not decided:
+        if self._measure(unit, index) != self.conjunction:
+          result = not self.conjunction
+          decided = True
+      elif explore:
+        try:
+          self._measure(unit, index)
+        except (KeyboardInterrupt, SystemExit):
+          raise
+        except BaseException:
+          # it would not have been evaluated at all
+          pass
+      else:
+        break
+    self._samples += 1
+    if self._samples % self.reorderEvery == 0 or \
+       self._samples == self.sampleSize:
+      self.order = learnedOrder(self._evaluations, self._trues,
+                                self._seconds, self.priors,
+                                self.conjunction, self.order)
+      self._apply(self.order)
+    if self._samples >= self.sampleSize:
+      self.sampling = False
+    return result
+
+  def _measure(self, unit, index):
+    start = time.time()
+    value = bool(unit(index))
+    self._seconds[index] += time.time() - start
+    self._evaluations[index] += 1
+    if value:
+      self._trues[index] += 1
+    return value
+
+  # RETURN: (evaluations, times true, seconds) of each child, since the
+  #         previous call
+  def takeStatistics(self):
+    current = (list(self._evaluations), list(self._trues),
+               list(self._seconds))
+    statistics = [[now - before for (now, before) in zip(*pair)]
+                  for pair in zip(current, self._reported)]
+    self._reported = current
+    return statistics
+
+# evaluations - how many times each child was evaluated
+# trues       - how many times it was true
+# seconds     - how long it took altogether
+# priors      - estimated selectivity of each child
+# current     - the order so far: those that have never been evaluated
+#               stay in it, after the others
+# RETURN: the order to evaluate the children in, list of their indices
+def learnedOrder(evaluations, trues, seconds, priors, conjunction, current):
+  weight = _Adaptive.priorWeight
+  def rank(index):
+    n = evaluations[index]
+    if n == 0:
+      return (1, 0, current.index(index))
+    p = (trues[index] + priors[index] * weight) / (n + weight)
+    if conjunction:
+      # the chance of deciding is that of being false
+      p = 1.0 - p
+    return (0, (seconds[index] / n) / max(p, 1e-6), current.index(index))
+  return sorted(current, key=rank)
+
+# a: list of statistics of the _Adaptive nodes of a query, as
+#    CompiledQuery.takeStatistics returns them, or None
+# b: the same, of the same query
+# RETURN: both together
+def mergeStatistics(a, b):
+  if a == None:
+    return b
+  if b == None:
+    return a
+  return [[[x + y for (x, y) in zip(xs, ys)]
+           for (xs, ys) in zip(nodeA, nodeB)]
+          for (nodeA, nodeB) in zip(a, b)]
+
+class _Shared:
+  """The subexpressions that occur more than once in a query, by their
+     key (see Expr.getKey). Each is compiled once, into a function that
+     keeps its value for the message being evaluated in a slot of its
+     own; wrap() makes the function of the whole query empty the slots
+     after each message, so that no message is kept.
+     Evaluating a quantifier leaves a value in its variable, which is
+     the same for each occurrence, but may be seen after it by a
+     variable of the same name if a quantifier binding that name is
+     around (see _Scope): such occurrences are not shared.
+     With a valuecache.ValueCache, `cache', the values of those that
+     need more than the headers of the message are looked up there
+     first, and kept there, for the messages that have a memoKey (see
+     emailextra.MessageContext); the values of those that need only the
+     headers too, for the messages without a HeaderCache (see
+     MessageContext.headersCached)."""
+
+  # the others cost no more than the lookup of the slot
+  classes = (ExprSubstring, ExprAnd, ExprOr, ExprForAll, ExprExists,
+             ExprAllAttachments, ExprAttSize, ExprGt, ExprCustomHeader)
+
+  def __init__(self, query, cache):
+    self._cache = cache
+    # number of subexpressions looked up in the cache: of those that
+    # need more than the headers, of those that need only them
+    self.cached = 0
+    self.cachedHeaders = 0
+    # id of a subexpression -> its key
+    self._keys = dict()
+    counts = dict()
+    for expr in query.getFlatTree():
+      if isinstance(expr, self.classes):
+        key = expr.getKey(frozenset())
+        if key != None:
+          self._keys[id(expr)] = key
+          counts[key] = counts.get(key, 0) + 1
+    self._repeated = set([key for (key, count) in counts.items()
+                          if count > 1])
+    # key -> the compiled function
+    self._functions = dict()
+    # [message, value] of each shared subexpression
+    self._slots = []
+
+  # expr    - a subexpression of the query
+  # scope   - _Scope where it is
+  # compile - function() compiling it
+  # RETURN: the function evaluating `expr'
+  def compile(self, expr, scope, compile):
+    key = self._keys.get(id(expr))
+    if key == None:
+      return compile()
+    for sub in expr.getFlatTree():
+      if isinstance(sub, (ExprForAll, ExprExists)) and \
+         scope.isBound(sub._varName):
+        return compile()
+    if self._cache != None and expr.getNeeds() >= MsgNeeds.Headers:
+      compile = self._cached(key, compile,
+                             expr.getNeeds() == MsgNeeds.Headers)
+    if not key in self._repeated:
+      return compile()
+    if not key in self._functions:
+      function = compile()
+      slot = [None, None]
+      self._slots.append(slot)
+      def evaluate(message):
+        if slot[0] is not message:
+          slot[1] = function(message)
+          slot[0] = message
+        return slot[1]
+      self._functions[key] = evaluate
+    return self._functions[key]
+
+  # headers - True if the subexpression needs only the headers
+  # RETURN: function() compiling the subexpression with the key `key'
+  #         as `compile' does, looking up its values in the cache
+  def _cached(self, key, compile, headers):
+    cache = self._cache
+    if headers:
+      self.cachedHeaders += 1
+    else:
+      self.cached += 1
+    missing = []
+    def compileCached():
+      function = compile()
+      def evaluate(message):
+        if message.memoKey == None or \
+           (headers and message.headersCached):
+          return function(message)
+        entry = (key, message.memoKey)
+        value = cache.get(entry, missing)
+        if value is missing:
+          value = function(message)
+          cache.put(entry, value)
+        return value
+      return evaluate
+    return compileCached
+
+  # matches - the compiled query
+  # RETURN: the function to evaluate it with
+  def wrap(self, matches):
+    if len(self._slots) == 0:
+      return matches
+    slots = self._slots
+    def evaluate(message):
+      try:
+        return matches(message)
+      finally:
+        for slot in slots:
+          slot[0] = slot[1] = None
+    return evaluate
+
+class CompiledQuery:
+  """A query compiled once for a search, maybe to be run on several
+     mailboxes (or shards of them) one after another: matches(message)
+     evaluates it on an emailextra.MessageContext. What is compiled is
+     `query' simplified (see expr_simplify), kept as `query'. If
+     `adaptive', the order of evaluation is learnt on the first messages
+     (see _Adaptive) and kept for the next ones. With a
+     valuecache.ValueCache, `cache', the values of the costly parts of
+     the query are kept there (see _Shared)."""
+
+  def __init__(self, query, adaptive=True, cache=None):
+    self.query = expr_simplify.simplify(query)
+    shared = _Shared(self.query, cache)
+    scope = _Scope(adaptive, shared, expr_plan.Estimates())
+    self.matches = shared.wrap(_compile(self.query, scope))
+    self._adaptives = scope.adaptives
+    self._cached = shared.cached > 0
+    self._cachedHeaders = shared.cachedHeaders > 0
+
+  # headersCached - if the headers of the messages are in a HeaderCache
+  #                 (see emailextra.MessageContext.headersCached)
+  # RETURN: True if the messages evaluated need a memoKey, for the
+  #         cache
+  def usesCache(self, headersCached):
+    return self._cached or (self._cachedHeaders and not headersCached)
+
+  def takeStatistics(self):
+    """What the adaptive nodes learnt since the previous call, to be
+       passed to other processes and merged (see mergeStatistics).
+       RETURNS for each node, in the order of compilation: [list of
+       evaluations, list of times true, list of seconds], with an entry
+       for each child"""
+    return [adaptive.takeStatistics() for adaptive in self._adaptives]
+
+  def describeOrder(self, statistics):
+    """The order of evaluation learnt, for the user.
+       statistics - merged statistics of this query (see takeStatistics)
+       RETURNS list of (node of `query' - ExprAnd, ExprOr, ExprForAll or
+       ExprExists, list of (child, evaluations, times true, seconds) in
+       the order learnt), for the nodes that have learnt anything"""
+    result = []
+    for (adaptive, (evaluations, trues, seconds)) in \
+        zip(self._adaptives, statistics or []):
+      if sum(evaluations) == 0:
+        continue
+      order = learnedOrder(evaluations, trues, seconds, adaptive.priors,
+                           adaptive.conjunction, adaptive.order)
+      result.append((adaptive.expr,
+                     [(adaptive.children[index], evaluations[index],
+                       trues[index], seconds[index]) for index in order]))
+    return result
+
+# RETURN: the function evaluating `expr', shared with the other
+#         occurrences of it in the query (see _Shared)
+def _compile(expr, scope):
+  return scope.shared.compile(expr, scope, lambda: expr.compile(scope))
+
+# RETURN: key of an expression named `name' with `children' (see
+#         Expr.getKey)
+def _keyOf(name, children, bound):
+  keys = [child.getKey(bound) for child in children]
+  if None in keys:
+    return None
+  return (name,) + tuple(keys)
+
+# RETURN: (list of the compiled `children' of an ExprAnd (`conjunction'
+#          True) or an ExprOr, list of the same in the order to evaluate
+#          them, the _Adaptive learning that order or None)
+def _compileChildren(expr, children, scope, conjunction):
+  shadows = scope.getShadows()
+  compiled = [_compile(child, scope) for child in children]
+  if scope.getShadows() > shadows:
+    # a quantifier in one of them rebinds a variable, which keeps the
+    # value it leaves: the children after it may depend on it
+    return (compiled, compiled, None)
+  order = expr_plan.plannedOrder(children, conjunction, scope.estimates)
+  ordered = [compiled[index] for index in order]
+  if not scope.adaptive or len(children) < 2:
+    return (compiled, ordered, None)
+  def apply(order):
+    ordered[:] = [compiled[index] for index in order]
+  adaptive = _Adaptive(expr, children,
+                       [scope.estimates.selectivity(child)
+                        for child in children],
+                       order, conjunction, apply)
+  scope.adaptives.append(adaptive)
+  return (compiled, ordered, adaptive)
+
+# RETURN: the _Adaptive learning the order of the values of a
+#         quantifier, or None
+def _adaptValues(expr, scope, shadows, conjunction, apply):
+  if not scope.adaptive or len(expr._values) < 2 or \
+     scope.getShadows() > shadows:
+    return None
+  # a value may be a list: the selectivity of the body is a guess
+  p = scope.estimates.selectivity(expr._expr)
+  adaptive = _Adaptive(expr, expr._values, [p] * len(expr._values),
+                       range(len(expr._values)), conjunction, apply)
+  scope.adaptives.append(adaptive)
+  return adaptive
+
+### class Expr
+
+# scope - _Scope
+# RETURN: function of the message, returning the value of the
+#         expression
+def _Expr_compile(self, scope):
+  raise BaseException("Abstract class")
+Expr.compile = _Expr_compile
+
+# bound - names of the variables bound inside the expression this one
+#         is a part of
+# RETURN: a key, equal for the expressions of the same structure and
+#         constants, which evaluate to the same on any message; None
+#         for those with variables bound outside (their value depends
+#         on where they are)
+def _Expr_getKey(self, bound):
+  return None
+Expr.getKey = _Expr_getKey
+
+### class ExprNull
+
+def _ExprNull_compile(self, scope):
+  raise BaseException("Evaluation error")
+ExprNull.compile = _ExprNull_compile
+
+### class ExprSubstring
+
+def _ExprSubstring_compile(self, scope):
+  if self._childSuper.__class__ is ExprCustomHeader and \
+     self._childSub.__class__ is ExprConst:
+    needle = self._childSub.getAsciiValue()
+    if needle != None:
+      name = self._childSuper._name
+      return lambda message: message.headerContains(name, needle)
+  superF = _compile(self._childSuper, scope)
+  if self._childSub.__class__ is ExprConst:
+    needle = self._childSub._value
+    return lambda message: needle in superF(message)
+  subF = _compile(self._childSub, scope)
+  return lambda message: subF(message) in superF(message)
+ExprSubstring.compile = _ExprSubstring_compile
+
+def _ExprSubstring_getKey(self, bound):
+  return _keyOf('substring', (self._childSub, self._childSuper), bound)
+ExprSubstring.getKey = _ExprSubstring_getKey
+
+### class ExprAnd
+
+def _ExprAnd_compile(self, scope):
+  (compiled, ordered, adaptive) = \
+    _compileChildren(self, self._children, scope, True)
+  if adaptive != None:
+    def evaluate(message):
+      if adaptive.sampling:
+        return adaptive.run(lambda index: compiled[index](message))
+      for child in ordered:
+        if not child(message):
+          return False
+      return True
+    return evaluate
+  children = tuple(ordered)
+  if len(children) == 2:
+    (first, second) = children
+    return lambda message: bool(first(message) and second(message))
+  def evaluate(message):
+    for child in children:
+      if not child(message):
+        return False
+    return True
+  return evaluate
+ExprAnd.compile = _ExprAnd_compile
+
+def _ExprAnd_getKey(self, bound):
+  return _keyOf('and', self._children, bound)
+ExprAnd.getKey = _ExprAnd_getKey
+
+### class ExprOr
+
+def _ExprOr_compile(self, scope):
+  (compiled, ordered, adaptive) = \
+    _compileChildren(self, self._children, scope, False)
+  if adaptive != None:
+    def evaluate(message):
+      if adaptive.sampling:
+        return adaptive.run(lambda index: compiled[index](message))
+      for child in ordered:
+        if child(message):
+          return True
+      return False
+    return evaluate
+  children = tuple(ordered)
+  if len(children) == 2:
+    (first, second) = children
+    return lambda message: bool(first(message) or second(message))
+  def evaluate(message):
+    for child in children:
+      if child(message):
+        return True
+    return False
+  return evaluate
+ExprOr.compile = _ExprOr_compile
+
+def _ExprOr_getKey(self, bound):
+  return _keyOf('or', self._children, bound)
+ExprOr.getKey = _ExprOr_getKey
+
+### class ExprForAll
+
+def _ExprForAll_compile(self, scope):
+  # the values are evaluated where the quantifier is, the expression
+  # where the variable is bound
+  shadows = scope.getShadows()
+  values = [_compile(value, scope) for value in self._values]
+  inner = scope.binding(self._varName)
+  frame = inner.frame
+  slot = inner.slot(self._varName)
+  expr = _compile(self._expr, inner)
+  ordered = list(values)
+  def apply(order):
+    ordered[:] = [values[index] for index in order]
+  adaptive = _adaptValues(self, scope, shadows, True, apply)
+  def unit(message, index):
+    frame[slot] = values[index](message)
+    return expr(message)
+  def evaluate(message):
+    if adaptive != None and adaptive.sampling:
+      return adaptive.run(lambda index: unit(message, index))
+    for value in ordered:
+      frame[slot] = value(message)
+      if not expr(message):
+        return False
+    return True
+  return evaluate
+ExprForAll.compile = _ExprForAll_compile
+
+# RETURN: key of quantifier `expr' named `name' (see Expr.getKey)
+def _quantifierKey(expr, name, bound):
+  values = _keyOf('values', expr._values, bound)
+  body = expr._expr.getKey(bound | frozenset([expr._varName]))
+  if values == None or body == None:
+    return None
+  return (name, expr._varType, expr._varName, values, body)
+
+def _ExprForAll_getKey(self, bound):
+  return _quantifierKey(self, 'forall', bound)
+ExprForAll.getKey = _ExprForAll_getKey
+
+### class ExprExists
+
+def _ExprExists_compile(self, scope):
+  shadows = scope.getShadows()
+  values = tuple([(_compile(value, scope), value.isTypeList())
+                  for value in self._values])
+  inner = scope.binding(self._varName)
+  frame = inner.frame
+  slot = inner.slot(self._varName)
+  expr = _compile(self._expr, inner)
+  order = range(len(values))
+  def apply(newOrder):
+    order[:] = newOrder
+  adaptive = _adaptValues(self, scope, shadows, False, apply)
+  def unit(groups, message, index):
+    for v in groups[index]:
+      frame[slot] = v
+      if expr(message):
+        return True
+    return False
+  def evaluate(message):
+    # all the values first, as Expr.evaluate does
+    groups = []
+    for (value, isList) in values:
+      if isList:
+        groups.append(value(message))
+      else:
+        groups.append((value(message),))
+    if adaptive != None and adaptive.sampling:
+      return adaptive.run(lambda index: unit(groups, message, index))
+    for index in order:
+      for v in groups[index]:
+        frame[slot] = v
+        if expr(message):
+          return True
+    return False
+  return evaluate
+ExprExists.compile = _ExprExists_compile
+
+def _ExprExists_getKey(self, bound):
+  return _quantifierKey(self, 'exists', bound)
+ExprExists.getKey = _ExprExists_getKey
+
+### class ExprConst
+
+def _ExprConst_compile(self, scope):
+  value = self._value
+  return lambda message: value
+ExprConst.compile = _ExprConst_compile
+
+def _ExprConst_getKey(self, bound):
+  # 'a' and u'a', or 1 and True, are equal, but may not evaluate alike
+  return ('const', self._etype, type(self._value), self._value)
+ExprConst.getKey = _ExprConst_getKey
+
+### class ExprVar
+
+def _ExprVar_compile(self, scope):
+  if not scope.isBound(self._id):
+    raise BaseException("Variable not bound by any quantifier: "+self._id)
+  frame = scope.frame
+  slot = scope.slot(self._id)
+  return lambda message: frame[slot]
+ExprVar.compile = _ExprVar_compile
+
+def _ExprVar_getKey(self, bound):
+  if self._id in bound:
+    return ('var', self._id)
+  return None
+ExprVar.getKey = _ExprVar_getKey
+
+### class ExprCustomHeader
+
+def _ExprCustomHeader_compile(self, scope):
+  name = self._name
+  return lambda message: message.headerToUnicode(name)
+ExprCustomHeader.compile = _ExprCustomHeader_compile
+
+def _ExprCustomHeader_getKey(self, bound):
+  return ('header', self._name)
+ExprCustomHeader.getKey = _ExprCustomHeader_getKey
+
+### class ExprAllAttachments
+
+def _ExprAllAttachments_compile(self, scope):
+  def evaluate(message):
+    message = message.getMessage()
+    if message.is_multipart():
+      return [part for part in message.get_payload()
+              if not part.get_content_type().startswith('text/')]
+    return []
+  return evaluate
+ExprAllAttachments.compile = _ExprAllAttachments_compile
+
+def _ExprAllAttachments_getKey(self, bound):
+  return ('attachments',)
+ExprAllAttachments.getKey = _ExprAllAttachments_getKey
+
+### class ExprAttSize
+
+def _ExprAttSize_compile(self, scope):
+  child = _compile(self._child, scope)
+  payloadSize = mimestream.payloadSize
+  def evaluate(message):
+    att = child(message)
+    if att.is_multipart():
+      return 0
+    # for a large message, the payload may be known by its size only
+    return payloadSize(att)
+  return evaluate
+ExprAttSize.compile = _ExprAttSize_compile
+
+def _ExprAttSize_getKey(self, bound):
+  return _keyOf('attsize', (self._child,), bound)
+ExprAttSize.getKey = _ExprAttSize_getKey
+
+### class ExprGt
+
+def _ExprGt_compile(self, scope):
+  left = _compile(self._left, scope)
+  if self._right.__class__ is ExprConst:
+    right = self._right._value
+    return lambda message: left(message) > right
+  rightF = _compile(self._right, scope)
+  return lambda message: left(message) > rightF(message)
+ExprGt.compile = _ExprGt_compile
+
+def _ExprGt_getKey(self, bound):
+  return _keyOf('gt', (self._left, self._right), bound)
+ExprGt.getKey = _ExprGt_getKey
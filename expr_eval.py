@@ -23,6 +23,15 @@ import re
 
 from expr import *
 import emailextra
+import mimestream
+
+class MsgNeeds:
+  """Which parts of a message a query looks at. The values are
+     ordered: each one includes everything the lower ones need."""
+  Nothing      = 0
+  Headers      = 1
+  Structure    = 2  # MIME parts and their headers
+  Full         = 3  # also the payloads
 
 ### class Expr
 
@@ -30,13 +39,18 @@ def _Expr_isComplete(self):
   raise BaseException("Abstract class")
 Expr.isComplete = _Expr_isComplete
 
-# message - the email message to match
+# message - the email message to match (emailextra.MessageContext)
 # tenv - type environment (var name -> ET)
 # venv - value environment (var name -> value)
 def _Expr_evaluate(self, message, tenv, venv):
   raise BaseException("Abstract class")
 Expr.evaluate = _Expr_evaluate
 
+# RETURN: MsgNeeds
+def _Expr_getNeeds(self):
+  raise BaseException("Abstract class")
+Expr.getNeeds = _Expr_getNeeds
+
 ### class ExprNull
 
 def _ExprNull_isComplete(self):
@@ -47,6 +61,10 @@ def _ExprNull_evaluate(self, message, tenv, venv):
   raise BaseException("Evaluation error")
 ExprNull.evaluate = _ExprNull_evaluate
 
+def _ExprNull_getNeeds(self):
+  return MsgNeeds.Nothing
+ExprNull.getNeeds = _ExprNull_getNeeds
+
 ### class ExprSubstring
 
 def _ExprSubstring_isComplete(self):
@@ -54,11 +72,22 @@ def _ExprSubstring_isComplete(self):
 ExprSubstring.isComplete = _ExprSubstring_isComplete
 
 def _ExprSubstring_evaluate(self, message, tenv, venv):
+  # a constant ASCII string in a header: may be checked on the raw
+  # header value, skipping the decoding (see MessageContext)
+  if self._childSuper.__class__ is ExprCustomHeader and \
+     self._childSub.__class__ is ExprConst:
+    needle = self._childSub.getAsciiValue()
+    if needle != None:
+      return message.headerContains(self._childSuper._name, needle)
   valueSub = self._childSub.evaluate(message, tenv, venv)
   valueSuper = self._childSuper.evaluate(message, tenv, venv)
   return valueSub in valueSuper
 ExprSubstring.evaluate = _ExprSubstring_evaluate
 
+def _ExprSubstring_getNeeds(self):
+  return max(self._childSub.getNeeds(), self._childSuper.getNeeds())
+ExprSubstring.getNeeds = _ExprSubstring_getNeeds
+
 ### class And 
 
 def _ExprAnd_isComplete(self):
@@ -75,6 +104,13 @@ def _ExprAnd_evaluate(self, message, tenv, venv):
   return True
 ExprAnd.evaluate = _ExprAnd_evaluate
 
+def _ExprAnd_getNeeds(self):
+  needs = MsgNeeds.Nothing
+  for child in self._children:
+    needs = max(needs, child.getNeeds())
+  return needs
+ExprAnd.getNeeds = _ExprAnd_getNeeds
+
 ### class Or
 
 def _ExprOr_isComplete(self):
@@ -91,6 +127,13 @@ def _ExprOr_evaluate(self, message, tenv, venv):
   return False
 ExprOr.evaluate = _ExprOr_evaluate
 
+def _ExprOr_getNeeds(self):
+  needs = MsgNeeds.Nothing
+  for child in self._children:
+    needs = max(needs, child.getNeeds())
+  return needs
+ExprOr.getNeeds = _ExprOr_getNeeds
+
 ### class ExprForAll
 
 def _ExprForAll_isComplete(self):
@@ -109,6 +152,13 @@ def _ExprForAll_evaluate(self, message, tenv, venv):
   return True
 ExprForAll.evaluate = _ExprForAll_evaluate
 
+def _ExprForAll_getNeeds(self):
+  needs = self._expr.getNeeds()
+  for value in self._values:
+    needs = max(needs, value.getNeeds())
+  return needs
+ExprForAll.getNeeds = _ExprForAll_getNeeds
+
 ### class ExprExists
 
 def _ExprExists_isComplete(self):
@@ -137,6 +187,13 @@ def _ExprExists_evaluate(self, message, tenv, venv):
   return False
 ExprExists.evaluate = _ExprExists_evaluate
 
+def _ExprExists_getNeeds(self):
+  needs = self._expr.getNeeds()
+  for value in self._values:
+    needs = max(needs, value.getNeeds())
+  return needs
+ExprExists.getNeeds = _ExprExists_getNeeds
+
 ### class ExprConst
 
 def _ExprConst_isComplete(self):
@@ -147,6 +204,22 @@ def _ExprConst_evaluate(self, message, tenv, venv):
   return self._value
 ExprConst.evaluate = _ExprConst_evaluate
 
+# RETURN: the value as an ASCII str, None if it is not an ASCII string
+def _ExprConst_getAsciiValue(self):
+  # remembered together with the value it was computed for, since
+  # the value may be modified by the user
+  if getattr(self, '_asciiOf', None) is not self._value:
+    self._asciiValue = None
+    if isinstance(self._value, basestring):
+      self._asciiValue = emailextra.asciiOrNone(self._value)
+    self._asciiOf = self._value
+  return self._asciiValue
+ExprConst.getAsciiValue = _ExprConst_getAsciiValue
+
+def _ExprConst_getNeeds(self):
+  return MsgNeeds.Nothing
+ExprConst.getNeeds = _ExprConst_getNeeds
+
 ### class ExprVar
 
 def _ExprVar_isComplete(self):
@@ -157,6 +230,10 @@ def _ExprVar_evaluate(self, message, tenv, venv):
   return venv[self._id]
 ExprVar.evaluate = _ExprVar_evaluate
 
+def _ExprVar_getNeeds(self):
+  return MsgNeeds.Nothing
+ExprVar.getNeeds = _ExprVar_getNeeds
+
 ### class ExprCustomHeader
 
 def _ExprCustomHeader_isComplete(self):
@@ -164,9 +241,13 @@ def _ExprCustomHeader_isComplete(self):
 ExprCustomHeader.isComplete = _ExprCustomHeader_isComplete
 
 def _ExprCustomHeader_evaluate(self, message, tenv, venv):
-  return emailextra.headerToUnicode(message, self._name)
+  return message.headerToUnicode(self._name)
 ExprCustomHeader.evaluate = _ExprCustomHeader_evaluate
 
+def _ExprCustomHeader_getNeeds(self):
+  return MsgNeeds.Headers
+ExprCustomHeader.getNeeds = _ExprCustomHeader_getNeeds
+
 ### class ExprAllAttachments
 
 def _ExprAllAttachments_isComplete(self):
@@ -174,6 +255,7 @@ def _ExprAllAttachments_isComplete(self):
 ExprAllAttachments.isComplete = _ExprAllAttachments_isComplete
 
 def _ExprAllAttachments_evaluate(self, message, tenv, venv):
+  message = message.getMessage()
   if message.is_multipart():
     ret = []
     for part in message.get_payload():
@@ -184,6 +266,10 @@ def _ExprAllAttachments_evaluate(self, message, tenv, venv):
     return []
 ExprAllAttachments.evaluate = _ExprAllAttachments_evaluate
 
+def _ExprAllAttachments_getNeeds(self):
+  return MsgNeeds.Structure
+ExprAllAttachments.getNeeds = _ExprAllAttachments_getNeeds
+
 ### class ExprAttSize
 
 def _ExprAttSize_isComplete(self):
@@ -195,9 +281,14 @@ def _ExprAttSize_evaluate(self, message, tenv, venv):
   if att.is_multipart():
     return 0
   else:
-    return len(att.get_payload(decode=False))
+    # for a large message, the payload may be known by its size only
+    return mimestream.payloadSize(att)
 ExprAttSize.evaluate = _ExprAttSize_evaluate
 
+def _ExprAttSize_getNeeds(self):
+  return max(MsgNeeds.Full, self._child.getNeeds())
+ExprAttSize.getNeeds = _ExprAttSize_getNeeds
+
 ### class ExprGt
 
 def _ExprGt_isComplete(self):
@@ -209,3 +300,7 @@ def _ExprGt_evaluate(self, message, tenv, venv):
   r = self._right.evaluate(message, tenv, venv)
   return l > r
 ExprGt.evaluate = _ExprGt_evaluate
+
+def _ExprGt_getNeeds(self):
+  return max(self._left.getNeeds(), self._right.getNeeds())
+ExprGt.getNeeds = _ExprGt_getNeeds
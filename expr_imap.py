@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Translation of queries into IMAP SEARCH criteria, so that the server
+# can leave out the messages that cannot match (see imapmbox).
+#
+# The criteria of an expression are implied by it: every message for
+# which the expression is true satisfies them, but not the other way
+# round (IMAP matches substrings case-insensitively, in any occurrence
+# of a header, LARGER compares the size of the whole message, ...). So
+# the server finds candidates, and the query is still evaluated on
+# them. None stands for no criteria at all: any message may match.
+#
+# HEADER criteria are only used with servers known to match the decoded
+# header values: one that looks for the needle in the raw header would
+# not find 'Re port' in '=?utf-8?q?Re_port?=', and the message would be
+# lost. LARGER is safe with any server.
+
+import emailextra
+from expr import *
+
+# RETURN: `text' as an IMAP quoted string, None if it cannot be one
+def imapQuote(text):
+  text = emailextra.asciiOrNone(text)
+  if text == None or '\r' in text or '\n' in text or '\0' in text:
+    return None
+  return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+# RETURN: the criteria all of which are to be met, as one search key
+def _imapAll(criteria):
+  if len(criteria) == 1:
+    return criteria[0]
+  return '(' + ' '.join(criteria) + ')'
+
+# RETURN: the criteria one of which is to be met, as one search key
+def _imapAny(criteria):
+  result = criteria[-1]
+  for key in reversed(criteria[:-1]):
+    result = 'OR ' + key + ' ' + result
+  return result
+
+# RETURN: the expression a variable stands for in `env', or `expr'
+def _resolve(expr, env):
+  if expr.__class__ is ExprVar and expr._id in env:
+    return env[expr._id]
+  return expr
+
+### class Expr
+
+# env     - var name -> the expression the variable stands for (for
+#           quantifiers over single values, see ExprForAll)
+# headers - whether HEADER criteria may be used (see
+#           imapmbox.ImapMailbox.searchesHeaders)
+# RETURN: IMAP search key implied by the expression, or None
+def _Expr_getImapSearch(self, env, headers):
+  return None
+Expr.getImapSearch = _Expr_getImapSearch
+
+### class ExprSubstring
+
+def _ExprSubstring_getImapSearch(self, env, headers):
+  if not headers:
+    return None
+  sub = _resolve(self._childSub, env)
+  sup = _resolve(self._childSuper, env)
+  if sub.__class__ is not ExprConst or \
+     sup.__class__ is not ExprCustomHeader:
+    return None
+  # '' is in every value, also of a header that is not there
+  if sub.getAsciiValue() in (None, ''):
+    return None
+  name = imapQuote(sup._name)
+  needle = imapQuote(sub.getAsciiValue())
+  if name == None or needle == None:
+    return None
+  return 'HEADER ' + name + ' ' + needle
+ExprSubstring.getImapSearch = _ExprSubstring_getImapSearch
+
+### class And
+
+def _ExprAnd_getImapSearch(self, env, headers):
+  criteria = []
+  for child in self._children:
+    key = child.getImapSearch(env, headers)
+    if key != None:
+      criteria.append(key)
+  if len(criteria) == 0:
+    return None
+  return _imapAll(criteria)
+ExprAnd.getImapSearch = _ExprAnd_getImapSearch
+
+### class Or
+
+def _ExprOr_getImapSearch(self, env, headers):
+  criteria = []
+  for child in self._children:
+    key = child.getImapSearch(env, headers)
+    if key == None:
+      return None
+    criteria.append(key)
+  if len(criteria) == 0:
+    return None
+  return _imapAny(criteria)
+ExprOr.getImapSearch = _ExprOr_getImapSearch
+
+### class ExprForAll
+
+# RETURN: list of the criteria of `expr' with `varName' standing for each
+#         of `values' in turn, None if a value is a list (it may be empty)
+def _quantifiedCriteria(expr, varName, values, env, headers):
+  criteria = []
+  for value in values:
+    value = _resolve(value, env)
+    if value.isTypeList():
+      return None
+    env1 = dict(env)
+    env1[varName] = value
+    criteria.append(expr.getImapSearch(env1, headers))
+  return criteria
+
+def _ExprForAll_getImapSearch(self, env, headers):
+  criteria = _quantifiedCriteria(self._expr, self._varName, self._values, env,
+                                 headers)
+  if criteria == None:
+    # true if the list is empty
+    return None
+  criteria = [key for key in criteria if key != None]
+  if len(criteria) == 0:
+    return None
+  return _imapAll(criteria)
+ExprForAll.getImapSearch = _ExprForAll_getImapSearch
+
+### class ExprExists
+
+def _ExprExists_getImapSearch(self, env, headers):
+  criteria = _quantifiedCriteria(self._expr, self._varName, self._values, env,
+                                 headers)
+  if criteria == None:
+    # some element makes the expression true: what does not depend on
+    # the element holds
+    env1 = dict(env)
+    if self._varName in env1:
+      del env1[self._varName]
+    return self._expr.getImapSearch(env1, headers)
+  if len(criteria) == 0 or None in criteria:
+    return None
+  return _imapAny(criteria)
+ExprExists.getImapSearch = _ExprExists_getImapSearch
+
+### class ExprGt
+
+def _ExprGt_getImapSearch(self, env, headers):
+  # an attachment is a part of the message, so the message is larger
+  if _resolve(self._left, env).__class__ is not ExprAttSize or \
+     _resolve(self._right, env).__class__ is not ExprConst:
+    return None
+  limit = _resolve(self._right, env)._value
+  if not isinstance(limit, (int, long)) or limit < 0:
+    return None
+  return 'LARGER ' + str(limit)
+ExprGt.getImapSearch = _ExprGt_getImapSearch
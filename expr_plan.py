@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Static estimates of what evaluating a query costs, used to evaluate
+# the children of ExprAnd and ExprOr in the best order (see
+# expr_compile): an ExprAnd stops at the first child that is false, an
+# ExprOr at the first one that is true, so a cheap child that decides
+# for most messages should come first; one that needs the MIME structure
+# or the payloads of the message (which, with the header cache, means
+# reading the message at all) should come last.
+#
+# The user's tree is not changed: only the order of evaluation is.
+
+from expr import *
+from expr_eval import *
+
+# Cost of what a message needs to have been read, in the time it takes
+# to look up one header
+_needsCost = {
+  MsgNeeds.Nothing: 0.0,
+  MsgNeeds.Headers: 1.0,
+  MsgNeeds.Structure: 20.0,
+  MsgNeeds.Full: 50.0,
+}
+
+# How many values a list-valued expression (ExprAllAttachments) is
+# assumed to have
+_listLength = 2
+
+# Fraction of the messages a substring is assumed to be found in
+_substringSelectivity = 0.1
+
+_comparisonSelectivity = 0.5
+
+class Estimates:
+  """The cost and selectivity of the expressions of a query, each worked
+     out once, from those of its children: asking every node for them
+     again would take time exponential in the depth of nested ExprAnd
+     and ExprOr. The expressions must not change while it is in use."""
+
+  def __init__(self):
+    # id of an expression -> (the expression, its cost); the expression
+    # is kept so that its id is not given to another one
+    self._costs = dict()
+    # id of an expression -> (the expression, its selectivity)
+    self._selectivities = dict()
+
+  def cost(self, expr):
+    entry = self._costs.get(id(expr))
+    if entry == None:
+      entry = (expr, expr.getCost(self))
+      self._costs[id(expr)] = entry
+    return entry[1]
+
+  def selectivity(self, expr):
+    entry = self._selectivities.get(id(expr))
+    if entry == None:
+      entry = (expr, expr.getSelectivity(self))
+      self._selectivities[id(expr)] = entry
+    return entry[1]
+
+# RETURN: the order to evaluate `children' of an ExprAnd (`conjunction'
+#         True) or an ExprOr in, as a list of their indices
+def plannedOrder(children, conjunction, estimates):
+  def rank(index):
+    child = children[index]
+    p = estimates.selectivity(child)
+    if conjunction:
+      # the chance to stop here is that of being false
+      p = 1.0 - p
+    # the children deciding nothing go last; the user's order is kept
+    # between equals
+    return (estimates.cost(child) / max(p, 1e-6), index)
+  return sorted(range(len(children)), key=rank)
+
+# RETURN: the expected cost of evaluating `children' in the order given
+#         (as plannedOrder returns it), and the selectivity of the
+#         whole
+def _sequenceCost(children, order, conjunction, estimates):
+  cost = 0.0
+  # the chance of getting to the next child
+  reach = 1.0
+  for index in order:
+    child = children[index]
+    cost += reach * estimates.cost(child)
+    if conjunction:
+      reach *= estimates.selectivity(child)
+    else:
+      reach *= 1.0 - estimates.selectivity(child)
+  if conjunction:
+    return (cost, reach)
+  return (cost, 1.0 - reach)
+
+# RETURN: number of values the quantifier goes through, as assumed
+def _valueCount(values):
+  count = 0
+  for value in values:
+    if value.isTypeList():
+      count += _listLength
+    else:
+      count += 1
+  return count
+
+### class Expr
+
+# estimates - Estimates, giving those of the children
+# RETURN: estimated cost of evaluating the expression on a message
+def _Expr_getCost(self, estimates):
+  raise BaseException("Abstract class")
+Expr.getCost = _Expr_getCost
+
+# RETURN: estimated fraction of the messages for which the expression
+#         (of type ET.Bool) is true
+def _Expr_getSelectivity(self, estimates):
+  return 0.5
+Expr.getSelectivity = _Expr_getSelectivity
+
+### class ExprNull
+
+def _ExprNull_getCost(self, estimates):
+  return 0.0
+ExprNull.getCost = _ExprNull_getCost
+
+### class ExprSubstring
+
+def _ExprSubstring_getCost(self, estimates):
+  return estimates.cost(self._childSub) + estimates.cost(self._childSuper)
+ExprSubstring.getCost = _ExprSubstring_getCost
+
+def _ExprSubstring_getSelectivity(self, estimates):
+  return _substringSelectivity
+ExprSubstring.getSelectivity = _ExprSubstring_getSelectivity
+
+### class ExprAnd
+
+def _ExprAnd_getCost(self, estimates):
+  order = plannedOrder(self._children, True, estimates)
+  return _sequenceCost(self._children, order, True, estimates)[0]
+ExprAnd.getCost = _ExprAnd_getCost
+
+def _ExprAnd_getSelectivity(self, estimates):
+  p = 1.0
+  for child in self._children:
+    p *= estimates.selectivity(child)
+  return p
+ExprAnd.getSelectivity = _ExprAnd_getSelectivity
+
+### class ExprOr
+
+def _ExprOr_getCost(self, estimates):
+  order = plannedOrder(self._children, False, estimates)
+  return _sequenceCost(self._children, order, False, estimates)[0]
+ExprOr.getCost = _ExprOr_getCost
+
+def _ExprOr_getSelectivity(self, estimates):
+  q = 1.0
+  for child in self._children:
+    q *= 1.0 - estimates.selectivity(child)
+  return 1.0 - q
+ExprOr.getSelectivity = _ExprOr_getSelectivity
+
+### class ExprForAll
+
+def _ExprForAll_getCost(self, estimates):
+  cost = sum([estimates.cost(value) for value in self._values])
+  return cost + _valueCount(self._values) * estimates.cost(self._expr)
+ExprForAll.getCost = _ExprForAll_getCost
+
+def _ExprForAll_getSelectivity(self, estimates):
+  return estimates.selectivity(self._expr) ** _valueCount(self._values)
+ExprForAll.getSelectivity = _ExprForAll_getSelectivity
+
+### class ExprExists
+
+def _ExprExists_getCost(self, estimates):
+  cost = sum([estimates.cost(value) for value in self._values])
+  return cost + _valueCount(self._values) * estimates.cost(self._expr)
+ExprExists.getCost = _ExprExists_getCost
+
+def _ExprExists_getSelectivity(self, estimates):
+  q = 1.0 - estimates.selectivity(self._expr)
+  return 1.0 - q ** _valueCount(self._values)
+ExprExists.getSelectivity = _ExprExists_getSelectivity
+
+### class ExprConst
+
+def _ExprConst_getCost(self, estimates):
+  return 0.0
+ExprConst.getCost = _ExprConst_getCost
+
+def _ExprConst_getSelectivity(self, estimates):
+  if self._value is True:
+    return 1.0
+  if self._value is False:
+    return 0.0
+  return 0.5
+ExprConst.getSelectivity = _ExprConst_getSelectivity
+
+### class ExprVar
+
+def _ExprVar_getCost(self, estimates):
+  return 0.0
+ExprVar.getCost = _ExprVar_getCost
+
+### class ExprCustomHeader
+
+def _ExprCustomHeader_getCost(self, estimates):
+  return _needsCost[MsgNeeds.Headers]
+ExprCustomHeader.getCost = _ExprCustomHeader_getCost
+
+### class ExprAllAttachments
+
+def _ExprAllAttachments_getCost(self, estimates):
+  return _needsCost[MsgNeeds.Structure]
+ExprAllAttachments.getCost = _ExprAllAttachments_getCost
+
+### class ExprAttSize
+
+def _ExprAttSize_getCost(self, estimates):
+  return _needsCost[MsgNeeds.Full] + estimates.cost(self._child)
+ExprAttSize.getCost = _ExprAttSize_getCost
+
+### class ExprGt
+
+def _ExprGt_getCost(self, estimates):
+  return estimates.cost(self._left) + estimates.cost(self._right)
+ExprGt.getCost = _ExprGt_getCost
+
+def _ExprGt_getSelectivity(self, estimates):
+  return _comparisonSelectivity
+ExprGt.getSelectivity = _ExprGt_getSelectivity
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Simplification of queries before they are compiled (see expr_compile),
+# on a copy: the user's tree is not changed.
+#
+# - constants are folded: a substring of a constant in a constant, a
+#   comparison of constants, and the ExprAnd, ExprOr and quantifiers
+#   that these decide, become an ExprConst of type ET.Bool (which the
+#   user cannot enter, but which evaluates as any constant);
+# - an ExprAnd in an ExprAnd (an ExprOr in an ExprOr) is merged into
+#   it, and one left with a single child is replaced by the child;
+# - a quantifier over single values (not lists) may be expanded into an
+#   ExprAnd (ExprForAll) or an ExprOr (ExprExists) of copies of its
+#   expression, one for each value, as the 'expand' command does: the
+#   copies may then be folded, or take the fast paths of expr_compile
+#   (a substring of a constant in a header), but a value used several
+#   times in the expression is then evaluated several times. The
+#   quantifier is expanded if that is not more costly, as estimated by
+#   expr_plan, and does not make the query too large.
+#
+# As in Expr.evaluate, a variable keeps the value its quantifier leaves
+# in it, which a variable of the same name may see later, if another
+# quantifier binding that name is around both. The quantifiers whose
+# values could be seen that way are never removed.
+
+import expr_plan
+from expr import *
+from expr_eval import *
+from expr_special import *
+
+# Quantifiers are not expanded into more than so many nodes
+maxExpandedSize = 200
+
+class _Context:
+  """Where an expression being simplified is: `bound', the variable
+     names bound by the quantifiers around it, and `env', variable name
+     -> (expression, _Context) the variable is to be replaced with, for
+     the quantifiers being expanded."""
+
+  def __init__(self, bound, env):
+    self.bound = bound
+    self.env = env
+
+  def binding(self, name):
+    env = dict(self.env)
+    if name in env:
+      del env[name]
+    return _Context(self.bound | set([name]), env)
+
+  def substituting(self, name, expr, context):
+    env = dict(self.env)
+    env[name] = (expr, context)
+    return _Context(self.bound, env)
+
+def simplify(query):
+  """RETURNS a simplified copy of `query' (see above), evaluating as it
+     does"""
+  result = query.simplify(_Context(set(), dict()))
+  result.setParent(None)
+  return result
+
+def _const(value):
+  return ExprConst(ET.Bool, dict(), {'value': bool(value)})
+
+def _isConst(expr):
+  return expr.__class__ is ExprConst and expr.getType() == ET.Bool
+
+# RETURN: True if a quantifier in `expr' binds one of `names'
+def _rebinds(expr, names):
+  for sub in expr.getFlatTree():
+    if isinstance(sub, (ExprForAll, ExprExists)) and sub._varName in names:
+      return True
+  return False
+
+# children - simplified children of an ExprAnd (`cls') or an ExprOr
+# RETURN: the simplified ExprAnd or ExprOr of them
+def _combine(cls, children, context):
+  conjunction = cls is ExprAnd
+  flat = []
+  for child in children:
+    if child.__class__ is cls:
+      flat.extend(child._children)
+    elif _isConst(child) and child._value == conjunction:
+      continue
+    else:
+      flat.append(child)
+  decided = [child for child in flat if _isConst(child)]
+  if len(decided) > 0:
+    # the others go, unless they leave a value in a variable that may
+    # be seen after them
+    if len([child for child in flat
+            if _rebinds(child, context.bound)]) == 0:
+      return _const(not conjunction)
+  if len(flat) == 0:
+    return _const(conjunction)
+  if len(flat) == 1:
+    return flat[0]
+  expr = cls(ET.Bool, dict(), dict())
+  expr.replaceChildren(flat)
+  return expr
+
+# RETURN: True if the variable of `quantifier' can be replaced with its
+#         values in its expression
+def _canExpand(quantifier, context):
+  # the value left in the variable would be seen
+  if quantifier._varName in context.bound:
+    return False
+  names = set([quantifier._varName])
+  for value in quantifier._values:
+    if value.isTypeList():
+      return False
+    for sub in value.getFlatTree():
+      if sub.__class__ is ExprVar:
+        names.add(sub._id)
+  # the variable, or one a value depends on, would be bound again
+  # between the value and where it is used
+  return not _rebinds(quantifier._expr, names)
+
+def _simplifyQuantifier(self, context, conjunction):
+  values = [value.simplify(context) for value in self._values]
+  expr = self._expr.simplify(context.binding(self._varName))
+  if _isConst(expr) and not self._varName in context.bound:
+    # for all values, as for some of them; except that a list may be
+    # empty
+    if conjunction or expr._value == False:
+      return expr
+    if len([value for value in values if not value.isTypeList()]) > 0:
+      return expr
+  kept = self.__class__(ET.Bool, self._constParams,
+                        {'variable name': self._varName})
+  kept.replaceValues(values)
+  kept.replaceExpr(expr)
+  if not _canExpand(self, context) or \
+     len(self._values) * len(self._expr.getFlatTree()) > maxExpandedSize:
+    return kept
+  copies = [self._expr.simplify(context.substituting(self._varName, value,
+                                                     context))
+            for value in self._values]
+  cls = ExprOr
+  if conjunction:
+    cls = ExprAnd
+  expanded = _combine(cls, copies, context)
+  if len(expanded.getFlatTree()) > maxExpandedSize:
+    return kept
+  estimates = expr_plan.Estimates()
+  if estimates.cost(expanded) > estimates.cost(kept):
+    return kept
+  return expanded
+
+### class Expr
+
+# context - _Context
+# RETURN: a simplified copy of the expression
+def _Expr_simplify(self, context):
+  raise BaseException("Abstract class")
+Expr.simplify = _Expr_simplify
+
+### class ExprNull
+
+def _ExprNull_simplify(self, context):
+  # an incomplete query is not searched; left to fail as it is
+  return ExprNull(self._etype, self._constParams, dict())
+ExprNull.simplify = _ExprNull_simplify
+
+### class ExprSubstring
+
+def _ExprSubstring_simplify(self, context):
+  sub = self._childSub.simplify(context)
+  sup = self._childSuper.simplify(context)
+  if sub.__class__ is ExprConst:
+    if sup.__class__ is ExprConst:
+      try:
+        return _const(sub._value in sup._value)
+      except UnicodeError:
+        # a non-ASCII str in unicode: fails at evaluation, as it should
+        pass
+    elif sub._value == '':
+      return _const(True)
+  expr = ExprSubstring(self._etype, self._constParams, dict())
+  expr.replaceChild(expr._childSub, sub)
+  expr.replaceChild(expr._childSuper, sup)
+  return expr
+ExprSubstring.simplify = _ExprSubstring_simplify
+
+### class ExprAnd
+
+def _ExprAnd_simplify(self, context):
+  return _combine(ExprAnd, [child.simplify(context)
+                            for child in self._children], context)
+ExprAnd.simplify = _ExprAnd_simplify
+
+### class ExprOr
+
+def _ExprOr_simplify(self, context):
+  return _combine(ExprOr, [child.simplify(context)
+                           for child in self._children], context)
+ExprOr.simplify = _ExprOr_simplify
+
+### class ExprForAll
+
+def _ExprForAll_simplify(self, context):
+  return _simplifyQuantifier(self, context, True)
+ExprForAll.simplify = _ExprForAll_simplify
+
+### class ExprExists
+
+def _ExprExists_simplify(self, context):
+  return _simplifyQuantifier(self, context, False)
+ExprExists.simplify = _ExprExists_simplify
+
+### class ExprConst
+
+def _ExprConst_simplify(self, context):
+  return ExprConst(self._etype, self._constParams, {'value': self._value})
+ExprConst.simplify = _ExprConst_simplify
+
+### class ExprVar
+
+def _ExprVar_simplify(self, context):
+  if self._id in context.env:
+    (value, valueContext) = context.env[self._id]
+    return value.simplify(valueContext)
+  return ExprVar(self._etype, self._constParams, {'id': self._id})
+ExprVar.simplify = _ExprVar_simplify
+
+### class ExprCustomHeader
+
+def _ExprCustomHeader_simplify(self, context):
+  return ExprCustomHeader(self._etype, self._constParams,
+                          {'name': self._name})
+ExprCustomHeader.simplify = _ExprCustomHeader_simplify
+
+### class ExprAllAttachments
+
+def _ExprAllAttachments_simplify(self, context):
+  return ExprAllAttachments(self._etype, self._constParams, dict())
+ExprAllAttachments.simplify = _ExprAllAttachments_simplify
+
+### class ExprAttSize
+
+def _ExprAttSize_simplify(self, context):
+  expr = ExprAttSize(self._etype, self._constParams, dict())
+  expr.replaceChild(expr._child, self._child.simplify(context))
+  return expr
+ExprAttSize.simplify = _ExprAttSize_simplify
+
+### class ExprGt
+
+def _ExprGt_simplify(self, context):
+  left = self._left.simplify(context)
+  right = self._right.simplify(context)
+  if left.__class__ is ExprConst and right.__class__ is ExprConst:
+    return _const(left._value > right._value)
+  expr = ExprGt(self._etype, self._constParams, dict())
+  expr.replaceChild(expr._left, left)
+  expr.replaceChild(expr._right, right)
+  return expr
+ExprGt.simplify = _ExprGt_simplify
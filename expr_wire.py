@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Queries as plain data (dicts, lists, strings and numbers), to be sent
+# to another host as JSON (see remote).
+#
+# Unlike pickle, which the worker processes of one host use (see
+# parallel), this can be read from an untrusted peer: only the classes
+# and fields listed below are ever built.
+
+from expr import *
+
+# Kinds of fields
+_Expr = 0      # an expression
+_ExprList = 1  # a list of expressions
+_String = 2
+_Int = 3
+_Value = 4     # a string or an int (ExprConst)
+
+# class name -> (class, field name -> kind)
+_classes = dict()
+
+def _register(cls, fields):
+  _classes[cls.__name__] = (cls, fields)
+
+_register(ExprNull, {})
+_register(ExprSubstring, {'_childSub': _Expr, '_childSuper': _Expr})
+_register(ExprAnd, {'_children': _ExprList})
+_register(ExprOr, {'_children': _ExprList})
+_register(ExprForAll, {'_varType': _Int, '_varName': _String,
+                       '_values': _ExprList, '_expr': _Expr})
+_register(ExprExists, {'_varType': _Int, '_varName': _String,
+                       '_values': _ExprList, '_expr': _Expr})
+_register(ExprConst, {'_value': _Value})
+_register(ExprVar, {'_id': _String})
+_register(ExprCustomHeader, {'_name': _String})
+_register(ExprAllAttachments, {})
+_register(ExprAttSize, {'_child': _Expr})
+_register(ExprGt, {'_left': _Expr, '_right': _Expr})
+
+# The strings of a query are byte strings, as typed in; JSON only has
+# unicode ones, so each byte is sent as the character of the same code
+# (any bytes survive, whatever their encoding).
+
+def _stringToData(value):
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  return value.decode('latin-1')
+
+def _stringFromData(data):
+  if not isinstance(data, basestring):
+    raise BaseException("Invalid query: string expected")
+  return data.encode('latin-1')
+
+def _intFromData(data):
+  if not isinstance(data, (int, long)) or isinstance(data, bool):
+    raise BaseException("Invalid query: integer expected")
+  return data
+
+### class Expr
+
+# RETURN: the expression as data, to be read by exprFromData
+def _Expr_toData(self):
+  (cls, fields) = _classes[self.__class__.__name__]
+  data = dict()
+  for (field, kind) in fields.items():
+    value = getattr(self, field)
+    if value == None:
+      data[field] = None
+    elif kind == _Expr:
+      data[field] = value.toData()
+    elif kind == _ExprList:
+      data[field] = [expr.toData() for expr in value]
+    elif kind == _String or (kind == _Value and isinstance(value, basestring)):
+      data[field] = _stringToData(value)
+    else:
+      data[field] = value
+  constParams = dict()
+  for (name, value) in self._constParams.items():
+    constParams[name] = value
+  return {'class': self.__class__.__name__, 'type': self._etype,
+          'const': constParams, 'fields': data}
+Expr.toData = _Expr_toData
+
+# RETURN: Expr built from the result of Expr.toData;
+#         raises BaseException if `data' is not such a result
+def exprFromData(data, parent=None):
+  try:
+    (cls, fields) = _classes[data['class']]
+    etype = _intFromData(data['type'])
+    constParams = dict()
+    for (name, value) in data['const'].items():
+      constParams[_stringFromData(name)] = _intFromData(value)
+    values = data['fields']
+    # the constructor would make placeholders for the children, and some
+    # constructors check the parameters: the fields are set here instead
+    expr = cls.__new__(cls)
+    Expr.__init__(expr, etype, constParams, dict())
+    for (field, kind) in fields.items():
+      value = values[field]
+      if value == None and kind != _Expr and kind != _ExprList:
+        pass
+      elif kind == _Expr:
+        value = exprFromData(value, expr)
+      elif kind == _ExprList:
+        value = [exprFromData(item, expr) for item in value]
+      elif kind == _String:
+        value = _stringFromData(value)
+      elif kind == _Int:
+        value = _intFromData(value)
+      elif isinstance(value, basestring):
+        value = _stringFromData(value)
+      else:
+        value = _intFromData(value)
+      setattr(expr, field, value)
+  except (KeyError, TypeError, AttributeError, ValueError, RuntimeError), e:
+    raise BaseException("Invalid query: %s: %s" % (e.__class__.__name__, e))
+  expr.setParent(parent)
+  return expr
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+import mailbox
+import os
+import sqlite3
+import zlib
+
+import emailextra
+import imapmbox
+import mimestream
+
+def cachePathFor(mboxName):
+  """The cache lives next to the mailbox: for 'path/to/box' (a file
+     or a Maildir) it is 'path/to/box.moss-cache'."""
+  return mboxName.rstrip(os.sep) + '.moss-cache'
+
+class HeaderCache:
+  """Persistent cache of decoded message headers, kept in an SQLite
+     file next to the mailbox.
+     - Maildir messages are keyed by their unique name (the mailbox
+       key), so flag changes (renames) do not invalidate them.
+     - mbox messages are keyed by the byte offset of their 'From '
+       line. The file size and mtime seen last time are remembered,
+       with the CRC32 of the first and the last message. If the file
+       changed, the old entries stay valid only if it grew and those
+       two messages are still where they were, unchanged (i.e. it most
+       likely only grew at the end); otherwise the cache is dropped.
+     For every message the first occurrence of each header is stored,
+     decoded with emailextra.headerToUnicode. A header that failed to
+     decode is stored as NULL, meaning 'ask the message itself'."""
+
+  _schemaVersion = '1'
+
+  def __init__(self, path, mboxName):
+    self._mboxName = mboxName
+    self._db = sqlite3.connect(path)
+    self._createSchema()
+    # set of cache keys present in the database (None = not read yet)
+    self._known = None
+    # mailbox key -> cache key, valid after refresh()
+    self._keyMap = dict()
+    # lowercase header name -> (cache key -> value), loaded on demand
+    self._columns = dict()
+
+  @staticmethod
+  def open(mboxName):
+    """Returns a HeaderCache for the mailbox, or None if the cache
+       file cannot be used (e.g. read-only directory). IMAP mailboxes
+       have none: the server searches the headers (see expr_imap)."""
+    if imapmbox.isImapUrl(mboxName):
+      return None
+    try:
+      return HeaderCache(cachePathFor(mboxName), mboxName)
+    except sqlite3.Error:
+      return None
+
+  def _createSchema(self):
+    self._db.execute(
+      'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+    if self._getMeta('version') != self._schemaVersion:
+      self._db.execute('DROP TABLE IF EXISTS messages')
+      self._db.execute('DROP TABLE IF EXISTS headers')
+      self._db.execute('DELETE FROM meta')
+    self._db.execute(
+      'CREATE TABLE IF NOT EXISTS messages (ckey TEXT PRIMARY KEY)')
+    self._db.execute(
+      'CREATE TABLE IF NOT EXISTS headers ('
+      '  name TEXT, ckey TEXT, value TEXT, PRIMARY KEY (name, ckey))')
+    self._setMeta('version', self._schemaVersion)
+    self._db.commit()
+
+  def _getMeta(self, name):
+    row = self._db.execute(
+      'SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+    if row == None:
+      return None
+    return row[0]
+
+  def _setMeta(self, name, value):
+    self._db.execute(
+      'INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+      (name, value))
+
+  def _clear(self):
+    self._db.execute('DELETE FROM messages')
+    self._db.execute('DELETE FROM headers')
+    self._known = set()
+    self._columns = dict()
+
+  #---- refreshing
+
+  def refresh(self, mbox, progress=None):
+    """Brings the cache up to date with the mailbox `mbox': headers of
+       messages not seen before are read and stored, entries of
+       messages that are gone are deleted. `progress', if given, is
+       called with (done, total) while the new messages are read."""
+    if self._known == None:
+      self._known = set(row[0] for row in
+                        self._db.execute('SELECT ckey FROM messages'))
+    if isinstance(mbox, mailbox.Maildir):
+      keyMap = self._maildirKeyMap(mbox)
+    else:
+      keyMap = self._mboxKeyMap(mbox)
+      self._checkMbox(mbox, keyMap)
+    current = set(keyMap.itervalues())
+    stale = self._known - current
+    for ckey in stale:
+      self._db.execute('DELETE FROM messages WHERE ckey = ?', (ckey,))
+      self._db.execute('DELETE FROM headers WHERE ckey = ?', (ckey,))
+    changed = len(stale) > 0
+    self._known -= stale
+    new = [(key, ckey) for (key, ckey) in keyMap.iteritems()
+           if not ckey in self._known]
+    for (done, (key, ckey)) in enumerate(new):
+      if progress != None:
+        progress(done, len(new))
+      try:
+        self._store(ckey, self._readHeaders(mbox, key))
+      except KeyError:
+        # the message disappeared in the meantime
+        continue
+      self._known.add(ckey)
+      changed = True
+    self._db.commit()
+    self._keyMap = keyMap
+    if changed:
+      self._columns = dict()
+
+  def attach(self, mbox):
+    """Like refresh(), but only reads the cache: messages that are not
+       in it are left to be read from the mailbox. Meant for processes
+       sharing the cache file with the one that does the refreshing."""
+    self._known = set(row[0] for row in
+                      self._db.execute('SELECT ckey FROM messages'))
+    if isinstance(mbox, mailbox.Maildir):
+      self._keyMap = self._maildirKeyMap(mbox)
+    else:
+      self._keyMap = self._mboxKeyMap(mbox)
+    self._columns = dict()
+
+  def _maildirKeyMap(self, mbox):
+    return dict((key, key) for key in mbox.iterkeys())
+
+  def _checkMbox(self, mbox, keyMap):
+    st = os.stat(self._mboxName)
+    size = str(st.st_size)
+    mtime = repr(st.st_mtime)
+    oldSize = self._getMeta('mbox size')
+    ends = self._getMeta('mbox ends')
+    if oldSize == size and self._getMeta('mbox mtime') == mtime and \
+       ends != None:
+      return
+    if oldSize != None:
+      # 'mbox ends' is '<first offset> <last offset> <checksum>'
+      fields = (ends or '').split()
+      if st.st_size <= int(oldSize) or len(fields) != 3 or \
+         self._checksum(mbox, keyMap, fields[0:2]) != fields[2]:
+        self._clear()
+    offsets = sorted(set(keyMap.itervalues()), key=int)
+    if len(offsets) > 0:
+      ends = [offsets[0], offsets[-1]]
+      ends.append(self._checksum(mbox, keyMap, ends))
+    else:
+      ends = []
+    self._setMeta('mbox size', size)
+    self._setMeta('mbox mtime', mtime)
+    self._setMeta('mbox ends', ' '.join(ends))
+
+  def _checksum(self, mbox, keyMap, ckeys):
+    """CRC32 of the messages starting at the offsets `ckeys', as text;
+       None if there is no message at one of them."""
+    keys = dict((ckey, key) for (key, ckey) in keyMap.iteritems())
+    crc = 0
+    for ckey in ckeys:
+      if not ckey in keys:
+        return None
+      crc = zlib.crc32(mbox.get_string(keys[ckey]), crc)
+    return str(crc & 0xffffffff)
+
+  def _mboxKeyMap(self, mbox):
+    keyMap = dict()
+    for key in mbox.iterkeys():
+      # iterkeys() builds the table of contents: key -> (start, stop)
+      keyMap[key] = str(mbox._toc[key][0])
+    return keyMap
+
+  def _readHeaders(self, mbox, key):
+    headers = emailextra.loadHeaders(mbox, key)
+    values = dict()
+    for name in headers.keys():
+      lname = name.lower()
+      if lname in values:
+        continue
+      try:
+        values[lname] = emailextra.headerToUnicode(headers, name)
+      except Exception:
+        values[lname] = None
+    return values
+
+  def _store(self, ckey, values):
+    self._db.execute('INSERT OR REPLACE INTO messages (ckey) VALUES (?)',
+                     (ckey,))
+    self._db.executemany(
+      'INSERT OR REPLACE INTO headers (name, ckey, value) VALUES (?, ?, ?)',
+      [(lname, ckey, value) for (lname, value) in values.iteritems()])
+
+  #---- lookups
+
+  def hasKey(self, key):
+    return self._keyMap.get(key) in self._known
+
+  def lookup(self, key, headerName):
+    """Returns the decoded value of the header `headerName' of the
+       message with the mailbox key `key': u'' if there is no such
+       header, None if the value is not in the cache."""
+    lname = headerName.lower()
+    column = self._columns.get(lname)
+    if column == None:
+      # one query per header name and search, instead of one per message
+      column = dict(self._db.execute(
+        'SELECT ckey, value FROM headers WHERE name = ?', (lname,)))
+      self._columns[lname] = column
+    return column.get(self._keyMap[key], u'')
+
+class CachedMessage(emailextra.MessageContext):
+  """Stands in for a message during query evaluation. Headers are
+     answered from the HeaderCache; anything else (attachments, ...)
+     loads the real message from the mailbox, once, on first use,
+     within `budget' (see mimestream.loadMessage)."""
+
+  headersCached = True
+
+  # message - the message, if it has been read already
+  # budget  - mimestream.MessageBudget, or None for no limits
+  def __init__(self, cache, mbox, key, message=None, budget=None):
+    emailextra.MessageContext.__init__(self, message)
+    self._cache = cache
+    self._mbox = mbox
+    self._key = key
+    self._budget = budget
+
+  def getMessage(self):
+    if self._message == None:
+      self._message = mimestream.loadMessage(self._mbox, self._key,
+                                             self._budget)
+    return self._message
+
+  def headerToUnicode(self, headerName):
+    value = self._cache.lookup(self._key, headerName)
+    if value == None:
+      return emailextra.MessageContext.headerToUnicode(self, headerName)
+    return value
+
+  def headerContains(self, headerName, needle):
+    # the cache has the decoded value already
+    return needle in self.headerToUnicode(headerName)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Opening mailboxes in the background, so that the program can be used
+# while they load.
+
+import threading
+
+import headercache
+import remote
+import scan
+
+class MailboxLoader(threading.Thread):
+  """Opens mailboxes in a thread of its own: finds them (see
+     scan.findMailboxes), builds the table of contents of each (or
+     lists a Maildir) and brings its header cache up to date, which on
+     a large mailbox seen for the first time takes long.
+     Meanwhile getProgress() tells how far it is; once the thread has
+     finished, getMailboxes() returns the mailboxes.
+     The header caches are only refreshed here: an SQLite connection
+     cannot be shared between threads, so whoever searches opens the
+     cache again (see headercache.HeaderCache.open), and finds it up to
+     date.
+     Then it asks the workers given, if any, which mailboxes they serve
+     (see remote)."""
+
+  # paths   - as given to scan.findMailboxes
+  # workers - addresses of workers (see remote.connect)
+  def __init__(self, paths, workers=()):
+    threading.Thread.__init__(self, name='MailboxLoader')
+    self.daemon = True
+    self._paths = paths
+    self._workers = workers
+    self._lock = threading.Lock()
+    self._progress = 'looking for mailboxes'
+    self._folder = ''
+    # (name, mailbox) of the mailboxes opened
+    self._mailboxes = []
+    # (remote.RemoteWorker, names of its mailboxes) of the workers that
+    # answered
+    self._remotes = []
+    # (name, error) of the mailboxes that could not be opened
+    self._errors = []
+
+  def run(self):
+    if len(self._paths) > 0:
+      self._openLocal()
+    for address in self._workers:
+      self._folder = ''
+      self._setProgress('asking worker %s' % address)
+      worker = remote.RemoteWorker(address)
+      try:
+        (names, errors) = worker.listMailboxes()
+      except BaseException, e:
+        self._errors.append(('worker ' + address, self._describe(e)))
+        continue
+      self._remotes.append((worker, names))
+      self._errors.extend([(worker.qualify(name), error)
+                           for (name, error) in errors])
+
+  def _openLocal(self):
+    try:
+      names = scan.findMailboxes(self._paths)
+    except BaseException, e:
+      self._errors.append((', '.join(self._paths), self._describe(e)))
+      return
+    for (i, name) in enumerate(names):
+      if len(names) > 1:
+        self._folder = 'folder %d/%d: ' % (i + 1, len(names))
+      try:
+        self._mailboxes.append((name, self._open(name)))
+      except BaseException, e:
+        self._errors.append((name, self._describe(e)))
+
+  def _open(self, name):
+    self._setProgress('opening the mailbox')
+    mbox = scan.openMailbox(name)
+    self._setProgress('reading the table of contents')
+    mbox.snapshot()
+    cache = headercache.HeaderCache.open(name)
+    if cache != None:
+      self._setProgress('reading headers')
+      cache.refresh(mbox, self._headersRead)
+    return mbox
+
+  @staticmethod
+  def _describe(e):
+    # this program raises BaseException for its own errors
+    return '%s: %s' % (e.__class__.__name__, e)
+
+  def _setProgress(self, text):
+    self._lock.acquire()
+    try:
+      self._progress = self._folder + text
+    finally:
+      self._lock.release()
+
+  def _headersRead(self, done, total):
+    self._setProgress('reading headers: %d/%d' % (done, total))
+
+  # RETURN: what is being done now, e.g. 'reading headers: 120/5000'
+  def getProgress(self):
+    self._lock.acquire()
+    try:
+      return self._progress
+    finally:
+      self._lock.release()
+
+  # RETURN: list of (name, mailbox) of the mailboxes opened (see
+  #         scan.openMailbox); call after the thread has finished
+  def getMailboxes(self):
+    return self._mailboxes
+
+  # RETURN: list of (remote.RemoteWorker, list of the names of its
+  #         mailboxes)
+  def getRemoteMailboxes(self):
+    return self._remotes
+
+  # RETURN: list of (name, why it could not be opened)
+  def getErrors(self):
+    return self._errors
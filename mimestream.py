@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Parsing messages in pieces, under limits of memory and CPU time.
+
+import email.feedparser
+import email.message
+import email.parser
+import re
+
+import osextra
+
+from email.feedparser import NLCRE, NLCRE_eol, NeedMoreData, headerRE
+
+# how much of a message is read and parsed at once
+_chunkSize = 65536
+
+class BudgetExceeded(Exception):
+  """Reading a message took more CPU time than MessageBudget allows."""
+
+class MessageBudget:
+  """Limits for reading one message during a search.
+     maxBytes   - messages larger than this are not read into memory:
+                  their MIME structure and the sizes of their parts
+                  are found by streaming over them (see parseSkeleton)
+     maxSeconds - CPU time after which reading a message is given up
+                  (BudgetExceeded is raised); only that of the thread
+                  reading it counts (see osextra.threadCpuTime), not
+                  that of the others reading or searching meanwhile
+     None means no limit."""
+
+  def __init__(self, maxBytes=None, maxSeconds=None):
+    self.maxBytes = maxBytes
+    self.maxSeconds = maxSeconds
+
+  # RETURN: the deadline for a message read from now on by this thread
+  #         (see check, to be called in the same thread)
+  def start(self):
+    if self.maxSeconds == None:
+      return None
+    return osextra.threadCpuTime() + self.maxSeconds
+
+  def check(self, deadline):
+    if deadline != None and osextra.threadCpuTime() > deadline:
+      raise BudgetExceeded('Message takes longer than %s s to read' %
+                           self.maxSeconds)
+
+def parseMessage(f, budget, deadline):
+  """Parses the message read from the file-like object `f' with a
+     FeedParser, a chunk at a time, checking the budget in between.
+     RETURNS Message, or None if it is larger than budget.maxBytes"""
+  parser = email.feedparser.FeedParser()
+  size = 0
+  while True:
+    data = f.read(_chunkSize)
+    if data == '':
+      return parser.close()
+    size += len(data)
+    if budget.maxBytes != None and size > budget.maxBytes:
+      return None
+    parser.feed(data)
+    budget.check(deadline)
+
+def loadMessage(mbox, key, budget):
+  """Reads the message `key' of the mailbox `mbox' for a search:
+     parsed completely, or with parseSkeleton if it is larger than
+     budget.maxBytes. Raises BudgetExceeded.
+     RETURNS Message or SkeletonPart"""
+  if budget == None:
+    return mbox.get_message(key)
+  deadline = budget.start()
+  f = mbox.get_file(key)
+  try:
+    message = parseMessage(f, budget, deadline)
+  finally:
+    f.close()
+  if message == None:
+    message = loadSkeleton(mbox, key, budget, deadline)
+  return message
+
+def loadSkeleton(mbox, key, budget, deadline=None):
+  """parseSkeleton for the message `key' of the mailbox `mbox' (when it
+     is known to be too large for loadMessage to parse completely)."""
+  if deadline == None:
+    deadline = budget.start()
+  f = mbox.get_file(key)
+  try:
+    return parseSkeleton(f, budget, deadline)
+  finally:
+    f.close()
+
+class SkeletonPart(email.message.Message):
+  """A message, or a part of one, as parsed by parseSkeleton: headers
+     and sub-parts as usual, but where a Message would have the body
+     as its payload, only its length (bodySize) is kept."""
+
+  def __init__(self):
+    email.message.Message.__init__(self)
+    self.bodySize = 0
+    # length of the line ending of the last body line
+    self.lastEolSize = 0
+
+def payloadSize(part):
+  """len(part.get_payload(decode=False)) for a part that is not
+     multipart, also for a SkeletonPart."""
+  if isinstance(part, SkeletonPart):
+    return part.bodySize
+  return len(part.get_payload(decode=False))
+
+def parseSkeleton(f, budget, deadline):
+  """Parses the message read from the file-like object `f' like the
+     email package does, except that bodies are only measured, never
+     kept: memory use does not depend on the size of the message.
+     RETURNS SkeletonPart"""
+  return _SkeletonParser(f, budget, deadline).parse(None)
+
+class _SkeletonParser:
+  """The parsing of email.feedparser.FeedParser (_parsegen), reading
+     from a file instead of being fed, and counting body lines instead
+     of collecting them. Its BufferedSubFile does the line splitting
+     and the matching of the boundaries of enclosing multiparts."""
+
+  def __init__(self, f, budget, deadline):
+    self._f = f
+    self._budget = budget
+    self._deadline = deadline
+    self._input = email.feedparser.BufferedSubFile()
+
+  def _readline(self):
+    # RETURN: the next line, or '' at the end of the current part
+    while True:
+      line = self._input.readline()
+      if line is not NeedMoreData:
+        return line
+      data = self._f.read(_chunkSize)
+      if data == '':
+        self._input.close()
+      else:
+        self._input.push(data)
+      self._budget.check(self._deadline)
+
+  def _count(self, part):
+    # the rest of the current part is the body of `part'
+    while True:
+      line = self._readline()
+      if line == '':
+        return
+      part.bodySize += len(line)
+      eol = NLCRE_eol.search(line)
+      if eol:
+        part.lastEolSize = len(eol.group(0))
+      else:
+        part.lastEolSize = 0
+
+  def _skip(self):
+    while self._readline() != '':
+      pass
+
+  def parse(self, defaultType):
+    headers = []
+    while True:
+      line = self._readline()
+      if line == '':
+        break
+      if not headerRE.match(line):
+        if not NLCRE.match(line):
+          self._input.unreadline(line)
+        break
+      headers.append(line)
+    part = email.parser.HeaderParser(SkeletonPart).parsestr(''.join(headers))
+    part.set_payload(None)
+    if defaultType != None:
+      part.set_default_type(defaultType)
+    if part.get_content_type() == 'message/delivery-status':
+      # blocks of headers separated by blank lines
+      while True:
+        self._input.push_eof_matcher(NLCRE.match)
+        part.attach(self.parse(None))
+        self._input.pop_eof_matcher()
+        self._readline()
+        line = self._readline()
+        if line == '':
+          break
+        self._input.unreadline(line)
+    elif part.get_content_maintype() == 'message':
+      part.attach(self.parse(None))
+    elif part.get_content_maintype() == 'multipart':
+      self._parseMultipart(part)
+    else:
+      self._count(part)
+    return part
+
+  def _parseMultipart(self, part):
+    boundary = part.get_boundary()
+    if boundary == None:
+      # the body is read as it is
+      self._count(part)
+      return
+    separator = '--' + boundary
+    boundaryre = re.compile(
+      '(?P<sep>' + re.escape(separator) +
+      r')(?P<end>--)?(?P<ws>[ \t]*)(?P<linesep>\r\n|\r|\n)?$')
+    if part.get_content_type() == 'multipart/digest':
+      defaultType = 'message/rfc822'
+    else:
+      defaultType = None
+    # until the first boundary, count the preamble: it becomes the body
+    # if there is no boundary at all
+    capturing = True
+    while True:
+      line = self._readline()
+      if line == '':
+        break
+      mo = boundaryre.match(line)
+      if mo == None:
+        part.bodySize += len(line)
+        continue
+      if mo.group('end'):
+        break
+      if capturing:
+        capturing = False
+        part.bodySize = 0
+        self._input.unreadline(line)
+        continue
+      # several boundaries in a row make no empty parts
+      while True:
+        line = self._readline()
+        if boundaryre.match(line) == None:
+          self._input.unreadline(line)
+          break
+      self._input.push_eof_matcher(boundaryre.match)
+      sub = self.parse(defaultType)
+      # the line ending before a boundary belongs to the boundary: to the
+      # body of the last part parsed, which for message/* is inside it
+      last = sub
+      while last.get_content_maintype() == 'message' and \
+            last.is_multipart():
+        last = last.get_payload()[-1]
+      if last.get_content_maintype() != 'multipart' and \
+         not last.is_multipart():
+        last.bodySize -= last.lastEolSize
+      self._input.pop_eof_matcher()
+      part.attach(sub)
+    # the epilogue is of no interest
+    self._skip()
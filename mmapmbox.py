@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+import cStringIO
+import mailbox
+import mmap
+import os
+import struct
+import zlib
+
+import emailextra
+import osextra
+
+class MmapMbox(mailbox.mbox):
+  """A read-mostly mbox that maps the file into memory instead of
+     reading it line by line.
+     - The table of contents is built by searching the mapping for
+       'From ' lines, not by readline().
+     - Messages are handed out as slices of the mapping: get_file()
+       returns a file over a buffer() of the message (no copy), and
+       get_header_string() copies only the header section.
+     Keys and (start, stop) offsets are the same as mailbox.mbox would
+     produce, so everything that works with mailbox.mbox (including
+     writing, which goes through the normal file) keeps working. The
+     file is mapped again when a message beyond the mapping is asked
+     for (e.g. after add())."""
+
+  def __init__(self, path, factory=None, create=True):
+    mailbox.mbox.__init__(self, path, factory, create)
+    self._map = None
+
+  def _mapFile(self):
+    if self._map != None:
+      self._map.close()
+      self._map = None
+    self._file.seek(0, 2)
+    if self._file.tell() > 0:
+      # searches go through the file from start to end; this makes the
+      # kernel read ahead more, also for page faults in the mapping
+      osextra.fadvise(self._file.fileno(), osextra.FADV_SEQUENTIAL)
+      self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def _mapped(self, stop):
+    """Makes sure the mapping covers the file up to `stop' (messages
+       may have been appended since it was made). Returns False if
+       there is nothing to map."""
+    if self._map == None or len(self._map) < stop:
+      self._mapFile()
+    return self._map != None
+
+  def _generate_toc(self):
+    """Generate key-to-(start, stop) table of contents."""
+    self._mapFile()
+    starts, stops = [], []
+    size = 0
+    if self._map != None:
+      size = len(self._map)
+      pos = self._loadToc(starts, stops)
+      if pos == None:
+        pos = self._firstStart()
+      if pos != size:
+        self._scanToc(pos, starts, stops)
+        self._saveToc(starts, stops)
+    self._toc = dict(enumerate(zip(starts, stops)))
+    self._next_key = len(self._toc)
+    self._file_length = size
+    self._tocMtime = os.fstat(self._file.fileno()).st_mtime
+
+  def snapshot(self):
+    """Brings the table of contents up to the current end of the file.
+       Messages appended since it was made get new keys, the old ones
+       keep theirs (unless the file was rewritten, see _loadToc).
+       Messages appended after this are not seen until the next
+       snapshot(): searches stop at the end of the file as it is now.
+       The file is never locked, so delivery goes on meanwhile."""
+    if self._toc != None:
+      st = os.fstat(self._file.fileno())
+      if st.st_size == self._file_length and st.st_mtime == self._tocMtime:
+        return
+    # the sidecar makes this cheap: only new messages are scanned
+    self._generate_toc()
+
+  def _firstStart(self):
+    if self._map[:5] == 'From ':
+      return 0
+    pos = self._map.find(os.linesep + 'From ')
+    if pos == -1:
+      return len(self._map)
+    return pos + len(os.linesep)
+
+  def _scanToc(self, pos, starts, stops):
+    """Appends to starts/stops the messages found from the 'From ' line
+       at `pos' to the end of the file."""
+    sep = os.linesep + 'From '
+    sepLen = len(os.linesep)
+    blank = os.linesep + os.linesep
+    size = len(self._map)
+    while pos != -1:
+      start = pos
+      starts.append(start)
+      next = self._map.find(sep, start)
+      if next == -1:
+        end = size
+        pos = -1
+      else:
+        end = next + sepLen
+        pos = end
+      # like mailbox.mbox: an empty line just before the next 'From '
+      # line (or the end of file) does not belong to the message
+      if self._map[max(end-2*sepLen, start):end] == blank:
+        stops.append(end - sepLen)
+      else:
+        stops.append(end)
+
+  #---- table of contents sidecar
+  #
+  # The table of contents is kept in '<mbox>.moss-toc' so that opening
+  # an mbox that only grew at the end does not scan it all again:
+  #   header:  magic, file size, mtime, checksum, number of messages
+  #   records: (start, stop) for each message
+  # The checksum is the CRC32 of the file from the start of the last
+  # message to the old end of file. If it still matches (and the file
+  # did not shrink), only that last message and whatever was appended
+  # after it are scanned.
+
+  _tocMagic = 'MOSSTOC1'
+  _tocHeader = struct.Struct('<8sQdIQ')
+
+  def _tocPath(self):
+    return self._path + '.moss-toc'
+
+  def _loadToc(self, starts, stops):
+    """Fills starts/stops from the sidecar, except for the last message.
+       Returns the offset to continue scanning from, or None if the
+       sidecar is missing or does not match the file."""
+    try:
+      f = open(self._tocPath(), 'rb')
+      try:
+        data = f.read()
+      finally:
+        f.close()
+    except IOError:
+      return None
+    if len(data) < self._tocHeader.size:
+      return None
+    (magic, oldSize, oldMtime, checksum, count) = \
+      self._tocHeader.unpack_from(data)
+    if magic != self._tocMagic or count == 0 or \
+       len(data) != self._tocHeader.size + 16*count:
+      return None
+    size = len(self._map)
+    if oldSize > size:
+      return None
+    records = struct.unpack_from('<%dQ' % (2*count), data,
+                                 self._tocHeader.size)
+    lastStart = records[-2]
+    if oldSize != size or oldMtime != os.fstat(self._file.fileno()).st_mtime:
+      if zlib.crc32(self._map[lastStart:oldSize]) & 0xffffffff != checksum:
+        return None
+    if oldSize == size:
+      starts.extend(records[0::2])
+      stops.extend(records[1::2])
+      return size
+    starts.extend(records[0:-2:2])
+    stops.extend(records[1:-2:2])
+    return lastStart
+
+  def _saveToc(self, starts, stops):
+    if len(starts) == 0:
+      return
+    size = len(self._map)
+    checksum = zlib.crc32(self._map[starts[-1]:size]) & 0xffffffff
+    records = [None] * (2*len(starts))
+    records[0::2] = starts
+    records[1::2] = stops
+    header = self._tocHeader.pack(
+      self._tocMagic, size, os.fstat(self._file.fileno()).st_mtime,
+      checksum, len(starts))
+    try:
+      f = open(self._tocPath(), 'wb')
+      try:
+        f.write(header)
+        f.write(struct.pack('<%dQ' % len(records), *records))
+      finally:
+        f.close()
+    except IOError:
+      # e.g. read-only directory; we'll just scan again next time
+      pass
+
+  def _bodyStart(self, start, stop):
+    """Offset just after the 'From ' line of the message at `start'."""
+    pos = self._map.find('\n', start, stop)
+    if pos == -1:
+      return stop
+    return pos + 1
+
+  def get_message(self, key):
+    """Return a Message representation or raise a KeyError."""
+    (start, stop) = self._lookup(key)
+    if not self._mapped(stop):
+      return mailbox.mbox.get_message(self, key)
+    bodyStart = self._bodyStart(start, stop)
+    fromLine = self._map[start:bodyStart].rstrip('\r\n')
+    msg = self._message_factory(
+      self._map[bodyStart:stop].replace(os.linesep, '\n'))
+    msg.set_from(fromLine[5:])
+    return msg
+
+  def get_file(self, key, from_=False):
+    """Return a file-like representation or raise a KeyError."""
+    (start, stop) = self._lookup(key)
+    if not self._mapped(stop):
+      return mailbox.mbox.get_file(self, key, from_)
+    if not from_:
+      start = self._bodyStart(start, stop)
+    return cStringIO.StringIO(buffer(self._map, start, stop - start))
+
+  def get_header_string(self, key):
+    """Return the header section of the message (without the 'From '
+       line and the empty line ending it) or raise a KeyError."""
+    (start, stop) = self._lookup(key)
+    if not self._mapped(stop):
+      f = mailbox.mbox.get_file(self, key)
+      try:
+        return emailextra.readHeaderBlock(f)
+      finally:
+        f.close()
+    start = self._bodyStart(start, stop)
+    if self._map[start:start+1] == '\n' or self._map[start:start+2] == '\r\n':
+      return ''
+    end = self._map.find('\n\n', start, stop)
+    crlfEnd = self._map.find('\n\r\n', start, stop)
+    if end == -1 or (crlfEnd != -1 and crlfEnd < end):
+      end = crlfEnd
+    if end == -1:
+      return self._map[start:stop]
+    return self._map[start:end+1]
+
+  def flush(self):
+    """Write any pending changes to disk."""
+    pending = self._pending
+    mailbox.mbox.flush(self)
+    if pending:
+      # the file has been rewritten, and the table of contents with it
+      self._mapFile()
+      if self._map != None:
+        keys = sorted(self._toc.keys())
+        self._saveToc([self._toc[key][0] for key in keys],
+                      [self._toc[key][1] for key in keys])
+
+  def close(self):
+    """Flush and close the mailbox."""
+    if self._map != None:
+      self._map.close()
+      self._map = None
+    mailbox.mbox.close(self)
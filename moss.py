@@ -23,13 +23,23 @@ import curses
 import curses.wrapper
 import curses.ascii
 import email
+import getopt
 import mailbox
+import multiprocessing
 import re
 import os
 import sys
 
 # application modules
 import emailextra
+import expr_compile
+import headercache
+import mboxloader
+import mimestream
+import parallel
+import remote
+import snapshotmaildir
+import valuecache
 from expr import *
 from expr_ui import *
 from expr_special import *
@@ -104,6 +114,11 @@ class MainLayout:
       if ch == curses.KEY_RESIZE:
         (self._screenMaxY, self._screenMaxX) = self._stdscr.getmaxyx()
         self._mainpanel.feedResize()
+      elif ch == curses.ERR: # no key pressed for a while
+        ret = self._cmdlistener.feedIdle()
+        if ret != None:
+          self._tmpmessage = ret.msg
+          self._tmpmessagemode = ret.msgType
       elif ch in [8, 127, curses.KEY_BACKSPACE]: # backspace
         self._tmpmessage = None
         self._cmdline = self._cmdline[0:len(self._cmdline)-1]
@@ -372,15 +387,57 @@ class Engine:
   def setStatusInterface(self, statusInterface):
     self._statusInterface = statusInterface
 
-  def setMailbox(self, mboxName):
-    self._mboxName = mboxName
+  # paths - mailboxes, or directories to look for mailboxes in (see
+  #         scan.findMailboxes)
+  def setMailboxes(self, paths):
+    self._paths = paths
+
+  # addresses - workers to search the mailboxes of other hosts with (see
+  #             remote)
+  def setWorkers(self, addresses):
+    self._workerAddresses = addresses
+
+  # processes - number of worker processes to search with (1 = search
+  #             in this process, None = one per CPU if there are several
+  #             mailboxes, else 1)
+  def setSearchProcesses(self, processes):
+    self._searchProcesses = processes
+
+  # readers - number of threads reading messages ahead of the search
+  #           (0 = no read-ahead)
+  # depth   - at most this many messages are read ahead
+  def setReadAhead(self, readers, depth):
+    self._readers = readers
+    self._readDepth = depth
+
+  # budget - mimestream.MessageBudget: limits for reading one message
+  def setMessageBudget(self, budget):
+    self._budget = budget
+
+  # size - bytes of the values kept from one search to the next, in
+  #        each process searching (see valuecache); 0 = none
+  def setValueCacheSize(self, size):
+    self._valueCacheSize = size
 
   def startup(self):
     self._statusInterface.setTopStatusText('MailMan version 0.1')
-    if os.path.isdir(self._mboxName):
-      self._mailbox = mailbox.Maildir(self._mboxName, None)
-    else:
-      self._mailbox = mailbox.mbox(self._mboxName)
+    # the mailboxes are opened in the background (see finishLoading), so
+    # that the query can be edited meanwhile
+    # list of (name, mailbox, header cache or None)
+    self._folders = []
+    # remote.RemoteWorker of the workers searched along
+    self._remotes = []
+    # name -> mailbox (remote.RemoteMailbox for those of the workers)
+    self._mailboxes = dict()
+    self._loadErrors = []
+    self._searchPool = None
+    # valuecache.ValueCache of the searches in this process
+    self._valueCache = None
+    self._loader = mboxloader.MailboxLoader(self._paths,
+                                            self._workerAddresses)
+    self._loader.start()
+    # True if 'search' was given while loading: it runs when loading ends
+    self._searchQueued = False
     self._query = ExprNull(ET.Bool, dict(), dict())
     for (indent, text, obj) in self._query.uiGetRendering():
       self._mainPanel.addLine('  '*indent+text, obj)
@@ -398,13 +455,73 @@ class Engine:
       except:
         pass
     ##### query status:
-    # the list of all messages resulted in last search
+    # the list of (mailbox name, key) of all messages resulted in last
+    # search
     self._results = None
+    # (mailbox name, key) of the messages the last search skipped (see
+    # mimestream.MessageBudget)
+    self._overBudget = []
+    # what the last search learnt about the order of evaluation (see
+    # expr_compile.mergeStatistics)
+    self._statistics = None
     # boolean: True if the query didn't change since _results were obtained
     self._resultsFresh = None
     #####
     self.updateStatus()
 
+  # RETURN: FeedCmdResult of the search given while loading, if any,
+  #         else None
+  def finishLoading(self):
+    self._loader.join()
+    for (name, mbox) in self._loader.getMailboxes():
+      self._folders.append((name, mbox, headercache.HeaderCache.open(name)))
+      self._mailboxes[name] = mbox
+    for (worker, names) in self._loader.getRemoteMailboxes():
+      self._remotes.append(worker)
+      for name in names:
+        self._mailboxes[worker.qualify(name)] = \
+          remote.RemoteMailbox(worker, name)
+    self._loadErrors = self._loader.getErrors()
+    self._loader = None
+    if len(self._mailboxes) == 0:
+      if self._searchQueued:
+        self._searchQueued = False
+        return FeedCmdResult.error('No mailbox to search: the search given '+
+                                   'while loading was not run')
+      return None
+    processes = self._searchProcesses
+    if processes == None:
+      processes = 1
+      if len(self._folders) > 1:
+        processes = multiprocessing.cpu_count()
+    if processes > 1 and len(self._folders) > 0:
+      self._searchPool = parallel.SearchPool(processes,
+                                             self._readers, self._readDepth,
+                                             self._budget,
+                                             self._valueCacheSize)
+    elif self._valueCacheSize > 0:
+      self._valueCache = valuecache.ValueCache(self._valueCacheSize)
+    if self._searchQueued:
+      self._searchQueued = False
+      if not self._query.isComplete():
+        return FeedCmdResult.error('The query is incomplete: the search '+
+                                   'given while loading was not run')
+      return self.searchCommand()
+    return None
+
+  # this will be called by the UI when no key has been pressed for a while
+  # RETURN: FeedCmdResult, whose message is to be shown, or None
+  def feedIdle(self):
+    result = None
+    if self._loader != None and not self._loader.isAlive():
+      result = self.finishLoading()
+    self.updateStatus()
+    return result
+
+  def shutdown(self):
+    if self._searchPool != None:
+      self._searchPool.close()
+
   def defaultValue(self, ptype):
     if ptype == ET.Int: return 0
     if ptype == ET.String: return ''
@@ -592,15 +709,58 @@ class Engine:
       return None
    
   def searchCommand(self):
+    if self._loader != None:
+      self._searchQueued = True
+      return FeedCmdResult()
+    if len(self._mailboxes) == 0:
+      return FeedCmdResult.error('No mailbox to search')
     count = 0
     st= "searching..."
     self._statusInterface.quickUpdateBottomStatusText(st)
-    iter = self._mailbox.items()
+    # the workers search meanwhile
+    searches = [remote.RemoteSearch(worker, self._query)
+                for worker in self._remotes]
+    for search in searches:
+      search.start()
+    errors = []
+    try:
+      parts = list(parallel.searchFolders(self._query, self._folders,
+                                          self._searchPool, self._readers,
+                                          self._readDepth, self._budget,
+                                          self._valueCache))
+    except KeyboardInterrupt:
+      raise
+    except BaseException, e:
+      # e.g. a worker process died, or a mailbox file was removed; the
+      # workers' searches are still waited for
+      parts = []
+      if e.__class__ is BaseException:
+        # this program raises BaseException for its own errors
+        errors.append(str(e))
+      else:
+        errors.append('Search failed: %s: %s' % (e.__class__.__name__, e))
+    parts.sort()
     self._results = []
-    for (key, message) in iter:
-      if self._query.evaluate(message, dict(), dict()) == True:
-        self._results.append(message)
+    self._overBudget = []
+    self._statistics = None
+    for (index, name, found, overBudget, statistics) in parts:
+      self._results.extend([(name, key) for key in found])
+      self._overBudget.extend([(name, key) for key in overBudget])
+      self._statistics = expr_compile.mergeStatistics(self._statistics,
+                                                      statistics)
+    for search in searches:
+      search.join()
+      (found, overBudget, statistics, error) = search.getResults()
+      self._results.extend(found)
+      self._overBudget.extend(overBudget)
+      self._statistics = expr_compile.mergeStatistics(self._statistics,
+                                                      statistics)
+      if error != None:
+        errors.append('Search failed on worker '+
+                      search.getWorker().getAddress()+': '+error)
     self._resultsFresh = True
+    if len(errors) > 0:
+      return FeedCmdResult.error(errors[0])
     return FeedCmdResult()
 
   def showCommand(self, force):
@@ -611,8 +771,12 @@ class Engine:
                                  'results, use \'show!\' command.')
     mbox = mailbox.Maildir('.tmp.mail.dir', None, True)
     mbox.clear()
-    for message in self._results:
-      mbox.add(message)
+    for (name, key) in self._results:
+      try:
+        mbox.add(self._mailboxes[name].get_message(key))
+      except snapshotmaildir.MessageGone:
+        # deleted since the search
+        continue
     mbox.close()
     self._mainLayout.save()
     curses.savetty()
@@ -621,10 +785,55 @@ class Engine:
     curses.resetty()
     return FeedCmdResult()
 
+  def planCommand(self):
+    if self._results == None:
+      return FeedCmdResult.error('Nothing learnt yet (use \'search\' command first).')
+    if self._resultsFresh == False:
+      return FeedCmdResult.error('The query has been changed since the last search.')
+    order = expr_compile.CompiledQuery(self._query).describeOrder(self._statistics)
+    if len(order) == 0:
+      return FeedCmdResult.info('No and/or with several subexpressions was evaluated')
+    def describe(expr):
+      return ' '.join([text for (indent, text, obj) in expr.uiGetRendering()])
+    lines = ['The order of evaluation learnt by the last search:', '']
+    for (node, children) in order:
+      lines.append(node.uiGetRendering()[0][1])
+      for (position, (child, evaluations, trues, seconds)) in enumerate(children):
+        lines.append('  %d. %s' % (position+1, describe(child)[:60]))
+        if evaluations > 0:
+          lines.append('     true %.1f%% of %d times, %.1f us each' %
+                       (100.0 * trues / evaluations, evaluations,
+                        1e6 * seconds / evaluations))
+        else:
+          lines.append('     never evaluated')
+      lines.append('')
+    self._mainLayout.save()
+    curses.savetty()
+    pager = os.popen(os.environ.get('PAGER', 'less'), 'w')
+    pager.write('\n'.join(lines))
+    pager.close()
+    self._mainLayout.restore()
+    curses.resetty()
+    return FeedCmdResult()
+
   def updateStatus(self):
-    if self._query.isComplete():
+    if self._loader != None:
+      text = 'loading: '+self._loader.getProgress()
+      if self._searchQueued:
+        text += ' (the search will start when done)'
+    elif len(self._mailboxes) == 0:
+      if len(self._loadErrors) > 0:
+        text = 'cannot open '+self._loadErrors[0][0]+': '+self._loadErrors[0][1]
+      else:
+        text = 'no mailboxes found'
+    elif self._query.isComplete():
       if self._resultsFresh == True:
         text = str(len(self._results))+' messages found'
+        folders = len(set([name for (name, key) in self._results]))
+        if folders > 1:
+          text += ' in '+str(folders)+' mailboxes'
+        if len(self._overBudget) > 0:
+          text += ' ('+str(len(self._overBudget))+' skipped: too long to read)'
       elif self._resultsFresh == False:
         text = 'query changed (previously: '+str(len(self._results))+' messages found)'
       else: # None - no results yet
@@ -636,6 +845,8 @@ class Engine:
         text = 'query changed and incomplete (was: '+str(len(self._results))+' messages found)'
       else: # None - no results yet
         text = 'query incomplete'
+    if len(self._mailboxes) > 0 and len(self._loadErrors) > 0:
+      text += ' ('+str(len(self._loadErrors))+' mailboxes could not be opened)'
     self._statusInterface.setBottomStatusText(text) 
 
   def feedCmd(self, cmdline):
@@ -680,6 +891,8 @@ class Engine:
       ret = self.showCommand(False)
     elif cmd == 'show!':
       ret = self.showCommand(True)
+    elif cmd == 'plan':
+      ret = self.planCommand()
     elif cmd == 'rm':
       currentLine = self._mainPanel.getSelected()
       current = self._mainPanel.getLineUserParam(currentLine)
@@ -740,14 +953,56 @@ class Engine:
 global errorMsg
 errorMsg = None
 
+usage = """Usage: moss [options] <mailbox/maildir/directory path or imap[s]:// URL>...
+Options:
+  -w <address>  search also the mailboxes served by the worker at
+                <address> (host:port or a Unix socket path, see
+                mossworker.py); may be repeated, and then the paths may
+                be left out
+  -j <n>  search with <n> worker processes (default: 1, or one per CPU
+          for several mailboxes)
+  -r <n>  read messages ahead of the search with <n> threads (default: 0)
+  -d <n>  read at most <n> messages ahead (default: 64)
+  -m <n>  parse messages up to <n> MB completely, only stream over larger
+          ones (default: 16, 0 = no limit)
+  -t <n>  skip messages that take more than <n> seconds of CPU time to
+          read (default: 30, 0 = no limit)
+  -c <n>  keep up to <n> MB of what was found in the messages for the next
+          searches, in each search process (default: 64, 0 = nothing)"""
+
 def main(stdscr, *args, **kwds):
-  if (len(sys.argv) != 2):
-    global errorMsg
-    errorMsg = "Usage: moss <mailbox/maildir path>"
+  global errorMsg
+  try:
+    (opts, args) = getopt.getopt(sys.argv[1:], 'j:r:d:m:t:w:c:')
+    processes = None
+    workers = []
+    readers = 0
+    depth = 64
+    maxBytes = 16 << 20
+    maxSeconds = 30
+    cacheBytes = 64 << 20
+    for (opt, value) in opts:
+      if opt == '-j':
+        processes = int(value)
+      elif opt == '-r':
+        readers = int(value)
+      elif opt == '-d':
+        depth = max(int(value), 1)
+      elif opt == '-m':
+        maxBytes = int(value) << 20
+      elif opt == '-t':
+        maxSeconds = float(value)
+      elif opt == '-w':
+        workers.append(value)
+      elif opt == '-c':
+        cacheBytes = int(value) << 20
+  except (getopt.GetoptError, ValueError):
+    args = []
+    workers = []
+  if (len(args) == 0 and len(workers) == 0):
+    errorMsg = usage
     return
 
-  mboxName = sys.argv[1]
-
   mainLayout = MainLayout(stdscr)
   mainPanel = MainPanel(stdscr)
 
@@ -759,9 +1014,16 @@ def main(stdscr, *args, **kwds):
   engine.setMainPanel(mainPanel)
   engine.setStatusInterface(mainLayout)
   engine.setMainLayout(mainLayout)
-  engine.setMailbox(mboxName)
+  engine.setMailboxes(args)
+  engine.setWorkers(workers)
+  engine.setSearchProcesses(processes)
+  engine.setReadAhead(readers, depth)
+  engine.setMessageBudget(mimestream.MessageBudget(maxBytes or None,
+                                                   maxSeconds or None))
+  engine.setValueCacheSize(cacheBytes)
 
   mainLayout.run()
+  engine.shutdown()
 
 curses.wrapper( main )
 if errorMsg != None:
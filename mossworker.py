@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# The worker serving the mailboxes of one host to moss on another one,
+# or to the users of this one (see remote).
+
+import getopt
+import multiprocessing
+import signal
+import sys
+
+import mboxloader
+import mimestream
+import parallel
+import remote
+
+usage = """Usage: mossworker.py -l <address> [options] <mailbox/maildir/directory path or imap[s]:// URL>...
+Serves searches of the mailboxes given to 'moss -w <address>', many at once.
+Options:
+  -l <address>  listen on <address>: host:port, or the path of a Unix
+                socket; there is no authentication, so listen on a Unix
+                socket, on localhost or on a trusted network only
+  -j <n>  search with <n> worker processes (default: one per CPU)
+  -r <n>  read messages ahead of the search with <n> threads (default: 0)
+  -d <n>  read at most <n> messages ahead (default: 64)
+  -m <n>  parse messages up to <n> MB completely, only stream over larger
+          ones (default: 16, 0 = no limit)
+  -t <n>  skip messages that take more than <n> seconds of CPU time to
+          read (default: 30, 0 = no limit)
+  -c <n>  keep up to <n> MB of what was found in the messages for the next
+          searches, in each worker process (default: 64, 0 = nothing)"""
+
+def main():
+  try:
+    (opts, args) = getopt.getopt(sys.argv[1:], 'l:j:r:d:m:t:c:')
+    address = None
+    processes = multiprocessing.cpu_count()
+    readers = 0
+    depth = 64
+    maxBytes = 16 << 20
+    maxSeconds = 30
+    cacheBytes = 64 << 20
+    for (opt, value) in opts:
+      if opt == '-l':
+        address = value
+      elif opt == '-j':
+        processes = int(value)
+      elif opt == '-r':
+        readers = int(value)
+      elif opt == '-d':
+        depth = max(int(value), 1)
+      elif opt == '-m':
+        maxBytes = int(value) << 20
+      elif opt == '-t':
+        maxSeconds = float(value)
+      elif opt == '-c':
+        cacheBytes = int(value) << 20
+  except (getopt.GetoptError, ValueError):
+    args = []
+  if len(args) == 0 or address == None:
+    print >>sys.stderr, usage
+    sys.exit(2)
+
+  # the same as the interactive program, only in the foreground
+  loader = mboxloader.MailboxLoader(args)
+  loader.start()
+  loader.join()
+  for (name, error) in loader.getErrors():
+    print >>sys.stderr, 'cannot open %s: %s' % (name, error)
+  folders = loader.getMailboxes()
+  if len(folders) == 0:
+    print >>sys.stderr, 'no mailboxes found'
+    sys.exit(1)
+  budget = mimestream.MessageBudget(maxBytes or None, maxSeconds or None)
+  # even with one process, so that the searches of several clients take
+  # turns (see parallel.SearchQueue)
+  pool = parallel.SearchPool(max(processes, 1), readers, depth, budget,
+                             cacheBytes)
+  worker = remote.Worker(folders, loader.getErrors(), pool)
+  print >>sys.stderr, 'serving %d mailboxes on %s' % (len(folders), address)
+  # stopped by kill as by ^C: the Unix socket is removed, the pool closed
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    worker.serve(address)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    pool.close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+import ctypes
+import ctypes.util
+import os
+import stat
+import sys
+import time
+
+try:
+  # the backport of os.scandir; without it, we stat() every entry
+  import scandir
+except ImportError:
+  scandir = None
+
+##### posix_fadvise #################################################
+
+# advice values as defined on Linux
+FADV_SEQUENTIAL = 2
+FADV_WILLNEED   = 3
+
+def _loadFadvise():
+  if hasattr(os, 'posix_fadvise'):
+    return os.posix_fadvise
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    func = libc.posix_fadvise
+  except (OSError, AttributeError):
+    return None
+  func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                   ctypes.c_int]
+  func.restype = ctypes.c_int
+  return func
+
+_fadvise = _loadFadvise()
+
+def fadvise(fd, advice, offset=0, length=0):
+  """Give the kernel a hint how the file `fd' is going to be read
+     (see posix_fadvise(2)). Does nothing where this is not available.
+     The hints are only hints: errors are ignored."""
+  if _fadvise == None:
+    return
+  try:
+    _fadvise(fd, offset, length, advice)
+  except (OSError, ctypes.ArgumentError):
+    pass
+
+def adviseWillNeed(path, length=0):
+  """Ask the kernel to start reading the file at `path' (its first
+     `length' bytes, or all of it) into the page cache, without waiting
+     for it."""
+  if _fadvise == None:
+    return
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    fadvise(fd, FADV_WILLNEED, 0, length)
+  finally:
+    os.close(fd)
+
+##### CPU time of a thread #########################################
+
+class _Timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+# CLOCK_THREAD_CPUTIME_ID, which differs between systems
+_threadClocks = { 'linux': 3, 'freebsd': 14, 'darwin': 16 }
+
+def _loadClockGettime():
+  clock = [value for (prefix, value) in _threadClocks.items()
+           if sys.platform.startswith(prefix)]
+  if len(clock) == 0:
+    return None
+  # before glibc 2.17, clock_gettime is in librt
+  for name in ('c', 'rt'):
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library(name), use_errno=True)
+      func = libc.clock_gettime
+    except (OSError, AttributeError):
+      continue
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    func.restype = ctypes.c_int
+    if func(clock[0], ctypes.byref(_Timespec())) != 0:
+      return None
+    return (func, clock[0])
+  return None
+
+_clockGettime = _loadClockGettime()
+
+def threadCpuTime():
+  """RETURNS the CPU time used by the calling thread so far, in seconds
+     (clock_gettime(CLOCK_THREAD_CPUTIME_ID)); where that is not
+     available, that of the whole process (time.clock())."""
+  if _clockGettime == None:
+    return time.clock()
+  (func, clock) = _clockGettime
+  value = _Timespec()
+  func(clock, ctypes.byref(value))
+  return value.tv_sec + value.tv_nsec * 1e-9
+
+##### directory listing #############################################
+
+# RETURN: list of (name, inode number) of the regular files in `path'
+def listFilesWithInodes(path):
+  result = []
+  if scandir != None:
+    for entry in scandir.scandir(path):
+      if entry.is_file(follow_symlinks=False):
+        result.append((entry.name, entry.inode()))
+    return result
+  for name in os.listdir(path):
+    try:
+      st = os.lstat(os.path.join(path, name))
+    except OSError:
+      # removed in the meantime
+      continue
+    if stat.S_ISREG(st.st_mode):
+      result.append((name, st.st_ino))
+  return result
@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import pickle
+import select
+import threading
+
+import expr_compile
+import headercache
+import scan
+import valuecache
+# Expr.evaluate etc. must be there in the workers
+from expr_eval import *
+
+def _workerMain(conn, readers, depth, budget, cacheSize):
+  """Body of a worker process: opens its own handles to the mailboxes
+     and their header caches, the first time it is given a part of
+     each, then serves searches until told to quit. The values kept for
+     the next searches (see valuecache) take at most `cacheSize' bytes."""
+  valueCache = None
+  if cacheSize > 0:
+    valueCache = valuecache.ValueCache(cacheSize)
+  # mailbox name -> [mailbox, header cache, search number of the last
+  #                  snapshot]
+  folders = dict()
+  # search number -> [pickled query, (query,
+  # expr_compile.CompiledQuery) once compiled] of the last searches,
+  # sent once for all the shards (see SearchPool.sendQuery), so that
+  # each shard goes on with the order of evaluation learnt on the
+  # previous ones
+  queries = dict()
+  while True:
+    request = conn.recv()
+    if request[0] == 'quit':
+      break
+    if request[0] == 'query':
+      (cmd, number, queryData) = request
+      # as SearchPool.sendQuery expects
+      if len(queries) >= SearchQueue.maxSearches:
+        del queries[min(queries)]
+      queries[number] = [queryData, None]
+      continue
+    (cmd, number, mboxName, keys) = request
+    try:
+      entry = queries[number]
+      if entry[1] == None:
+        query = pickle.loads(entry[0])
+        entry[:] = [None, (query, expr_compile.CompiledQuery(
+          query, cache=valueCache))]
+      (query, compiled) = entry[1]
+      folder = folders.get(mboxName)
+      if folder == None:
+        mbox = scan.openMailbox(mboxName)
+        folder = [mbox, headercache.HeaderCache.open(mboxName), None]
+        folders[mboxName] = folder
+      (mbox, cache, snapshotNumber) = folder
+      if snapshotNumber == None or snapshotNumber < number:
+        # catch up with the parent's snapshot (an mbox may have grown);
+        # the keys of an older one, of a search still under way (see
+        # SearchQueue), are still there, unless deleted meanwhile
+        mbox.snapshot()
+        if cache != None:
+          # the parent has just refreshed it
+          cache.attach(mbox)
+        folder[2] = number
+      scanner = scan.createScanner(mbox, cache, readers, depth, budget)
+      conn.send(('ok', scan.search(scanner, query, keys, compiled,
+                                   mboxName)))
+    except Exception, e:
+      conn.send(('error', '%s: %s' % (e.__class__.__name__, e)))
+  conn.close()
+
+def snapshotFolders(query, folders):
+  """Takes a snapshot of each mailbox and brings its header cache up to
+     date, before searching them.
+     folders - list of (mailbox name, mailbox, header cache or None)
+     RETURNS list of (mailbox name, keys of the messages `query' may
+     match), as SearchPool.search takes it"""
+  for (name, mbox, cache) in folders:
+    # the mail delivered from now on is left for the next search
+    mbox.snapshot()
+    if cache != None:
+      cache.refresh(mbox)
+  return [(name, scan.candidateKeys(mbox, query))
+          for (name, mbox, cache) in folders]
+
+def searchFolders(query, folders, pool, readers, depth, budget=None,
+                  cache=None):
+  """Searches whole mailboxes (see snapshotFolders) with `pool', or in
+     this process if it is None (`readers', `depth' and `budget' are
+     then passed to scan.createScanner, and the valuecache.ValueCache
+     `cache' is used, if any).
+     folders - list of (mailbox name, mailbox, header cache or None)
+     RETURNS iterator over (index of the part, mailbox name, keys of the
+     matching messages, keys of the messages skipped by the budget, what
+     was learnt about the order of evaluation - see
+     expr_compile.CompiledQuery.takeStatistics), as each part of the
+     mailboxes is searched; sorted by index, the parts are in the order
+     of `folders'"""
+  parts = snapshotFolders(query, folders)
+  if pool != None:
+    for result in pool.searchShards(query, parts):
+      yield result
+  else:
+    compiled = expr_compile.CompiledQuery(query, cache=cache)
+    for (index, (name, mbox, headerCache)) in enumerate(folders):
+      scanner = scan.createScanner(mbox, headerCache, readers, depth,
+                                   budget)
+      (found, overBudget, statistics) = \
+        scan.search(scanner, query, parts[index][1], compiled, name)
+      yield (index, name, found, overBudget, statistics)
+
+class SearchPool:
+  """A pool of worker processes searching mailboxes in parallel.
+     The workers are started once and stay alive for the whole session,
+     keeping open the mailboxes they have searched (for an mbox,
+     opening is cheap if its table of contents is known - see
+     MmapMbox). For a search, the keys of each mailbox are split into
+     contiguous shards, a few per worker, and the shards are handed
+     out to the workers as they become free, so that a large mailbox
+     is searched by all of them and many small ones are spread over
+     them. Only the keys of the matching messages come back.
+     `readers', `depth' and `budget' are passed to scan.createScanner
+     in the workers; each one keeps values for the next searches in a
+     valuecache.ValueCache of `cacheSize' bytes (none if 0).
+     A worker that dies (its connection is closed) is replaced by a new
+     one (see replaceWorker); the search it was at fails."""
+
+  # shards per worker, so that workers finishing early get more
+  shardsPerWorker = 4
+
+  def __init__(self, processes, readers, depth, budget=None, cacheSize=0):
+    self._workerArgs = (readers, depth, budget, cacheSize)
+    # (process, connection) of each worker
+    self._workers = [self._startWorker() for i in range(processes)]
+    self._searches = 0
+    # (mailbox name, first key of a shard) -> connection of the worker
+    # that searched it last, to be given it again (its ValueCache knows
+    # about the messages)
+    self._affinity = dict()
+    # connection -> set of the numbers of the searches whose query the
+    # worker has
+    self._queries = dict()
+
+  def _startWorker(self):
+    (parentConn, childConn) = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_workerMain,
+                                      args=(childConn,) + self._workerArgs)
+    process.daemon = True
+    process.start()
+    childConn.close()
+    return (process, parentConn)
+
+  def getSize(self):
+    return len(self._workers)
+
+  # RETURN: list of the connections to the workers
+  def getConnections(self):
+    return [conn for (process, conn) in self._workers]
+
+  # RETURN: the number of a new search; the workers take newer snapshots
+  #         of the mailboxes as the numbers grow
+  def newSearch(self):
+    self._searches += 1
+    return self._searches
+
+  def replaceWorker(self, conn):
+    """Replaces the worker at the connection `conn', which has died (its
+       connection was found closed), with a new one.
+       RETURNS (the connection to the new worker, None if it could not be
+       started - then the pool is a worker smaller; what became of the
+       old one, as an error message)"""
+    index = self.getConnections().index(conn)
+    (process, conn) = self._workers[index]
+    conn.close()
+    if process.is_alive():
+      process.terminate()
+    process.join()
+    error = 'worker process %d died (exit code %s)' % (process.pid,
+                                                       process.exitcode)
+    for (shard, owner) in self._affinity.items():
+      if owner is conn:
+        del self._affinity[shard]
+    self._queries.pop(conn, None)
+    try:
+      self._workers[index] = self._startWorker()
+    except OSError:
+      del self._workers[index]
+      return (None, error)
+    return (self._workers[index][1], error)
+
+  def sendQuery(self, conn, number, queryData):
+    """Sends `queryData', the pickled query of the search `number', to
+       the worker at `conn', unless it has it already: the shards of a
+       search sent to it after that carry only their keys. A worker
+       keeps the queries of the last SearchQueue.maxSearches searches
+       it was sent, as this expects."""
+    numbers = self._queries.setdefault(conn, set())
+    if number in numbers:
+      return
+    if len(numbers) >= SearchQueue.maxSearches:
+      numbers.remove(min(numbers))
+    conn.send(('query', number, queryData))
+    numbers.add(number)
+
+  # pending - indices in `shards' of those not handed out yet
+  # RETURN: the index of the shard for the worker `conn' to search: one
+  #         it searched last time, else one no worker did, else any
+  def takeShard(self, conn, shards, pending):
+    choice = None
+    for index in pending:
+      (mboxName, keys) = shards[index]
+      owner = self._affinity.get((mboxName, keys[0]))
+      if owner is conn:
+        choice = index
+        break
+      if owner == None and choice == None:
+        choice = index
+    if choice == None:
+      choice = pending[0]
+    pending.remove(choice)
+    (mboxName, keys) = shards[choice]
+    self._affinity[(mboxName, keys[0])] = conn
+    return choice
+
+  # folders - as for search()
+  # RETURN: list of (mailbox name, keys) of the shards to hand out to
+  #         the workers, `shardsPerWorker' for each of them (by default
+  #         SearchPool.shardsPerWorker) in all
+  def makeShards(self, folders, shardsPerWorker=None):
+    total = sum([len(keys) for (mboxName, keys) in folders])
+    parts = len(self._workers) * (shardsPerWorker or self.shardsPerWorker)
+    shardSize = max((total + parts - 1) // parts, 1)
+    shards = []
+    for (mboxName, keys) in folders:
+      for i in range(0, len(keys), shardSize):
+        shards.append((mboxName, keys[i:i+shardSize]))
+    return shards
+
+  # folders - list of (mailbox name, list of the keys of the messages
+  #           to search in it)
+  # RETURN: (list of (mailbox name, key) of the matching messages,
+  #          list of (mailbox name, key) of the messages skipped by the
+  #          budget, in the order of `folders', and what was learnt about
+  #          the order of evaluation, see expr_compile.mergeStatistics)
+  def search(self, query, folders):
+    results = list(self.searchShards(query, folders))
+    results.sort()
+    found = []
+    overBudget = []
+    statistics = None
+    for (index, mboxName, shardFound, shardOver, shardStatistics) in results:
+      found.extend([(mboxName, key) for key in shardFound])
+      overBudget.extend([(mboxName, key) for key in shardOver])
+      statistics = expr_compile.mergeStatistics(statistics, shardStatistics)
+    return (found, overBudget, statistics)
+
+  def searchShards(self, query, folders):
+    """Like search(), but hands out the results of each shard as soon as
+       it is searched.
+       RETURNS iterator over (index of the shard, mailbox name, keys of
+       the matching messages, keys of the messages skipped by the
+       budget, what was learnt about the order of evaluation); the
+       shards of `folders' are numbered in order"""
+    queryData = pickle.dumps(query, pickle.HIGHEST_PROTOCOL)
+    number = self.newSearch()
+    shards = self.makeShards(folders)
+    errors = []
+    # connection -> index of the shard it is searching
+    busy = dict()
+    pending = range(len(shards))
+    try:
+      while len(pending) > 0 or len(busy) > 0:
+        if len(self._workers) == 0:
+          errors.append('no worker processes left')
+          break
+        for conn in self.getConnections():
+          if len(pending) > 0 and not conn in busy:
+            index = self.takeShard(conn, shards, pending)
+            (mboxName, keys) = shards[index]
+            try:
+              self.sendQuery(conn, number, queryData)
+              conn.send(('search', number, mboxName, keys))
+            except IOError:
+              # died while idle
+              errors.append(self.replaceWorker(conn)[1])
+              continue
+            busy[conn] = index
+        if len(busy) == 0:
+          continue
+        (ready, w, x) = select.select(busy.keys(), [], [])
+        for conn in ready:
+          index = busy.pop(conn)
+          try:
+            (status, result) = conn.recv()
+          except (EOFError, IOError):
+            (status, result) = ('error', self.replaceWorker(conn)[1])
+          if status == 'ok':
+            yield (index, shards[index][0]) + result
+          else:
+            errors.append(result)
+    finally:
+      # if the caller stopped early, the answers still on the way must
+      # not be taken for those of the next search
+      for conn in busy:
+        try:
+          conn.recv()
+        except (EOFError, IOError):
+          self.replaceWorker(conn)
+    if len(errors) > 0:
+      raise BaseException("Search failed: "+errors[0])
+
+  def close(self):
+    for (process, conn) in self._workers:
+      try:
+        conn.send(('quit',))
+      except IOError:
+        pass
+      conn.close()
+    for (process, conn) in self._workers:
+      process.join()
+    self._workers = []
+    self._queries = dict()
+
+class _Search:
+  """A search under way in a SearchQueue."""
+
+  def __init__(self, number, queryData, shards, listener, cancelled):
+    self.number = number
+    self.queryData = queryData
+    self.shards = shards
+    self.listener = listener
+    self.cancelled = cancelled
+    # indices of the shards not handed out yet
+    self.pending = range(len(shards))
+    # number of shards being searched
+    self.inFlight = 0
+    self.failed = False
+
+  def isDropped(self):
+    return self.failed or self.cancelled.isSet()
+
+class SearchQueue(threading.Thread):
+  """Runs the searches of several clients at once on a SearchPool (see
+     remote.Worker). The workers are shared between the searches under
+     way: a worker getting free takes a shard of the search that has the
+     fewest being searched, so that a short search is not kept waiting
+     behind a long one (only until a worker finishes a shard; they are
+     smaller than those of SearchPool.search for that). A cancelled
+     search is dropped at once, but for the shards being searched, whose
+     results are thrown away.
+     The pool is used by this thread only, SearchPool.search must not be
+     called any more."""
+
+  shardsPerWorker = 16
+  # searches a worker remembers the compiled query of
+  maxSearches = 8
+
+  def __init__(self, pool):
+    threading.Thread.__init__(self, name='SearchQueue')
+    self.daemon = True
+    self._pool = pool
+    self._lock = threading.Lock()
+    # searches submitted, not yet seen by the thread
+    self._submitted = []
+    # written to when something is submitted, to wake the thread up
+    (self._wakeRead, self._wakeWrite) = os.pipe()
+
+  # query     - the query
+  # folders   - as for SearchPool.search; the mailboxes must have been
+  #             prepared just before (see snapshotFolders)
+  # listener  - called, in this thread, with ('part', index of the part,
+  #             mailbox name, keys found, keys skipped by the budget,
+  #             what was learnt about the order of evaluation) for each
+  #             part searched, then with ('done',), or with
+  #             ('error', text) if the search failed; not at all after
+  #             the search is cancelled
+  # cancelled - threading.Event, set to cancel the search
+  def submit(self, query, folders, listener, cancelled):
+    queryData = pickle.dumps(query, pickle.HIGHEST_PROTOCOL)
+    shards = self._pool.makeShards(folders, self.shardsPerWorker)
+    self._lock.acquire()
+    try:
+      self._submitted.append(_Search(self._pool.newSearch(), queryData,
+                                     shards, listener, cancelled))
+    finally:
+      self._lock.release()
+    os.write(self._wakeWrite, 'x')
+
+  def _takeSubmitted(self):
+    os.read(self._wakeRead, 4096)
+    self._lock.acquire()
+    try:
+      submitted = self._submitted
+      self._submitted = []
+    finally:
+      self._lock.release()
+    return submitted
+
+  def run(self):
+    free = self._pool.getConnections()
+    # connection -> (search, index of the shard it is searching)
+    busy = dict()
+    # searches with shards left to hand out
+    waiting = []
+    while True:
+      (ready, w, x) = select.select([self._wakeRead] + busy.keys(), [], [])
+      for conn in ready:
+        if conn == self._wakeRead:
+          for search in self._takeSubmitted():
+            if len(search.shards) > 0:
+              waiting.append(search)
+            elif not search.isDropped():
+              search.listener(('done',))
+          continue
+        (search, index) = busy.pop(conn)
+        search.inFlight -= 1
+        try:
+          (status, result) = conn.recv()
+          free.append(conn)
+        except (EOFError, IOError):
+          (status, result) = ('error', self._replaceWorker(conn, free))
+        if search.isDropped():
+          continue
+        if status == 'ok':
+          search.listener(('part', index, search.shards[index][0]) +
+                          result)
+          if len(search.pending) == 0 and search.inFlight == 0:
+            search.listener(('done',))
+        else:
+          self._fail(search, result)
+      waiting = [search for search in waiting if not search.isDropped()]
+      if len(self._pool.getConnections()) == 0:
+        for search in waiting:
+          self._fail(search, 'no worker processes left')
+        waiting = []
+      while len(free) > 0 and len(waiting) > 0:
+        search = min(waiting,
+                     key=lambda search: (search.inFlight, search.number))
+        conn = free.pop()
+        index = self._pool.takeShard(conn, search.shards, search.pending)
+        (mboxName, keys) = search.shards[index]
+        if len(search.pending) == 0:
+          waiting.remove(search)
+        try:
+          self._pool.sendQuery(conn, search.number, search.queryData)
+          conn.send(('search', search.number, mboxName, keys))
+        except IOError:
+          # died while idle
+          self._fail(search, self._replaceWorker(conn, free))
+          waiting = [search for search in waiting if not search.isDropped()]
+          continue
+        busy[conn] = (search, index)
+        search.inFlight += 1
+
+  # RETURN: what became of the worker at `conn', found dead, having put
+  #         the one replacing it, if any, in `free'
+  def _replaceWorker(self, conn, free):
+    (newConn, error) = self._pool.replaceWorker(conn)
+    if newConn != None:
+      free.append(newConn)
+    return error
+
+  def _fail(self, search, error):
+    search.failed = True
+    search.listener(('error', 'Search failed: '+error))
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Searching the mailboxes of other hosts: a worker (see mossworker.py)
+# serves the mailboxes of its host, and the program asks it to search
+# them along with its own (see Engine).
+#
+# The protocol is a line of JSON for each request, and lines of JSON
+# coming back until the last one of the answer:
+#   {"cmd": "list"}
+#     -> {"mailboxes": [name, ...], "errors": [[name, error], ...]}
+#   {"cmd": "search", "query": Expr.toData()}
+#     -> {"part": n, "mailbox": name, "found": [key, ...],
+#         "skipped": [key, ...], "statistics": ...}
+#                                          for each part searched
+#     -> {"done": true}
+#   {"cmd": "get", "mailbox": name, "key": key}
+#     -> {"message": the message, base64-encoded} or {"gone": true}
+#   {"cmd": "cancel"}   while a search or get is under way
+#     -> {"cancelled": true}
+# Any request may also be answered with {"error": text}. A request is
+# also cancelled when the connection is closed before it is over. The parts of a
+# search come as they are searched; sorted by "part", they are in the
+# order of the mailboxes, as the keys in each of them.
+#
+# There is no authentication: a worker should listen on a Unix socket,
+# on localhost or on a trusted network only.
+
+import Queue
+import base64
+import email
+import json
+import os
+import select
+import socket
+import SocketServer
+import stat
+import threading
+
+import expr_compile
+import expr_wire
+import headercache
+import parallel
+import snapshotmaildir
+
+# requests longer than this are refused
+maxRequest = 16 << 20
+
+# RETURN: socket connected to `address', 'host:port' or the path of a
+#         Unix socket (anything with a '/')
+def connect(address, timeout=None):
+  if '/' in address:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(address)
+    return sock
+  (host, port) = _splitAddress(address)
+  return socket.create_connection((host, port), timeout)
+
+def _splitAddress(address):
+  (host, sep, port) = address.rpartition(':')
+  if sep == '' or not port.isdigit():
+    raise BaseException("Invalid address (host:port expected): " + address)
+  return (host or 'localhost', int(port))
+
+##### Server ########################################################
+
+class _Replies:
+  """The replies to a request, passed from the thread making them to
+     the one sending them. fileno() becomes readable when there are
+     some, for select(). Once closed, more replies are dropped."""
+
+  def __init__(self):
+    self._queue = Queue.Queue()
+    self._lock = threading.Lock()
+    (self._read, self._write) = os.pipe()
+
+  def put(self, reply):
+    self._lock.acquire()
+    try:
+      if self._write != None:
+        self._queue.put(reply)
+        os.write(self._write, 'x')
+    finally:
+      self._lock.release()
+
+  def fileno(self):
+    return self._read
+
+  # RETURN: the next reply; call when fileno() is readable
+  def get(self):
+    os.read(self._read, 1)
+    return self._queue.get()
+
+  def close(self):
+    self._lock.acquire()
+    try:
+      os.close(self._read)
+      os.close(self._write)
+      self._write = None
+    finally:
+      self._lock.release()
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+  # nothing is read ahead, so that select() sees whatever the client
+  # sends while its search is under way
+  rbufsize = 0
+
+  def handle(self):
+    while True:
+      line = self.rfile.readline(maxRequest)
+      if line == '':
+        break
+      if not line.endswith('\n'):
+        self._send({'error': 'request too long'})
+        break
+      try:
+        request = json.loads(line)
+        cmd = request['cmd']
+      except (ValueError, TypeError, KeyError):
+        self._send({'error': 'invalid request'})
+        break
+      if cmd == 'list':
+        self._send(self.server.worker.list())
+      elif cmd in ('search', 'get'):
+        if not self._serve(request):
+          break
+      elif cmd == 'cancel':
+        # nothing under way
+        self._send({'cancelled': True})
+      else:
+        self._send({'error': 'unknown command: %s' % cmd})
+
+  # RETURN: False if the client has gone
+  def _serve(self, request):
+    replies = _Replies()
+    cancelled = threading.Event()
+    try:
+      self.server.worker.submit(request, replies, cancelled)
+      while True:
+        (ready, w, x) = select.select([self.connection, replies], [], [])
+        if self.connection in ready:
+          # whatever comes now, a 'cancel' or the end of the connection,
+          # cancels the request
+          cancelled.set()
+          if self.rfile.readline(maxRequest) == '':
+            return False
+          self._send({'cancelled': True})
+          return True
+        reply = replies.get()
+        self._send(reply)
+        if not 'part' in reply:
+          return True
+    finally:
+      cancelled.set()
+      replies.close()
+
+  def _send(self, reply):
+    self.wfile.write(json.dumps(reply) + '\n')
+    self.wfile.flush()
+
+class _TcpServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+class Worker:
+  """Serves the mailboxes of this host to other hosts, or to the users
+     of this one (see serve()), keeping them open - with their header
+     caches, tables of contents etc. - for as long as it runs.
+     Each client has a thread of its own, and many clients may search at
+     once, on `pool' (parallel.SearchPool, see parallel.SearchQueue).
+     Before each search, a snapshot of the mailboxes is taken, by a
+     thread of its own that takes the requests in turn: the mailboxes
+     are only touched by this one, which also owns the header caches (an
+     SQLite connection cannot be shared between threads), keeping them
+     warm from one search to the next.
+     A request is cancelled when its client sends anything, a 'cancel'
+     or another request, before it is over, or when the client goes."""
+
+  # folders - list of (name, mailbox), as given by
+  #           mboxloader.MailboxLoader
+  # errors  - list of (name, error) of the mailboxes that could not be
+  #           opened, to be reported to the clients
+  def __init__(self, folders, errors, pool):
+    self._folders = folders
+    self._errors = errors
+    self._queue = parallel.SearchQueue(pool)
+    self._queue.start()
+    self._requests = Queue.Queue()
+    self._preparer = threading.Thread(target=self._run, name='Preparer')
+    self._preparer.daemon = True
+    self._preparer.start()
+
+  def list(self):
+    return {'mailboxes': [name for (name, mbox) in self._folders],
+            'errors': [[name, error] for (name, error) in self._errors]}
+
+  # request   - a 'search' or 'get' request, see the top of this file
+  # replies   - gets the replies (has put())
+  # cancelled - threading.Event, set when the request is cancelled
+  def submit(self, request, replies, cancelled):
+    self._requests.put((request, replies, cancelled))
+
+  def _run(self):
+    folders = [(name, mbox, headercache.HeaderCache.open(name))
+               for (name, mbox) in self._folders]
+    mailboxes = dict([(name, mbox) for (name, mbox) in self._folders])
+    while True:
+      (request, replies, cancelled) = self._requests.get()
+      if cancelled.isSet():
+        continue
+      try:
+        if request['cmd'] == 'search':
+          self._search(folders, expr_wire.exprFromData(request['query']),
+                       replies, cancelled)
+        else:
+          self._get(mailboxes, request['mailbox'], request['key'], replies)
+      except BaseException, e:
+        replies.put({'error': '%s: %s' % (e.__class__.__name__, e)})
+
+  def _search(self, folders, query, replies, cancelled):
+    if not query.isComplete():
+      raise BaseException("Incomplete query")
+    parts = parallel.snapshotFolders(query, folders)
+    def listener(event):
+      if event[0] == 'part':
+        (what, index, name, found, overBudget, statistics) = event
+        replies.put({'part': index, 'mailbox': name,
+                     'found': found, 'skipped': overBudget,
+                     'statistics': statistics})
+      elif event[0] == 'done':
+        replies.put({'done': True})
+      else:
+        replies.put({'error': event[1]})
+    self._queue.submit(query, parts, listener, cancelled)
+
+  def _get(self, mailboxes, name, key, replies):
+    mbox = mailboxes.get(name)
+    if mbox == None:
+      raise BaseException("No such mailbox: %s" % name)
+    try:
+      f = mbox.get_file(key)
+    except KeyError:
+      # also snapshotmaildir.MessageGone
+      replies.put({'gone': True})
+      return
+    try:
+      raw = f.read()
+    finally:
+      f.close()
+    replies.put({'message': base64.b64encode(raw)})
+
+  def serve(self, address):
+    """Serves the clients connecting to `address' (see connect()) until
+       interrupted. A Unix socket left by an earlier worker is
+       replaced."""
+    if '/' in address:
+      if os.path.exists(address) and \
+         stat.S_ISSOCK(os.stat(address).st_mode):
+        os.remove(address)
+      server = _UnixServer(address, _Handler)
+    else:
+      server = _TcpServer(_splitAddress(address), _Handler)
+    server.worker = self
+    try:
+      server.serve_forever()
+    finally:
+      server.server_close()
+      if '/' in address:
+        os.remove(address)
+
+##### Client ########################################################
+
+class RemoteWorker:
+  """A worker on another host (or in another process of this one),
+     seen from the program. Each request is made on a new connection,
+     so that a worker may be restarted between them."""
+
+  # seconds to wait for the worker to accept a connection
+  connectTimeout = 10
+
+  def __init__(self, address):
+    self._address = address
+
+  def getAddress(self):
+    return self._address
+
+  # RETURN: the name the program gives to the mailbox `name' of the
+  #         worker, to tell it from the mailboxes of this host
+  def qualify(self, name):
+    return '%s@%s' % (name, self._address)
+
+  # RETURN: iterator over the replies to `request'
+  def _call(self, request):
+    sock = connect(self._address, self.connectTimeout)
+    try:
+      # a search may take long
+      sock.settimeout(None)
+      sock.sendall(json.dumps(request) + '\n')
+      replies = sock.makefile('rb')
+      while True:
+        line = replies.readline()
+        if line == '':
+          raise BaseException("Connection closed by the worker")
+        reply = json.loads(line)
+        if 'error' in reply:
+          raise BaseException(reply['error'])
+        yield reply
+        if not 'part' in reply:
+          break
+    finally:
+      sock.close()
+
+  # RETURN: (list of the names of the mailboxes of the worker,
+  #          list of (name, why it could not be opened))
+  def listMailboxes(self):
+    for reply in self._call({'cmd': 'list'}):
+      return (reply['mailboxes'],
+              [tuple(error) for error in reply['errors']])
+
+  def search(self, query):
+    """Searches all the mailboxes of the worker.
+       RETURNS iterator over (index of the part, mailbox name, keys of
+       the matching messages, keys of the messages skipped by the
+       budget, what was learnt about the order of evaluation), as in
+       parallel.searchFolders; closing it before the end cancels the
+       search"""
+    for reply in self._call({'cmd': 'search', 'query': query.toData()}):
+      if 'part' in reply:
+        yield (reply['part'], reply['mailbox'], reply['found'],
+               reply['skipped'], reply['statistics'])
+
+  # RETURN: email.message.Message;
+  #         raises snapshotmaildir.MessageGone if it is not there any more
+  def getMessage(self, name, key):
+    for reply in self._call({'cmd': 'get', 'mailbox': name, 'key': key}):
+      if 'gone' in reply:
+        raise snapshotmaildir.MessageGone(key)
+      return email.message_from_string(base64.b64decode(reply['message']))
+
+class RemoteMailbox:
+  """A mailbox of a worker, enough of it for 'show'."""
+
+  def __init__(self, worker, name):
+    self._worker = worker
+    self._name = name
+
+  def get_message(self, key):
+    return self._worker.getMessage(self._name, key)
+
+class RemoteSearch(threading.Thread):
+  """A search by a worker, run in a thread of its own while the program
+     searches its own mailboxes. After join(), getResults() tells what
+     was found."""
+
+  def __init__(self, worker, query):
+    threading.Thread.__init__(self, name='RemoteSearch')
+    self.daemon = True
+    self._worker = worker
+    self._query = query
+    self._parts = []
+    self._error = None
+
+  def run(self):
+    try:
+      self._parts = list(self._worker.search(self._query))
+    except BaseException, e:
+      self._error = '%s: %s' % (e.__class__.__name__, e)
+
+  def getWorker(self):
+    return self._worker
+
+  # RETURN: (list of (mailbox name, key) of the matching messages,
+  #          list of (mailbox name, key) of the messages skipped by the
+  #          budget, what was learnt about the order of evaluation (see
+  #          expr_compile.mergeStatistics), error or None); the names are
+  #          qualified (see RemoteWorker.qualify)
+  def getResults(self):
+    self._parts.sort()
+    found = []
+    overBudget = []
+    statistics = None
+    for (index, name, partFound, partOver, partStatistics) in self._parts:
+      name = self._worker.qualify(name)
+      found.extend([(name, key) for key in partFound])
+      overBudget.extend([(name, key) for key in partOver])
+      statistics = expr_compile.mergeStatistics(statistics, partStatistics)
+    return (found, overBudget, statistics, self._error)
@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+import cStringIO
+import email
+import email.parser
+import mailbox
+import os
+import sys
+import threading
+
+import compressedmbox
+import emailextra
+import expr_compile
+import expr_imap
+import headercache
+import imapmbox
+import mimestream
+import mmapmbox
+import osextra
+import snapshotmaildir
+import valuecache
+from expr_eval import MsgNeeds
+
+def openMailbox(mboxName):
+  """Opens the Maildir or the single-file mbox at `mboxName'. An mbox
+     named *.gz, *.bz2, *.xz or *.zst is read compressed. An imap:// or
+     imaps:// URL names a folder on an IMAP server (see ImapMailbox).
+     All of them have snapshot(), to be called before each search: the
+     search sees the mailbox as it was then, however mail is delivered
+     meanwhile (see SnapshotMaildir and MmapMbox)."""
+  if imapmbox.isImapUrl(mboxName):
+    return imapmbox.ImapMailbox(mboxName)
+  elif os.path.isdir(mboxName):
+    return snapshotmaildir.SnapshotMaildir(mboxName, None)
+  elif compressedmbox.compressionOf(mboxName) != None:
+    return compressedmbox.CompressedMbox(mboxName)
+  else:
+    return mmapmbox.MmapMbox(mboxName)
+
+def _isMaildir(path):
+  for subdir in ('cur', 'new', 'tmp'):
+    if not os.path.isdir(os.path.join(path, subdir)):
+      return False
+  return True
+
+def _isMbox(path):
+  if compressedmbox.compressionOf(path) != None:
+    # not every .gz is an mbox (e.g. a .tar.gz)
+    try:
+      start = compressedmbox.readStart(path, 5)
+    except Exception:
+      # unreadable, or not compressed as its name says
+      return False
+    # None: it cannot be decompressed here; opening it will tell why
+    return start in (None, 'From ')
+  try:
+    f = open(path, 'rb')
+  except IOError:
+    return False
+  try:
+    return f.read(5) == 'From '
+  finally:
+    f.close()
+
+def findMailboxes(paths):
+  """The mailboxes named by `paths' (see openMailbox), where a directory
+     that is not a Maildir stands for all the Maildirs and mbox files
+     under it (an mbox file is recognized by its first 'From ' line,
+     also when compressed),
+     and a Maildir also for its Maildir++ subfolders ('.Name'
+     directories in it).
+     RETURNS list of names for openMailbox"""
+  names = []
+  for path in paths:
+    if imapmbox.isImapUrl(path) or not os.path.isdir(path):
+      names.append(path)
+      continue
+    found = []
+    for (dirpath, dirnames, filenames) in os.walk(path):
+      if _isMaildir(dirpath):
+        found.append(dirpath)
+      # nothing but messages below these
+      dirnames[:] = [name for name in dirnames
+                     if not name in ('cur', 'new', 'tmp')]
+      for name in filenames:
+        if not name.endswith('.moss-cache') and \
+           not name.endswith('.moss-toc') and \
+           _isMbox(os.path.join(dirpath, name)):
+          found.append(os.path.join(dirpath, name))
+    found.sort()
+    names.extend(found)
+  return names
+
+def maildirListing(mbox):
+  """Lists the messages of the Maildir `mbox' sorted by inode number.
+     On most file systems this follows the position of the files on
+     disk much better than the (hash) order of the directory, so
+     reading in this order goes mostly forward instead of at random.
+     RETURNS list of (inode, key, path)"""
+  if isinstance(mbox, snapshotmaildir.SnapshotMaildir):
+    return mbox.listing()
+  entries = []
+  for subdir in ('new', 'cur'):
+    path = os.path.join(mbox._path, subdir)
+    for (name, inode) in osextra.listFilesWithInodes(path):
+      entries.append((inode, name.split(mbox.colon)[0],
+                      os.path.join(path, name)))
+  entries.sort()
+  return entries
+
+def orderedKeys(mbox):
+  """The keys of all messages in `mbox', in the order it is best to read
+     them: by inode for a Maildir, by position for an mbox."""
+  if isinstance(mbox, mailbox.Maildir):
+    return [key for (inode, key, path) in maildirListing(mbox)]
+  return mbox.keys()
+
+def candidateKeys(mbox, query):
+  """The keys of the messages `query' may match, in the order of
+     orderedKeys: all of them, except for an IMAP mailbox, where the
+     server leaves out those that do not meet the criteria implied by
+     the query (see expr_imap)."""
+  if isinstance(mbox, imapmbox.ImapMailbox):
+    criteria = query.getImapSearch(dict(), mbox.searchesHeaders())
+    if criteria != None:
+      return mbox.search(criteria)
+  return orderedKeys(mbox)
+
+class Scanner:
+  """Goes over the messages of a mailbox for a search, loading from
+     each message only as much as the query needs (see Expr.getNeeds):
+       MsgNeeds.Nothing   - nothing at all (the message is None)
+       MsgNeeds.Headers   - the header section only
+       MsgNeeds.Structure,
+       MsgNeeds.Full      - the whole message (the email package cannot
+                            give the MIME structure without the bodies)
+     If there is a header cache, messages are handed out as
+     CachedMessage, which reads the file only when really needed.
+     Maildirs are read in inode order (see maildirListing), and the
+     kernel is asked to start reading the files of the next few
+     messages before they are needed.
+     Messages deleted since the snapshot of the mailbox was taken are
+     skipped (see search()).
+     With a `budget' (mimestream.MessageBudget), large messages are only
+     streamed over, never kept in memory, and messages that take too
+     long to read are skipped and listed by getOverBudget()."""
+
+  # how many messages ahead to ask the kernel for
+  hintDistance = 16
+  # for header-only queries, only this much of each file is asked for
+  hintHeaderBytes = 65536
+
+  def __init__(self, mbox, headerCache, budget=None):
+    self._mbox = mbox
+    self._headerCache = headerCache
+    self._budget = budget
+    # Maildir key -> path of the file, for the hints
+    self._paths = dict()
+    # keys of the messages skipped by the budget
+    self._overBudget = []
+
+  def load(self, key, needs):
+    if needs == MsgNeeds.Nothing:
+      return None
+    if self._headerCache != None and self._headerCache.hasKey(key):
+      return headercache.CachedMessage(self._headerCache, self._mbox, key,
+                                       budget=self._budget)
+    if needs == MsgNeeds.Headers:
+      return emailextra.MessageContext(emailextra.loadHeaders(self._mbox, key))
+    return emailextra.MessageContext(
+      mimestream.loadMessage(self._mbox, key, self._budget))
+
+  def getMailbox(self):
+    return self._mbox
+
+  def overBudget(self, key):
+    """Notes that the message `key' was skipped (BudgetExceeded)."""
+    self._overBudget.append(key)
+
+  # RETURN: list of the keys of the messages skipped so far because they
+  #         took longer to read than the budget allows
+  def getOverBudget(self):
+    return self._overBudget
+
+  def _orderedKeys(self):
+    if isinstance(self._mbox, mailbox.Maildir):
+      listing = maildirListing(self._mbox)
+      self._paths = dict((key, path) for (inode, key, path) in listing)
+      return [key for (inode, key, path) in listing]
+    return self._mbox.keys()
+
+  def _hint(self, key, needs):
+    if needs == MsgNeeds.Nothing or \
+       not isinstance(self._mbox, mailbox.Maildir):
+      return
+    if needs == MsgNeeds.Headers and self._headerCache != None and \
+       self._headerCache.hasKey(key):
+      return
+    path = self._paths.get(key)
+    if path == None:
+      # not listed by us (keys given by the caller)
+      subpath = self._mbox._toc.get(key)
+      if subpath == None:
+        return
+      path = os.path.join(self._mbox._path, subpath)
+    if needs == MsgNeeds.Headers:
+      osextra.adviseWillNeed(path, self.hintHeaderBytes)
+    else:
+      osextra.adviseWillNeed(path)
+
+  # keys - the keys to go over (default: all messages in the mailbox,
+  #        see orderedKeys)
+  # RETURN: iterator over (key, message)
+  def scan(self, needs, keys=None):
+    if keys == None:
+      keys = self._orderedKeys()
+    else:
+      keys = list(keys)
+    for key in keys[:self.hintDistance]:
+      self._hint(key, needs)
+    for i in range(len(keys)):
+      if i + self.hintDistance < len(keys):
+        self._hint(keys[i + self.hintDistance], needs)
+      try:
+        message = self.load(keys[i], needs)
+      except snapshotmaildir.MessageGone:
+        # deleted since the snapshot: it matches nothing any more
+        continue
+      except mimestream.BudgetExceeded:
+        self.overBudget(keys[i])
+        continue
+      yield (keys[i], message)
+
+def search(scanner, query, keys=None, compiled=None, mboxName=None):
+  """Evaluates `query' on the messages handed out by `scanner' (all of
+     them, or those with the given keys), compiled first (see
+     expr_compile) - unless `compiled', its expr_compile.CompiledQuery,
+     is given, to go on with the order of evaluation it has learnt on
+     other messages, or to use a valuecache.ValueCache; `mboxName', the
+     name of the mailbox, is needed then.
+     RETURNS (list of the keys of the matching messages,
+              list of the keys of the messages skipped by the budget,
+              what was learnt about the order of evaluation, see
+              CompiledQuery.takeStatistics)"""
+  if keys == None and isinstance(scanner.getMailbox(), imapmbox.ImapMailbox):
+    keys = candidateKeys(scanner.getMailbox(), query)
+  if compiled == None:
+    compiled = expr_compile.CompiledQuery(query)
+  matches = compiled.matches
+  cached = mboxName != None
+  mbox = scanner.getMailbox()
+  found = []
+  # the simplified query may need less
+  for (key, message) in scanner.scan(compiled.query.getNeeds(), keys):
+    try:
+      if cached and message != None and \
+         compiled.usesCache(message.headersCached):
+        message.memoKey = valuecache.messageKey(mboxName, mbox, key,
+                                                message)
+      if matches(message):
+        found.append(key)
+    except snapshotmaildir.MessageGone:
+      # a CachedMessage found the message deleted when it needed more
+      # than the headers
+      continue
+    except mimestream.BudgetExceeded:
+      # ... or too long to read
+      scanner.overBudget(key)
+  return (found, scanner.getOverBudget(), compiled.takeStatistics())
+
+def createScanner(mbox, headerCache, readers, depth, budget=None):
+  """Returns a PipelinedScanner with `readers' reader threads and at
+     most `depth' messages read ahead, or a plain Scanner if `readers'
+     is 0. `budget' is passed on to the scanner. For an IMAP mailbox,
+     an ImapScanner with `readers' connections (by default
+     ImapScanner.connections)."""
+  if isinstance(mbox, imapmbox.ImapMailbox):
+    return ImapScanner(mbox, readers or ImapScanner.connections, depth,
+                       budget)
+  if readers > 0:
+    return PipelinedScanner(mbox, headerCache, readers, depth, budget)
+  return Scanner(mbox, headerCache, budget)
+
+# _readRaw's result for a message larger than budget.maxBytes
+_oversized = object()
+
+class PipelinedScanner(Scanner):
+  """A Scanner that reads messages ahead of the parsing and evaluation.
+     A few reader threads fetch the raw text of the next messages (only
+     the header section if that is all the query needs) while the
+     calling thread parses and evaluates the previous ones, so the CPU
+     does not sit idle while waiting for the disk. At most `depth'
+     messages are read but not yet consumed; the readers wait when this
+     many are ahead. Messages are still handed out in mailbox order.
+     Parsing stays in the calling thread: with the GIL, a separate
+     parsing thread would not run in parallel with the evaluation.
+     The readers take the place of the kernel hints of Scanner.
+     Messages larger than budget.maxBytes are read only up to that size
+     by the readers, then streamed over in the calling thread."""
+
+  def __init__(self, mbox, headerCache, readers, depth, budget=None):
+    Scanner.__init__(self, mbox, headerCache, budget)
+    self._readers = readers
+    self._depth = depth
+
+  def _cached(self, key):
+    return self._headerCache != None and self._headerCache.hasKey(key)
+
+  def _readRaw(self, key, needs):
+    if needs == MsgNeeds.Nothing:
+      return None
+    if needs == MsgNeeds.Headers:
+      if self._cached(key):
+        return None
+      return emailextra.loadHeaderString(self._mbox, key)
+    f = self._mbox.get_file(key)
+    try:
+      if self._budget == None or self._budget.maxBytes == None:
+        return f.read()
+      raw = f.read(self._budget.maxBytes + 1)
+      if len(raw) > self._budget.maxBytes:
+        return _oversized
+      return raw
+    finally:
+      f.close()
+
+  def _parseRaw(self, key, raw, needs):
+    if needs == MsgNeeds.Nothing:
+      return None
+    if needs == MsgNeeds.Headers:
+      if raw == None:
+        return headercache.CachedMessage(self._headerCache, self._mbox, key,
+                                         budget=self._budget)
+      return emailextra.MessageContext(
+        email.parser.HeaderParser().parsestr(raw))
+    if self._budget == None:
+      message = email.message_from_string(raw)
+    elif raw is _oversized:
+      message = mimestream.loadSkeleton(self._mbox, key, self._budget)
+    else:
+      message = mimestream.parseMessage(cStringIO.StringIO(raw),
+                                        self._budget, self._budget.start())
+    if self._cached(key):
+      return headercache.CachedMessage(self._headerCache, self._mbox, key,
+                                       message, self._budget)
+    return emailextra.MessageContext(message)
+
+  def scan(self, needs, keys=None):
+    if keys == None:
+      keys = self._orderedKeys()
+    else:
+      keys = list(keys)
+    prefetcher = _Prefetcher(lambda key: self._readRaw(key, needs),
+                             keys, self._readers, self._depth)
+    try:
+      for i in range(len(keys)):
+        try:
+          message = self._parseRaw(keys[i], prefetcher.get(i), needs)
+        except snapshotmaildir.MessageGone:
+          continue
+        except mimestream.BudgetExceeded:
+          self.overBudget(keys[i])
+          continue
+        yield (keys[i], message)
+    finally:
+      prefetcher.stop()
+
+class ImapScanner(PipelinedScanner):
+  """A Scanner for an IMAP mailbox (imapmbox.ImapMailbox): messages are
+     fetched in batches over a few connections at once (see
+     ImapMailbox.fetch), only the items the query needs:
+       MsgNeeds.Headers   - the header section
+       MsgNeeds.Structure - the header section and BODYSTRUCTURE, of
+                            which a SkeletonPart is made
+       MsgNeeds.Full      - the whole message
+     With a `budget', a message larger than budget.maxBytes is still
+     sent whole by the server, but only streamed over after that."""
+
+  # default number of connections
+  connections = 4
+
+  _items = { MsgNeeds.Headers: 'BODY.PEEK[HEADER]',
+             MsgNeeds.Structure: 'BODY.PEEK[HEADER] BODYSTRUCTURE',
+             MsgNeeds.Full: 'BODY.PEEK[]' }
+
+  def __init__(self, mbox, connections, depth, budget=None):
+    PipelinedScanner.__init__(self, mbox, None, connections, depth, budget)
+
+  def _parseFetched(self, key, items, needs):
+    if needs == MsgNeeds.Headers:
+      return emailextra.MessageContext(
+        email.parser.HeaderParser().parsestr(items['BODY[HEADER]']))
+    if needs == MsgNeeds.Structure:
+      return emailextra.MessageContext(
+        imapmbox.structureMessage(items['BODY[HEADER]'],
+                                  items['BODYSTRUCTURE']))
+    raw = items['BODY[]']
+    if self._budget != None and self._budget.maxBytes != None and \
+       len(raw) > self._budget.maxBytes:
+      return emailextra.MessageContext(
+        mimestream.parseSkeleton(cStringIO.StringIO(raw), self._budget,
+                                 self._budget.start()))
+    return self._parseRaw(key, raw, needs)
+
+  def scan(self, needs, keys=None):
+    if keys == None:
+      keys = self._orderedKeys()
+    else:
+      keys = list(keys)
+    if needs == MsgNeeds.Nothing:
+      for key in keys:
+        yield (key, None)
+      return
+    for (key, items) in self._mbox.fetch(keys, self._items[needs],
+                                         self._readers, self._depth):
+      if items == None:
+        # deleted since the snapshot
+        continue
+      try:
+        message = self._parseFetched(key, items, needs)
+      except mimestream.BudgetExceeded:
+        self.overBudget(key)
+        continue
+      yield (key, message)
+
+class _Prefetcher:
+  """Calls `read' on the items of `keys' on several threads, keeping at
+     most `depth' results that have not been taken with get()."""
+
+  def __init__(self, read, keys, threads, depth):
+    self._read = read
+    self._keys = keys
+    self._lock = threading.Lock()
+    self._ready = threading.Condition(self._lock)
+    # free places for results; a reader takes one before reading
+    self._slots = threading.Semaphore(depth)
+    # index of the next key to be read
+    self._next = 0
+    # index -> (result, exception info or None)
+    self._done = dict()
+    self._stopped = False
+    self._threads = []
+    for i in range(threads):
+      thread = threading.Thread(target=self._run)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _run(self):
+    while True:
+      self._slots.acquire()
+      self._lock.acquire()
+      try:
+        if self._stopped or self._next >= len(self._keys):
+          # let the other readers find out, too
+          self._slots.release()
+          return
+        index = self._next
+        self._next += 1
+      finally:
+        self._lock.release()
+      try:
+        result = (self._read(self._keys[index]), None)
+      except Exception:
+        result = (None, sys.exc_info())
+      self._lock.acquire()
+      try:
+        self._done[index] = result
+        self._ready.notifyAll()
+      finally:
+        self._lock.release()
+
+  # RETURN: the result for keys[index]; raises what `read' raised
+  def get(self, index):
+    self._lock.acquire()
+    try:
+      while not index in self._done:
+        self._ready.wait()
+      (result, excInfo) = self._done.pop(index)
+    finally:
+      self._lock.release()
+    self._slots.release()
+    if excInfo != None:
+      raise excInfo[0], excInfo[1], excInfo[2]
+    return result
+
+  def stop(self):
+    self._lock.acquire()
+    self._stopped = True
+    self._lock.release()
+    # wake up the readers waiting for a place
+    for thread in self._threads:
+      self._slots.release()
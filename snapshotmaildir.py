@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import mailbox
+import os
+
+import osextra
+
+class MessageGone(KeyError):
+  """The message is not in the mailbox any more (deleted after the
+     snapshot was taken)."""
+
+class SnapshotMaildir(mailbox.Maildir):
+  """A Maildir that is read from a snapshot of its directory listing,
+     so that it can be searched while mail is being delivered.
+     - new/ and cur/ are listed once, by snapshot(). Messages delivered
+       later are not seen until the next snapshot(); mailbox.Maildir
+       would list the directories again on every keys(), len() or
+       unknown key, in the middle of a search.
+     - Messages are read by their name in the snapshot. If the file is
+       not there any more (moved from new/ to cur/, or its flags were
+       changed), the directories are listed once more to find it under
+       its new name. If it is gone for good, MessageGone (a KeyError)
+       is raised.
+     - Keys come in the order of the inode numbers of the files (see
+       scan.maildirListing).
+     Nothing is ever locked."""
+
+  def __init__(self, dirname, factory=None, create=True):
+    mailbox.Maildir.__init__(self, dirname, factory, create)
+    # (inode, key, path) of every message, sorted; None = no snapshot yet
+    self._listing = None
+
+  def _list(self):
+    # RETURN: list of (inode, key, subpath)
+    entries = []
+    for subdir in ('new', 'cur'):
+      for (name, inode) in \
+          osextra.listFilesWithInodes(os.path.join(self._path, subdir)):
+        entries.append((inode, name.split(self.colon)[0],
+                        os.path.join(subdir, name)))
+    return entries
+
+  def snapshot(self):
+    """Lists the directories, fixing the set of messages seen until the
+       next snapshot()."""
+    entries = self._list()
+    entries.sort()
+    self._toc = dict((key, subpath) for (inode, key, subpath) in entries)
+    self._listing = [(inode, key, os.path.join(self._path, subpath))
+                     for (inode, key, subpath) in entries]
+
+  # RETURN: list of (inode, key, path), sorted
+  def listing(self):
+    if self._listing == None:
+      self.snapshot()
+    return self._listing
+
+  def iterkeys(self):
+    """Return an iterator over keys."""
+    for (inode, key, path) in self.listing():
+      yield key
+
+  def _refresh(self):
+    # only snapshot() lists the directories
+    if self._listing == None:
+      self.snapshot()
+
+  def _lookup(self, key):
+    """Use TOC to return subpath for given key, or raise a KeyError."""
+    self._refresh()
+    subpath = self._toc.get(key)
+    if subpath == None:
+      return self._relocate(key)
+    return subpath
+
+  def _relocate(self, key):
+    """Lists the directories again and returns the new subpath of the
+       message `key'. The other messages of the snapshot that have
+       moved are updated as well, to spare a listing for each of them.
+       Raises MessageGone if the message is not there."""
+    found = None
+    for (inode, name, subpath) in self._list():
+      if name == key:
+        found = subpath
+      if name in self._toc:
+        self._toc[name] = subpath
+    if found == None:
+      raise MessageGone('No message with key: %s' % key)
+    self._toc[key] = found
+    return found
+
+  def _open(self, key, mode):
+    """Opens the file of the message `key', finding it again if it has
+       moved. RETURN: (file, subpath)"""
+    subpath = self._lookup(key)
+    try:
+      return (open(os.path.join(self._path, subpath), mode), subpath)
+    except IOError, e:
+      if e.errno != errno.ENOENT:
+        raise
+    subpath = self._relocate(key)
+    try:
+      return (open(os.path.join(self._path, subpath), mode), subpath)
+    except IOError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      # moved again in the meantime: rare enough to give up
+      raise MessageGone('No message with key: %s' % key)
+
+  def get_message(self, key):
+    """Return a Message representation or raise a KeyError."""
+    (f, subpath) = self._open(key, 'r')
+    try:
+      if self._factory:
+        msg = self._factory(f)
+      else:
+        msg = mailbox.MaildirMessage(f)
+      mtime = os.fstat(f.fileno()).st_mtime
+    finally:
+      f.close()
+    (subdir, name) = os.path.split(subpath)
+    msg.set_subdir(subdir)
+    if self.colon in name:
+      msg.set_info(name.split(self.colon)[-1])
+    msg.set_date(mtime)
+    return msg
+
+  def get_string(self, key):
+    """Return a string representation or raise a KeyError."""
+    (f, subpath) = self._open(key, 'r')
+    try:
+      return f.read()
+    finally:
+      f.close()
+
+  def get_file(self, key):
+    """Return a file-like representation or raise a KeyError."""
+    (f, subpath) = self._open(key, 'rb')
+    return mailbox._ProxyFile(f)
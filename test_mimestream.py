@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of mimestream.parseSkeleton against the email package: the
+# structure and the sizes of the parts it finds must be those of the
+# complete parse.
+# Run: python -m unittest test_mimestream
+
+import StringIO
+import email
+import unittest
+
+import mimestream
+
+_samples = {
+  'plain': """\
+Subject: plain
+
+line 1
+line 2
+""",
+  'nested': """\
+Subject: nested
+Content-Type: multipart/mixed; boundary="outer"
+
+preamble
+--outer
+Content-Type: text/plain
+
+first
+
+--outer
+Content-Type: multipart/alternative; boundary="inner"
+
+--inner
+Content-Type: text/plain
+
+plain
+--inner
+Content-Type: text/html
+
+<p>html</p>
+--inner--
+inner epilogue
+--outer
+Content-Type: message/rfc822
+
+Subject: forwarded
+
+body
+--outer
+Content-Type: message/rfc822
+
+Subject: forwarded twice
+Content-Type: message/rfc822
+
+Subject: forwarded once
+
+innermost body
+--outer
+Content-Type: message/rfc822
+
+Subject: forwarded multipart
+Content-Type: multipart/mixed; boundary="fwd"
+
+--fwd
+
+forwarded part
+--fwd--
+
+--outer
+Content-Type: application/octet-stream
+
+last
+--outer--
+epilogue
+""",
+  'digest': """\
+Subject: digest
+Content-Type: multipart/digest; boundary="d"
+
+--d
+
+Subject: one
+
+first message
+--d
+
+Subject: two
+Content-Type: multipart/mixed; boundary="m"
+
+--m
+
+part
+--m--
+--d
+Content-Type: text/plain
+
+not a message
+
+--d--
+""",
+  'crlf': """\
+Subject: crlf
+Content-Type: multipart/mixed; boundary="c"
+
+--c
+Content-Type: text/plain
+
+text\r\n\r\n--c
+Content-Type: message/rfc822
+
+Subject: inside
+
+inner\r\n--c--
+""",
+  'no boundary': """\
+Subject: no boundary
+Content-Type: multipart/mixed
+
+just text
+--x
+more text
+""",
+  'boundary not found': """\
+Subject: boundary not found
+Content-Type: multipart/mixed; boundary="missing"
+
+just text
+--other
+more text
+""",
+  'delivery status': """\
+Subject: bounce
+Content-Type: multipart/report; boundary="r"
+
+--r
+Content-Type: text/plain
+
+It bounced.
+--r
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; example.org
+
+Final-Recipient: rfc822; someone@example.org
+Action: failed
+
+--r--
+""",
+}
+
+def _shape(part):
+  # RETURN: (content type, payload size or list of the shapes of the
+  #          sub-parts)
+  if part.is_multipart():
+    return (part.get_content_type(),
+            [_shape(sub) for sub in part.get_payload()])
+  return (part.get_content_type(), mimestream.payloadSize(part))
+
+class SkeletonTest(unittest.TestCase):
+
+  def testSamples(self):
+    for (name, sample) in sorted(_samples.items()):
+      for eol in [None, '\r\n']:
+        if eol == None:
+          text = sample
+        else:
+          text = sample.replace('\r\n', '\n').replace('\n', eol)
+        skeleton = mimestream.parseSkeleton(
+          StringIO.StringIO(text), mimestream.MessageBudget(), None)
+        self.assertEqual(_shape(skeleton),
+                         _shape(email.message_from_string(text)),
+                         '%s, %r' % (name, eol))
+
+  def testSmallChunks(self):
+    # the lines and boundaries cross the chunks read
+    chunkSize = mimestream._chunkSize
+    mimestream._chunkSize = 7
+    try:
+      self.testSamples()
+    finally:
+      mimestream._chunkSize = chunkSize
+
+if __name__ == '__main__':
+  unittest.main()
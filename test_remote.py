@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of searches fanned out to workers (remote, mossworker.py), each
+# run as a process of its own on this host.
+# Run: python -m unittest test_remote
+
+import email.mime.application
+import email.mime.multipart
+import email.mime.text
+import mailbox
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import parallel
+import remote
+import scan
+import snapshotmaildir
+from expr import *
+from testutil import *
+
+# RETURN: path of a new mbox in `directory' with `count' messages, the
+#         i-th one from 'Person <i>' and with an attachment of i*100
+#         bytes if i is even
+def _makeMbox(directory, name, count):
+  path = os.path.join(directory, name)
+  mbox = mailbox.mbox(path)
+  for i in range(count):
+    text = email.mime.text.MIMEText('Hello %d from %s\n' % (i, name))
+    if i % 2 == 0:
+      message = email.mime.multipart.MIMEMultipart()
+      message.attach(text)
+      message.attach(email.mime.application.MIMEApplication('x' * (i*100)))
+    else:
+      message = text
+    message['From'] = 'Person %d <p%d@%s.example.com>' % (i, i, name)
+    message['Subject'] = 'Message %d of %s' % (i, name)
+    mbox.add(message)
+  mbox.close()
+  return path
+
+# RETURN: a TCP port nothing listens on (for now)
+def _freePort():
+  sock = socket.socket()
+  try:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+  finally:
+    sock.close()
+
+class RemoteSearchTest(unittest.TestCase):
+  """Two workers, one on a Unix socket and one on TCP, each serving two
+     mailboxes of its own."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.processes = []
+    self.workers = []
+    for (i, address) in enumerate([os.path.join(self.directory, 'socket'),
+                                   '127.0.0.1:%d' % _freePort()]):
+      paths = [_makeMbox(self.directory, 'box%d%s' % (i, suffix), 30 + i*7)
+               for suffix in 'ab']
+      self.startWorker(address, paths)
+
+  def tearDown(self):
+    for process in self.processes:
+      self.stopWorker(process)
+    shutil.rmtree(self.directory)
+
+  def stopWorker(self, process):
+    # a worker busy in its other threads does not always act on the
+    # first SIGTERM; nor must one that ignores them hang the tests
+    deadline = time.time() + 10
+    while process.poll() == None and time.time() < deadline:
+      process.terminate()
+      time.sleep(0.1)
+    if process.poll() == None:
+      process.kill()
+      process.wait()
+
+  def startWorker(self, address, paths):
+    process = subprocess.Popen(
+      [sys.executable, os.path.join(os.path.dirname(remote.__file__),
+                                    'mossworker.py'),
+       '-l', address, '-j', '2', '-c', '0'] + paths,
+      stderr=open(os.devnull, 'w'))
+    self.processes.append(process)
+    worker = remote.RemoteWorker(address)
+    # until it listens
+    for i in range(100):
+      try:
+        worker.listMailboxes()
+        break
+      except (socket.error, BaseException):
+        if process.poll() != None:
+          self.fail('mossworker.py exited with %d' % process.returncode)
+        time.sleep(0.1)
+    self.workers.append((worker, process, paths))
+
+  # RETURN: set of (qualified mailbox name, key) of the messages `query'
+  #         matches in `paths', searched here
+  def searchHere(self, worker, paths, query):
+    folders = [(path, scan.openMailbox(path), None) for path in paths]
+    found = set()
+    for (index, name, keys, overBudget, statistics) in \
+        parallel.searchFolders(query, folders, None, 0, 1):
+      found.update((worker.qualify(name), key) for key in keys)
+    return found
+
+  # RETURN: list of RemoteSearch of `workers', done
+  def fanOut(self, workers, query):
+    searches = [remote.RemoteSearch(worker, query) for worker in workers]
+    for search in searches:
+      search.start()
+    for search in searches:
+      search.join()
+    return searches
+
+  def queries(self):
+    return [substring(const(u'Person 1'), header('From')),
+            logical(ExprOr, [substring(const(u'box1a'), header('Subject')),
+                             attachmentLarger(1500)]),
+            logical(ExprAnd, [substring(const(u'Message'),
+                                        header('Subject')),
+                              attachmentLarger(20000)])]
+
+  def testResultsAreMerged(self):
+    names = []
+    for query in self.queries():
+      found = set()
+      expected = set()
+      for search in self.fanOut([worker for (worker, process, paths)
+                                 in self.workers], query):
+        (keys, overBudget, statistics, error) = search.getResults()
+        self.assertEqual(error, None)
+        self.assertEqual(len(keys), len(set(keys)))
+        found.update(keys)
+      for (worker, process, paths) in self.workers:
+        expected |= self.searchHere(worker, paths, query)
+      self.assertEqual(found, expected)
+      names.append(len(set(name for (name, key) in found)))
+    # in how many mailboxes each query matches
+    self.assertEqual(names, [4, 4, 0])
+
+  def testWorkerDown(self):
+    (worker, process, paths) = self.workers[1]
+    self.stopWorker(process)
+    query = self.queries()[0]
+    (up, down) = self.fanOut([self.workers[0][0], worker], query)
+    (keys, overBudget, statistics, error) = up.getResults()
+    self.assertEqual(error, None)
+    self.assertEqual(set(keys), self.searchHere(self.workers[0][0],
+                                                self.workers[0][2], query))
+    (keys, overBudget, statistics, error) = down.getResults()
+    self.assertEqual(keys, [])
+    self.assertNotEqual(error, None)
+
+  def testGetMessage(self):
+    (worker, process, paths) = self.workers[0]
+    (names, errors) = worker.listMailboxes()
+    self.assertEqual(sorted(names), sorted(paths))
+    local = mailbox.mbox(paths[0])
+    for key in (0, 5):
+      self.assertEqual(worker.getMessage(paths[0], key)['Subject'],
+                       local.get_message(key)['Subject'])
+    self.assertRaises(snapshotmaildir.MessageGone, worker.getMessage,
+                      paths[0], 1000)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+# Helpers shared by the tests (test_*.py) and benchmarks (bench_*.py):
+# building queries without the UI.
+
+from expr import *
+from expr_special import *
+from expr_eval import *
+
+def const(value, etype=ET.String):
+  return ExprConst(etype, dict(), {'value': value})
+
+def header(name):
+  return ExprCustomHeader(ET.String, dict(), {'name': name})
+
+def substring(sub, super):
+  expr = ExprSubstring(ET.Bool, dict(), dict())
+  expr.replaceChild(expr._childSub, sub)
+  expr.replaceChild(expr._childSuper, super)
+  return expr
+
+def logical(cls, children):
+  expr = cls(ET.Bool, dict(), dict())
+  expr.replaceChildren(children)
+  return expr
+
+def exists(varType, values, body):
+  expr = ExprExists(ET.Bool, {'variable type': varType}, dict())
+  expr.replaceValues(values)
+  expr.replaceExpr(body)
+  return expr
+
+def attachmentLarger(size):
+  attSize = ExprAttSize(ET.Int, dict(), dict())
+  attSize.replaceChild(attSize._child, ExprVar(ET.Attachment, dict(), dict()))
+  gt = ExprGt(ET.Bool, dict(), dict())
+  gt.replaceChild(gt._left, attSize)
+  gt.replaceChild(gt._right, const(size, ET.Int))
+  return exists(ET.Attachment, [ExprAllAttachments(ET.Attachment, dict(),
+                                                   dict())], gt)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Piotr Koźbiał
+#
+# This file is part of Moss.
+# 
+# Moss is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Moss is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Moss.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import mailbox
+import sys
+
+import mimestream
+
+class ValueCache:
+  """Values of subexpressions of queries on messages, kept from one
+     search to the next in the process doing the evaluation, so that
+     running a query again with a part changed does not read the
+     messages again for the parts that did not (see expr_compile). What
+     needs only the headers is kept only for messages whose headers are
+     not in a HeaderCache already (IMAP mailboxes, ...).
+     An entry is keyed by the key of the subexpression (Expr.getKey) and
+     the key of the message (see messageKey). The entries least recently
+     used are dropped when their estimated size exceeds `size' bytes.
+     Used by one thread at a time."""
+
+  # estimated memory taken by an entry besides its value: the node of
+  # the OrderedDict, the key tuples
+  entryOverhead = 200
+  # ... and by an attachment, as kept (see _storable)
+  partSize = 400
+
+  def __init__(self, size):
+    self._size = size
+    self._used = 0
+    # (expression key, message key) -> (value, estimated size), the
+    # least recently used first
+    self._entries = collections.OrderedDict()
+    self._hits = 0
+    self._misses = 0
+
+  # RETURN: the value kept for `key', `default' if there is none
+  def get(self, key, default=None):
+    entry = self._entries.pop(key, None)
+    if entry == None:
+      self._misses += 1
+      return default
+    self._entries[key] = entry
+    self._hits += 1
+    return entry[0]
+
+  def put(self, key, value):
+    value = _storable(value)
+    size = self.entryOverhead + _sizeOf(value)
+    if size > self._size:
+      return
+    old = self._entries.pop(key, None)
+    if old != None:
+      self._used -= old[1]
+    while self._used + size > self._size:
+      (oldKey, (oldValue, oldSize)) = self._entries.popitem(last=False)
+      self._used -= oldSize
+    self._entries[key] = (value, size)
+    self._used += size
+
+  # RETURN: (number of entries, their estimated size, hits, misses)
+  def getStatistics(self):
+    return (len(self._entries), self._used, self._hits, self._misses)
+
+def messageKey(mboxName, mbox, key, message):
+  """RETURNS the key of the message with the key `key' in the mailbox
+     `mbox' named `mboxName', for a ValueCache: the mailbox key, with
+     the position of an mbox message (the keys of an mbox are reused if
+     it is rewritten) and the Message-ID"""
+  position = None
+  # the position of a Maildir message is its file, renamed as its flags
+  # change
+  if not isinstance(mbox, mailbox.Maildir) and hasattr(mbox, '_toc'):
+    position = mbox._toc.get(key)
+  return (mboxName, key, position, message.headerToUnicode('Message-ID'))
+
+def _storable(value):
+  # a list of attachments (ExprAllAttachments): what matters of them is
+  # whether they are multipart, and the size of their payload (see
+  # ExprAttSize), which a SkeletonPart without headers has
+  if isinstance(value, list):
+    parts = []
+    for part in value:
+      skeleton = mimestream.SkeletonPart()
+      if part.is_multipart():
+        skeleton.set_payload([])
+      else:
+        skeleton.bodySize = mimestream.payloadSize(part)
+      parts.append(skeleton)
+    return parts
+  return value
+
+def _sizeOf(value):
+  if isinstance(value, list):
+    return sys.getsizeof(value) + len(value) * ValueCache.partSize
+  return sys.getsizeof(value)